@@ -0,0 +1,49 @@
+#!/bin/bash
+# mock_cli.sh with knobs for benchmarking, set through the environment:
+#   BENCH_PROMPT_DELAY  seconds to wait before every prompt, e.g. 0.05 for a slow CLI (default 0)
+#   BENCH_CONFIG_BYTES  extra bytes of settings printed by 'print config' (default 0)
+PASSWORD=RHUG2020
+LOGFILE=/tmp/pexpect_mock_cli_bench.$(date '+%Y%m%d').log
+PROMPT_DELAY=${BENCH_PROMPT_DELAY:-0}
+CONFIG_BYTES=${BENCH_CONFIG_BYTES:-0}
+
+echo "Welcome to the mock CLI!"
+echo "Logfile: $LOGFILE"
+
+read -s -p "Enter password: " PASSWORD_CHECK
+
+if [[ $PASSWORD_CHECK == $PASSWORD ]]; then
+  echo -e "\nPassword accepted!\n"
+else
+  exit 1
+fi
+
+while true; do
+    if [[ $PROMPT_DELAY != 0 ]]; then
+        sleep "$PROMPT_DELAY"
+    fi
+    IFS=' ' read -p "> " -a TEST
+    case "${TEST[@]}" in
+        set*)
+            echo "${TEST[1]} set to ${TEST[2]}"
+        ;;
+        add*)
+            echo "${TEST[1]} added"
+        ;;
+        print\ config)
+            echo -e "\nFake Config:\nminheap: 1024m\nmaxheap: 5120m\nport: 7000\nwebport: 80"
+            if [[ $CONFIG_BYTES != 0 ]]; then
+                yes "option: abcdefghijklmnopqrstuvwxyz0123456789" | head -c "$CONFIG_BYTES"
+                echo
+            fi
+        ;;
+        save)
+            echo "Settings saved!"
+        ;;
+        exit)
+            echo "Exiting fake cli"; break
+        ;;
+    esac
+done
+
+exit 0
@@ -0,0 +1,43 @@
+#!/bin/bash
+# mock_install.sh with knobs for benchmarking, set through the environment:
+#   BENCH_OUTPUT_BYTES  bytes of build output printed before the continue prompt (default 0)
+#   BENCH_PROMPT_DELAY  seconds to wait before every prompt (default 0)
+#   BENCH_MARKER        file created by a successful install (default /tmp/pexpect_mock_bench)
+PASSWORD=RHUG2020
+FILE=${BENCH_MARKER:-/tmp/pexpect_mock_bench}
+LOGFILE=/tmp/pexpect_mock_bench.$(date '+%Y%m%d').log
+PROMPT_DELAY=${BENCH_PROMPT_DELAY:-0}
+OUTPUT_BYTES=${BENCH_OUTPUT_BYTES:-0}
+
+echo "Welcome to the mock interactive installer!"
+
+if test -f "$FILE"; then
+    echo "Software already installed at: $FILE"
+    exit 0
+fi
+
+sleep "$PROMPT_DELAY"
+read -p "Please enter your password: " PASSWORD_CHECK
+
+if [[ $PASSWORD_CHECK == $PASSWORD ]]; then
+  echo -e "\nPassword accepted!\n"
+else
+  exit 0
+fi
+
+echo "Let's pretend we're installing a program..."
+if [[ $OUTPUT_BYTES != 0 ]]; then
+    yes "compiling component libfoo/src/module.c ... ok" | head -c "$OUTPUT_BYTES"
+    echo
+fi
+
+echo "ERROR: splines not properly reticulated..."
+sleep "$PROMPT_DELAY"
+read -p "Do you wish to continue anyways (Y/n)?" CHOICE
+
+touch "$FILE"
+echo "We ran the install mock script at: $(date)" >>$LOGFILE
+echo "Log file: $LOGFILE"
+echo "Created file: $FILE"
+echo "Install successful!"
+exit 0
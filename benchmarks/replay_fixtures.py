@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Replay recorded sessions with the demo mock scripts through run_pexpect() of both modules, no pty or waiting.
+
+Every case in CASES has a transcript in transcripts/ holding the session and the outcome of the run it was
+recorded from: the return values, or the type and first line of the error. A replay passes when run_pexpect()
+still makes the same sends and ends with the same outcome, which takes milliseconds even for the cases that
+end in a timeout. Record the transcripts again after changing the mock scripts; that runs the real scripts and
+takes a few seconds.
+The cases in DIALOG_CASES are replayed a second time with the built-in dialog of their module written as data,
+see keyva_pexpect.dialog, which has to make the same sends and end the same way as the hand-written code.
+A case with bounded_capture runs the installer with a BoundedCapture of that head and tail size and keeps what
+it captured in the outcome, so the redacted output is compared as well.
+tests/test_replay.py runs the same replays under pytest.
+
+Examples:
+    python benchmarks/replay_fixtures.py
+    python benchmarks/replay_fixtures.py --only install_
+    python benchmarks/replay_fixtures.py --record
+"""
+import argparse
+import os
+import sys
+import time
+
+from run_benchmarks import REPO_DIR, PASSWORD, install_import_shim, load_library
+
+TRANSCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcripts')
+MOCK_INSTALL = os.path.join(REPO_DIR, 'roles', 'pexpect_demo', 'files', 'mock_install.sh')
+MOCK_CLI = os.path.join(REPO_DIR, 'roles', 'pexpect_demo', 'files', 'mock_cli.sh')
+# What mock_install.sh leaves behind, its presence makes the script say it is already installed
+INSTALL_MARKER = '/tmp/pexpect_mock_demo'
+CLI_COMMANDS = ['set minheap 1024m', 'set maxheap 5120m', 'set port 7000', 'set webport 80']
+# socket.1 and socket.2 don't exist yet, each first set of one fails and is sent again after 'add socket'
+CLI_MISSING_ITEM_COMMANDS = ['set port 7000', 'set socket.1.port 8080', 'set socket.1.host a', 'set socket.2.port 80']
+
+# (name, module, installed, run_pexpect keyword arguments)
+CASES = [
+    ('install', 'keyva_pexpect_install', False, dict(timeout=5)),
+    ('install_already_installed', 'keyva_pexpect_install', True, dict(timeout=5)),
+    ('install_password', 'keyva_pexpect_install', False, dict(timeout=5, mock_failure='password')),
+    ('install_password_probe', 'keyva_pexpect_install', False,
+     dict(timeout=5, mock_failure='password', password_check='probe')),
+    ('install_probe', 'keyva_pexpect_install', False, dict(timeout=5, password_check='probe')),
+    ('install_timeout', 'keyva_pexpect_install', False, dict(timeout=2, mock_failure='timeout')),
+    ('install_error_abort', 'keyva_pexpect_install', False, dict(timeout=5, mock_failure='error_abort')),
+    ('install_die_early', 'keyva_pexpect_install', False, dict(timeout=5, mock_failure='die_early')),
+    ('install_bounded_capture', 'keyva_pexpect_install', False, dict(timeout=5, bounded_capture=(256, 96))),
+    ('cli', 'keyva_pexpect_cli', None, dict(options='-o myoption', commands=CLI_COMMANDS, timeout=5)),
+    ('cli_no_changes', 'keyva_pexpect_cli', None, dict(options='mock_no_changes', commands=CLI_COMMANDS, timeout=5)),
+    ('cli_pipelined', 'keyva_pexpect_cli', None,
+     dict(options='-o myoption', commands=CLI_COMMANDS, timeout=5, pipeline=32)),
+    ('cli_missing_item', 'keyva_pexpect_cli', None, dict(options='', commands=CLI_MISSING_ITEM_COMMANDS, timeout=5)),
+]
+
+# Cases the data version of the dialog covers, the others test options only the hand-written code has
+DIALOG_CASES = ['install', 'install_already_installed', 'install_password', 'install_error_abort',
+                'install_die_early', 'install_bounded_capture', 'cli', 'cli_no_changes', 'cli_missing_item']
+DIALOGS = {'keyva_pexpect_install': 'install', 'keyva_pexpect_cli': 'cli'}
+
+
+def transcript_path(name):
+    return os.path.join(TRANSCRIPT_DIR, name + '.json')
+
+
+def set_installed(installed):
+    if installed is None:
+        return
+    if installed:
+        open(INSTALL_MARKER, 'a').close()
+    elif os.path.exists(INSTALL_MARKER):
+        os.unlink(INSTALL_MARKER)
+
+
+def run_case(module, params, **hooks):
+    """
+    Call run_pexpect() of the module and return its outcome as something that can be stored as JSON
+    """
+    import pexpect
+    library = load_library(module)
+    params = dict(params)
+    bounded_capture = params.pop('bounded_capture', None)
+    if bounded_capture is not None:
+        from ansible.module_utils.keyva_pexpect.capture import BoundedCapture
+        params['capture'] = BoundedCapture(*bounded_capture, redact=[PASSWORD])
+    try:
+        if module == 'keyva_pexpect_install':
+            output, logfile, changed, exitstatus, errors = library.run_pexpect(MOCK_INSTALL, PASSWORD, **dict(
+                params, **hooks))
+            outcome = {'changed': changed, 'logfile': text(logfile), 'exitstatus': exitstatus,
+                       'errors_found': [text(error) for error in errors]}
+            if bounded_capture is not None:
+                # Bytes are kept as they are, a password that got through is not hidden by text()
+                outcome['output'] = text(output)
+            return outcome
+        current_settings, changed, logfile = library.run_pexpect(MOCK_CLI, password=PASSWORD, **dict(
+            params, **hooks))
+        return {'changed': changed, 'logfile': text(logfile), 'current_settings': text(current_settings)}
+    except RuntimeError as err:
+        # The rest of the message has the output, which differs between runs
+        return {'error': type(err).__name__, 'msg': str(err).splitlines()[0]}
+    except pexpect.ExceptionPexpect as err:
+        # pexpect's messages describe the child, a replayed one looks different
+        return {'error': type(err).__name__}
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if value is not None:
+        # The replayed output has the password redacted
+        return value.replace(PASSWORD, '<redacted>')
+    return value
+
+
+def record(name, module, installed, params):
+    from ansible.module_utils.keyva_pexpect.transcript import load, dump
+    path = transcript_path(name)
+    set_installed(installed)
+    try:
+        outcome = run_case(module, params, transcript=path)
+    finally:
+        set_installed(False if installed is not None else None)
+    transcript = load(path)
+    transcript.update(outcome=outcome)
+    dump(path, transcript)
+    return outcome, None
+
+
+def replay(name, module, installed, params, **hooks):
+    from ansible.module_utils.keyva_pexpect.transcript import load, replayer
+    path = transcript_path(name)
+    expected = load(path)['outcome']
+    outcome = run_case(module, params, spawn=replayer(path, redact=[PASSWORD]), **hooks)
+    if outcome != expected:
+        return outcome, 'expected {0}'.format(expected)
+    return outcome, None
+
+
+def runs(record=False):
+    """
+    (name, module, installed, run_pexpect keyword arguments, hooks) for every case, and when replaying for every
+    case in DIALOG_CASES again with its built-in dialog
+    """
+    runs = [(name, module, installed, params, {}) for name, module, installed, params in CASES]
+    if not record:
+        from ansible.module_utils.keyva_pexpect.dialog import compile_dialog, load_dialog
+        runs.extend((name + '+dialog', module, installed, params,
+                     dict(dialog=compile_dialog(load_dialog(DIALOGS[module]))))
+                    for name, module, installed, params in CASES if name in DIALOG_CASES)
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded sessions with the mock scripts')
+    parser.add_argument('--only', default='', help='only run cases whose name starts with this')
+    parser.add_argument('--record', action='store_true', help='record the transcripts from the mock scripts')
+    args = parser.parse_args(argv)
+    install_import_shim()
+    if args.record and not os.path.isdir(TRANSCRIPT_DIR):
+        os.makedirs(TRANSCRIPT_DIR)
+
+    failed = 0
+    start = time.time()
+    for name, module, installed, params, hooks in runs(args.record):
+        if not name.startswith(args.only):
+            continue
+        case_start = time.time()
+        if args.record:
+            outcome, problem = record(name, module, installed, params)
+        else:
+            outcome, problem = replay(name.split('+')[0], module, installed, params, **hooks)
+        status = 'FAIL' if problem else 'ok'
+        failed += bool(problem)
+        print('{0:<34} {1:<5} {2:8.4f}s {3}'.format(
+            name, status, time.time() - case_start, outcome.get('error') or 'changed={0}'.format(outcome['changed'])))
+        if problem:
+            print('    {0}\n    got {1}'.format(problem, outcome))
+    print('{0} in {1:.3f}s'.format('recorded' if args.record else '{0} failed'.format(failed), time.time() - start))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
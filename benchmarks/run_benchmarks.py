@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Local benchmarks for the pexpect modules, using the mock scripts in this directory.
+
+Every case runs in its own python process so the peak RSS reported is that case's alone. Each case reports
+    - wall_s: wall clock time of the measured part
+    - cpu_s: CPU time of the python process only, the mock scripts run in their own process, so this is the
+      time spent reading and matching output
+    - peak_rss_kb: peak resident memory of the python process
+plus what is specific to the case, like per command round trip times or commands per second.
+The results are written to a JSON file, pass the file of an earlier run with --compare to see what changed.
+
+Needs nothing but bash and pexpect, when ansible is not installed the module_utils in this repo are made
+importable as ansible.module_utils.
+
+Examples:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --commands 1000 --output-mb 16 -o after.json --compare before.json
+    python benchmarks/run_benchmarks.py --only cli_
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+MODULE_UTILS = os.path.join(REPO_DIR, 'module_utils')
+MOCK_CLI = os.path.join(BENCH_DIR, 'mock_cli_bench.sh')
+MOCK_INSTALL = os.path.join(BENCH_DIR, 'mock_install_bench.sh')
+PASSWORD = 'RHUG2020'
+MB = 1024 * 1024
+
+
+def cases(args):
+    """
+    (name, kind, params) for every case, kind is the name of the function below that runs it
+    """
+    commands = args.commands
+    output_bytes = int(args.output_mb * MB)
+    return [
+        ('cli_spawn', 'bench_cli_spawn', dict(repeat=args.repeat)),
+        ('cli_rtt', 'bench_cli_rtt', dict(commands=commands)),
+        ('cli_throughput', 'bench_cli_run', dict(commands=commands, pipeline=0)),
+        ('cli_throughput_pipelined', 'bench_cli_run', dict(commands=commands, pipeline=32)),
+        ('cli_slow_prompt', 'bench_cli_run', dict(commands=min(commands, 20), pipeline=0,
+                                                  prompt_delay=args.prompt_delay)),
+        ('cli_slow_prompt_pipelined', 'bench_cli_run', dict(commands=min(commands, 20), pipeline=32,
+                                                            prompt_delay=args.prompt_delay)),
+        ('cli_big_config', 'bench_cli_run', dict(commands=0, pipeline=0, config_bytes=output_bytes)),
+        ('install', 'bench_install', dict(output_bytes=0)),
+        ('install_big_output', 'bench_install', dict(output_bytes=output_bytes)),
+        ('install_big_output_bounded', 'bench_install', dict(output_bytes=output_bytes, bounded=True)),
+        ('install_big_output_ring', 'bench_install', dict(output_bytes=output_bytes, bounded=True,
+                                                          buffer_engine='ring')),
+        ('matcher_pexpect', 'bench_matcher', dict(output_bytes=output_bytes, engine='pexpect')),
+        ('matcher_keyva', 'bench_matcher', dict(output_bytes=output_bytes, engine='keyva')),
+    ]
+
+
+def install_import_shim():
+    """
+    Make the module_utils in this repo importable as ansible.module_utils, like ansible does on a remote host
+    """
+    try:
+        import ansible.module_utils
+    except ImportError:
+        for name, path in (('ansible', []), ('ansible.module_utils', [MODULE_UTILS])):
+            module = types.ModuleType(name)
+            module.__path__ = path
+            sys.modules[name] = module
+        sys.modules['ansible'].module_utils = sys.modules['ansible.module_utils']
+    else:
+        # An installed ansible doesn't know about our module_utils, look in the repo as well
+        if MODULE_UTILS not in ansible.module_utils.__path__:
+            ansible.module_utils.__path__.append(MODULE_UTILS)
+
+
+def load_library(name):
+    """
+    Import one of the modules in library/ by file name
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, 'library', name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_commands(count):
+    return ['set option{0} value{0}'.format(n) for n in range(count)]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def spread(name, values):
+    return {name + '_min_s': min(values), name + '_p50_s': percentile(values, 0.5),
+            name + '_p95_s': percentile(values, 0.95), name + '_max_s': max(values)}
+
+
+def bench_cli_spawn(repeat):
+    """
+    Start mock CLI, log in and wait for its first prompt, then exit it
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.cli_session import login, start_config
+    from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+    eof = PatternMatcher([pexpect.EOF])
+    to_prompt = []
+    to_close = []
+    for _ in range(repeat):
+        start = time.time()
+        child = pexpect.spawn(MOCK_CLI, encoding='utf-8')
+        login(child, PASSWORD)
+        start_config(child)
+        to_prompt.append(time.time() - start)
+        start = time.time()
+        child.sendline('exit')
+        expect(child, eof)
+        child.close()
+        to_close.append(time.time() - start)
+    result = spread('spawn_to_prompt', to_prompt)
+    result.update(spread('close', to_close))
+    return result
+
+
+def bench_cli_rtt(commands):
+    """
+    Round trip of single commands in a session that is already at the prompt
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.cli_session import login, start_config, run_command
+    child = pexpect.spawn(MOCK_CLI, encoding='utf-8')
+    try:
+        login(child, PASSWORD)
+        start_config(child)
+        times = []
+        for command in bench_commands(commands):
+            start = time.time()
+            run_command(child, command)
+            times.append(time.time() - start)
+        child.sendline('exit')
+    finally:
+        child.close()
+    return spread('rtt', times)
+
+
+def bench_cli_run(commands, pipeline, prompt_delay=0, config_bytes=0):
+    """
+    A whole keyva_pexpect_cli run_pexpect() call
+    """
+    os.environ['BENCH_PROMPT_DELAY'] = str(prompt_delay)
+    os.environ['BENCH_CONFIG_BYTES'] = str(config_bytes)
+    cli = load_library('keyva_pexpect_cli')
+    start = time.time()
+    current_settings, changed, logfile = cli.run_pexpect(MOCK_CLI, '', bench_commands(commands), PASSWORD,
+                                                         pipeline=pipeline)
+    wall = time.time() - start
+    return {'commands': commands, 'commands_per_s': commands / wall if commands else None,
+            'config_bytes': len(current_settings)}
+
+
+def bench_install(output_bytes, bounded=False, buffer_engine='default'):
+    """
+    A whole keyva_pexpect_install run_pexpect() call with a fresh marker file
+    """
+    marker_dir = tempfile.mkdtemp(prefix='keyva_bench')
+    os.environ['BENCH_MARKER'] = os.path.join(marker_dir, 'installed')
+    os.environ['BENCH_OUTPUT_BYTES'] = str(output_bytes)
+    install = load_library('keyva_pexpect_install')
+    capture = None
+    if bounded:
+        from ansible.module_utils.keyva_pexpect.capture import BoundedCapture
+        capture = BoundedCapture()
+    start = time.time()
+    try:
+        script_output, logfile, changed, exitstatus, errors = install.run_pexpect(MOCK_INSTALL, PASSWORD,
+                                                                                  capture=capture,
+                                                                                  buffer_engine=buffer_engine)
+    finally:
+        shutil.rmtree(marker_dir)
+    wall = time.time() - start
+    return {'output_bytes': output_bytes, 'result_bytes': len(script_output),
+            'mb_per_s': output_bytes / MB / wall if output_bytes else None}
+
+
+def bench_matcher(output_bytes, engine):
+    """
+    Only the matching, feed installer output to pexpect's expect machinery the way a read loop does
+    """
+    import pexpect
+    from pexpect.expect import Expecter, searcher_re
+    from pexpect.spawnbase import SpawnBase
+    from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, Searcher
+    patterns = [r'ERROR:.+?\r\n', r'(?i)do you wish to continue', r'(?i)log file:.+?\r\n', r'FATAL ERROR',
+                pexpect.EOF]
+    line = b'compiling component libfoo/src/module.c ... ok\r\n'
+    data = line * (output_bytes // len(line)) + b'Do you wish to continue anyways (Y/n)?'
+    child = SpawnBase()
+    if engine == 'pexpect':
+        searcher = searcher_re(child.compile_pattern_list(patterns))
+    else:
+        searcher = Searcher(PatternMatcher(patterns))
+    expecter = Expecter(child, searcher, -1)
+    index = None
+    for offset in range(0, len(data), child.maxread):
+        index = expecter.new_data(data[offset:offset + child.maxread])
+        if index is not None:
+            break
+    if index != 1:
+        raise RuntimeError('matcher found {0} instead of the continue prompt'.format(index))
+    return {'output_bytes': len(data)}
+
+
+def run_worker(kind, params):
+    """
+    Run one case in this process and return its measurements
+    """
+    install_import_shim()
+    # Imports are not part of any case
+    import pexpect
+    from ansible.module_utils.keyva_pexpect import cli_session, capture, matcher
+    start_cpu = time.process_time()
+    start = time.time()
+    result = globals()[kind](**params)
+    result['wall_s'] = time.time() - start
+    result['cpu_s'] = time.process_time() - start_cpu
+    # ru_maxrss is in kilobytes on linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run_case(name, kind, params, timeout):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', kind, '--params', json.dumps(params)]
+    env = dict(os.environ, TERM='dumb')
+    try:
+        output = subprocess.check_output(command, env=env, timeout=timeout, universal_newlines=True)
+        result = json.loads(output.splitlines()[-1])
+    except subprocess.CalledProcessError as err:
+        result = {'error': 'exit status {0}'.format(err.returncode)}
+    except subprocess.TimeoutExpired:
+        result = {'error': 'timed out after {0}s'.format(timeout)}
+    result.update(name=name, params=params)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', '-C', REPO_DIR, 'rev-parse', 'HEAD'], universal_newlines=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """
+    Print every timing and memory number next to the same number from an earlier run
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = dict((case['name'], case) for case in json.load(baseline_file)['results'])
+    print('\n{0:<28} {1:<22} {2:>12} {3:>12} {4:>8}'.format('case', 'metric', 'baseline', 'now', 'ratio'))
+    for case in results:
+        old = baseline.get(case['name'])
+        if old is None:
+            continue
+        for metric in sorted(case):
+            if not metric.endswith(('_s', '_kb')) or not old.get(metric) or case[metric] is None:
+                continue
+            print('{0:<28} {1:<22} {2:>12.4f} {3:>12.4f} {4:>7.2f}x'.format(
+                case['name'], metric, old[metric], case[metric], case[metric] / old[metric]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the keyva pexpect modules against mock scripts')
+    parser.add_argument('-o', '--output', default='benchmark-results.json',
+                        help='JSON file the results are written to')
+    parser.add_argument('--compare', help='results file of an earlier run to compare with')
+    parser.add_argument('--only', default='', help='only run cases whose name starts with this')
+    parser.add_argument('--commands', type=int, default=200, help='commands sent by the CLI cases')
+    parser.add_argument('--output-mb', type=float, default=4, help='MB of output for the big output cases')
+    parser.add_argument('--prompt-delay', type=float, default=0.05,
+                        help='seconds the slow prompt cases wait before every prompt')
+    parser.add_argument('--repeat', type=int, default=10, help='sessions started by cli_spawn')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds before a case is stopped')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, json.loads(args.params))))
+        return 0
+
+    results = []
+    for name, kind, params in cases(args):
+        if not name.startswith(args.only):
+            continue
+        result = run_case(name, kind, params, args.timeout)
+        results.append(result)
+        print('{0:<28} {1}'.format(name, result.get('error') or
+                                   'wall {0:.3f}s cpu {1:.3f}s rss {2}kB'.format(
+                                       result['wall_s'], result['cpu_s'], result['peak_rss_kb'])))
+    report = {'time': time.time(), 'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    try:
+        import pexpect
+        report['pexpect'] = pexpect.__version__
+    except ImportError:
+        pass
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print('Results written to {0}'.format(args.output))
+    if args.compare:
+        compare(results, args.compare)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+import functools
 import os
+import shlex
 import sys
+import time
 
 DOCUMENTATION = '''
 ---
@@ -10,16 +13,42 @@ short_description: This is a custom module using pexpect to run commands in mysc
 
 description:
     - "This module runs commands inside a script in a shell. When run without commands it returns current settings only."
+    - "Check mode reports which commands would change the config, using the snapshot saved by the last run with
+       diff_config or plan_commands, or by the last check, when there is one so the script does not have to be
+       started."
 
 options:
     path:
         description:
             - Path to the script to run
-        required: true
+            - Required unless targets is given
+        required: false
     commands:
         description:
             - The commands to run inside myscript in order
         required: false
+    commands_file:
+        description:
+            - Read the commands from this file on the remote host instead of commands, one per line, blank lines
+              and lines starting with # are skipped. For configs too big to pass as a list.
+            - The file is read and sent checkpoint_every commands at a time with a save after each chunk, so memory
+              use does not grow with the size of the file
+            - Not used with session_pool, targets or dialog. diff_config and plan_commands don't apply to the run,
+              check mode reports the commands that would change the config.
+        required: false
+    checkpoint_every:
+        description:
+            - Number of commands from commands_file sent between two saves. How far the file got is recorded under
+              state_dir after every save.
+        required: false
+        default: 1000
+    resume:
+        description:
+            - When an earlier run with the same path, options and commands_file failed partway through, start after
+              its last checkpoint instead of from the top, as long as the file was not changed since
+            - The commands sent after the last checkpoint are sent again
+        required: false
+        default: true
     options:
         description:
             - options to pass the script
@@ -32,7 +61,190 @@ options:
     password:
         description:
             - Password needed to run myscript
-        required: true
+            - With targets this is the password for every target that does not set its own
+        required: false
+    pipeline:
+        description:
+            - Number of commands to write ahead of the prompt before reading their replies back in order
+            - Each reply is still matched to its command so the automatic add and error reporting work per command
+            - 0 sends one command at a time and waits for the prompt before sending the next
+        required: false
+        default: 0
+    spawn_mode:
+        description:
+            - direct runs the script itself and takes its exit status from the process when it exits
+            - shell runs the script from an interactive bash shell and reads the exit status with 'echo $?',
+              options are then expanded by the shell
+        choices: ['direct', 'shell']
+        required: false
+        default: direct
+    diff_config:
+        description:
+            - Read the config before running the commands and only send the set commands that change a value
+            - save is skipped when nothing needs to be sent, so a run that changes nothing never touches the config
+        required: false
+        default: false
+    plan_commands:
+        description:
+            - Read the config before running the commands and plan them so none of them fails, instead of reacting
+              to every 'ERROR ... does not exist' with an add and a retry
+            - The add commands for item instances that are not in the config yet, like socket.3 when only socket.1
+              exists, are put in front of the first set that needs them, in instance order
+            - A set that a later set of the same key overrides is not sent, nothing is planned across a command
+              other than set and add
+            - With diff_config the sets that don't change anything are left out as well, check mode then reports
+              the planned commands including the adds
+        required: false
+        default: false
+    dialog:
+        description:
+            - Drive myscript with a dialog written as data instead of the built-in one, a dict of states with the
+              patterns to wait for, what to send and which state comes next, see keyva_pexpect.dialog
+            - Either the dialog itself, the path of a JSON or YAML file on the remote host holding it, or cli for
+              the built-in dialog written that way
+            - The dialog is started with the variables password, timeout, commands and changed and runs the whole
+              session from the logfile banner to exit. The module reads logfile, current_settings and changed from
+              the variables it ends with.
+            - Needs spawn_mode direct, not used with session_pool, targets or in check mode. diff_config and
+              plan_commands don't apply, the dialog sends the commands as given.
+        required: false
+    state_dir:
+        description:
+            - Directory on the remote host for the config snapshot saved after runs with diff_config or
+              plan_commands and after checks and used by check mode, and for the offsets reached by logfile_scan
+            - A snapshot that can't be saved is a warning, the next check reads the config from the script again
+        required: false
+        default: ~/.ansible/keyva_pexpect
+    config_cache_max_age:
+        description:
+            - Seconds a saved config snapshot can be used by check mode before the config is read from the script again
+            - 0 means the snapshot is always used
+        required: false
+        default: 0
+    logfile_scan:
+        description:
+            - Scan the logfile myscript reports for lines matching logfile_patterns and return them
+            - Only the part written since the last scan is read, the offset reached is kept under state_dir.
+              The whole file is read again when it was replaced, truncated or rewritten.
+            - Not done in check mode or for targets
+        required: false
+        default: false
+    logfile_patterns:
+        description:
+            - Regexes for the logfile lines returned by logfile_scan
+        required: false
+        default: ['ERROR', '(?i)warn']
+    session_pool:
+        description:
+            - Run the commands in a session kept logged in by a broker on the remote host instead of starting
+              and logging in to myscript for every task
+            - The broker is started by the first task that needs it and exits once it has been idle for
+              pool_idle_timeout seconds
+        required: false
+        default: false
+    pool_socket:
+        description:
+            - Unix socket the session pool broker listens on
+        required: false
+        default: ~/.ansible/keyva_pexpect/pool.sock
+    pool_idle_timeout:
+        description:
+            - Seconds a pooled session may sit unused before the broker closes it
+        required: false
+        default: 300
+    pool_max_sessions:
+        description:
+            - Most sessions the broker keeps open at once, the least recently used idle session is closed to make room
+        required: false
+        default: 8
+    targets:
+        description:
+            - Several scripts to configure in one task instead of path, each a dict with path and optionally
+              options, commands, password and timeout, which default to the module options of the same name
+            - All targets run at the same time on one event loop, a slow prompt in one does not hold up the others
+            - A target that fails does not stop the others, the task fails after all of them finished
+            - Needs python 3 on the remote host, session_pool and spawn_mode shell are not used for targets
+        required: false
+    concurrency:
+        description:
+            - Most targets running at the same time
+        required: false
+        default: 4
+    transcript:
+        description:
+            - Record the session with myscript to this file on the remote host, gzipped when it ends in .gz
+            - The password is redacted. The file can be replayed with keyva_pexpect.transcript to test changes to
+              the dialog without running myscript.
+            - Not recorded in check mode when the saved snapshot is used, or for session_pool or targets
+        required: false
+    idle_timeout:
+        description:
+            - Fail when myscript prints nothing for this many seconds, counted from its last output or the last
+              thing we sent, instead of waiting for timeout. 0 turns it off.
+            - Not used for session_pool or targets
+        required: false
+        default: 0
+    step_history:
+        description:
+            - Keep how long each step took on successful runs under state_dir and fail a step that takes much
+              longer than it used to, once it has 5 runs of history
+            - A step past its deadline still finishes while it keeps printing, it fails after 5 seconds without
+              output
+            - Not used for session_pool or targets
+        required: false
+        default: false
+    step_deadline_factor:
+        description:
+            - The deadline of a step is the p99 of its earlier times multiplied by this
+        required: false
+        default: 3
+    step_deadline_min:
+        description:
+            - Seconds a step deadline from step_history is never shorter than
+        required: false
+        default: 10
+    archive:
+        description:
+            - Keep what the myscript printed in a compressed archive under archive_dir, indexed by module, script,
+              start time and outcome, so a failed run can be looked at later. The password is redacted.
+            - Look at it on the host with 'python -m keyva_pexpect.archive --dir <archive_dir> list' and
+              'show <archive_id>', with module_utils on the PYTHONPATH
+            - Not done in check mode or for session_pool or targets
+        required: false
+        default: false
+    archive_dir:
+        description:
+            - Directory on the remote host for the archive
+        required: false
+        default: the archive directory under state_dir
+    archive_max_age:
+        description:
+            - Seconds archived sessions are kept, they are removed a whole segment of up to 64MB at a time
+        required: false
+        default: 2592000
+    archive_max_bytes:
+        description:
+            - Most bytes the archive may use, the oldest segments are removed to stay under it
+        required: false
+        default: 1073741824
+    timeline:
+        description:
+            - Return a timeline of every send and expect with the time it took, the pattern matched and the bytes
+              read, grouped into steps like spawn, login, command, save and print_config
+            - Not recorded for session_pool or targets
+        required: false
+        default: false
+    timeline_trace:
+        description:
+            - Also write the timeline to this file on the remote host in Chrome trace format, for chrome://tracing
+              or ui.perfetto.dev. Turns on timeline.
+        required: false
+    profile:
+        description:
+            - Return a summary of the module's own python overhead from cProfile or tracemalloc
+        choices: ['none', 'cprofile', 'tracemalloc']
+        required: false
+        default: none
 
 author:
     - Brad Johnson, Keyva 
@@ -52,6 +264,59 @@ EXAMPLES = '''
       - "set port 7000"
       - "set webport 80"
     timeout: 300
+
+- name: "Push a large config to myprogram without waiting on every prompt"
+  keyva_pexpect_cli:
+    path: "/path/to/myscript.sh"
+    password: "{{ myscript_password }}"
+    commands: "{{ myprogram_config_lines }}"
+    pipeline: 32
+
+- name: "Reuse a logged in myscript session across tasks"
+  keyva_pexpect_cli:
+    path: "/path/to/myscript.sh"
+    password: "{{ myscript_password }}"
+    commands:
+      - "set port 7000"
+    session_pool: true
+
+- name: "Only send settings that differ from the current config"
+  keyva_pexpect_cli:
+    path: "/path/to/myscript.sh"
+    password: "{{ myscript_password }}"
+    commands:
+      - "set minheap 1024m"
+      - "set port 7000"
+    diff_config: true
+
+- name: "Load a config file with hundreds of thousands of settings, carrying on where a failed run stopped"
+  keyva_pexpect_cli:
+    path: "/path/to/myscript.sh"
+    password: "{{ myscript_password }}"
+    commands_file: "/var/tmp/myprogram_config.txt"
+    checkpoint_every: 5000
+    pipeline: 32
+
+- name: "Configure several myprogram instances at once"
+  keyva_pexpect_cli:
+    password: "{{ myscript_password }}"
+    commands:
+      - "set port 7000"
+    targets:
+      - path: "/opt/app1/myscript.sh"
+      - path: "/opt/app2/myscript.sh"
+        options: "-o myoption"
+        commands:
+          - "set port 7001"
+    concurrency: 8
+
+- name: "Find out which prompts a slow run spends its time on"
+  keyva_pexpect_cli:
+    path: "/path/to/myscript.sh"
+    password: "{{ myscript_password }}"
+    commands: "{{ myprogram_config_lines }}"
+    timeline: true
+    timeline_trace: "/tmp/myscript_trace.json"
 '''
 
 RETURN = '''
@@ -61,8 +326,52 @@ current_settings: String containing current settings after last command was run
 logfile: String containing logfile location on the remote host from our script
     type: str
     returned: On success
+config: The current settings parsed into a dict of setting name to value
+    type: dict
+    returned: On success
+commands_to_send: The commands that would change the config, with commands_file only the first 1000
+    type: list
+    returned: In check mode
+commands_to_send_count: How many commands would change the config
+    type: int
+    returned: In check mode with commands_file
+commands_file: path, size, offset reached, commands_sent this run, commands_done including earlier runs,
+               resumed_from, checkpoints and complete once the whole file was sent and saved
+    type: dict
+    returned: When commands_file is set and not in check mode
+logfile_scan: Lines matching logfile_patterns written to the logfile since the last scan, with lines_dropped
+              past the first 200, the start and end offset scanned, bytes read and restarted when the file
+              was scanned from the top again
+    type: dict
+    returned: When logfile_scan is set and the logfile exists
+targets: One result per target in the order given, with path, options, failed and changed, plus
+         current_settings, logfile and config on success, msg on failure and commands_to_send in check mode
+    type: list
+    returned: When targets is given
+transcript: Path of the session transcript written on the remote host
+    type: str
+    returned: When transcript is set
+watchdog: idle_timeout, the step_deadlines taken from step_history and what fired when the watchdog failed
+          a step
+    type: dict
+    returned: When idle_timeout or step_history is set
+archive_id: Id of this session in the archive
+    type: str
+    returned: When archive is set
+timeline: summary with totals per step and the list of send, expect and step events
+    type: dict
+    returned: When timeline or timeline_trace is set
+timeline_trace: Path of the Chrome trace file written on the remote host
+    type: str
+    returned: When timeline_trace is set
+profile: cProfile functions by cumulative time or tracemalloc allocation sites by size
+    type: dict
+    returned: When profile is not none
 '''
 
+# Most commands listed in commands_to_send when they come from a commands_file
+MAX_LISTED_COMMANDS = 1000
+
 
 def main():
     # This is the import required to make this code an Ansible module
@@ -71,18 +380,56 @@ def main():
     # input argument information, it also enforces input types
     module = AnsibleModule(
         argument_spec=dict(
-            path=dict(required=True, type='str'),
+            path=dict(required=False, type='str'),
             commands=dict(required=False, type='list', default=[]),
+            commands_file=dict(required=False, type='path', default=None),
+            checkpoint_every=dict(required=False, type='int', default=1000),
+            resume=dict(required=False, type='bool', default=True),
             options=dict(required=False, type='str', default=""),
-            password=dict(required=True, type='str', no_log=True),
-            timeout=dict(required=False, type='int', default='300')
-        )
+            password=dict(required=False, type='str', no_log=True),
+            timeout=dict(required=False, type='int', default='300'),
+            pipeline=dict(required=False, type='int', default=0),
+            spawn_mode=dict(required=False, type='str', default='direct', choices=['direct', 'shell']),
+            session_pool=dict(required=False, type='bool', default=False),
+            pool_socket=dict(required=False, type='path', default=None),
+            pool_idle_timeout=dict(required=False, type='int', default=300),
+            pool_max_sessions=dict(required=False, type='int', default=8),
+            diff_config=dict(required=False, type='bool', default=False),
+            plan_commands=dict(required=False, type='bool', default=False),
+            dialog=dict(required=False, type='raw', default=None),
+            state_dir=dict(required=False, type='path', default=None),
+            config_cache_max_age=dict(required=False, type='int', default=0),
+            logfile_scan=dict(required=False, type='bool', default=False),
+            logfile_patterns=dict(required=False, type='list', default=None),
+            targets=dict(required=False, type='list', elements='dict', default=None),
+            concurrency=dict(required=False, type='int', default=4),
+            transcript=dict(required=False, type='path', default=None),
+            idle_timeout=dict(required=False, type='int', default=0),
+            step_history=dict(required=False, type='bool', default=False),
+            step_deadline_factor=dict(required=False, type='float', default=3.0),
+            step_deadline_min=dict(required=False, type='float', default=10.0),
+            archive=dict(required=False, type='bool', default=False),
+            archive_dir=dict(required=False, type='path', default=None),
+            archive_max_age=dict(required=False, type='int', default=2592000),
+            archive_max_bytes=dict(required=False, type='int', default=1073741824),
+            timeline=dict(required=False, type='bool', default=False),
+            timeline_trace=dict(required=False, type='path', default=None),
+            profile=dict(required=False, type='str', default='none', choices=['none', 'cprofile', 'tracemalloc'])
+        ),
+        required_one_of=[['path', 'targets']],
+        mutually_exclusive=[['path', 'targets']],
+        supports_check_mode=True
     )
     path = module.params['path']
     commands = module.params['commands']
     options = module.params['options']
     password = module.params['password']
     timeout = module.params['timeout']
+    pipeline = module.params['pipeline']
+    spawn_mode = module.params['spawn_mode']
+    session_pool = module.params['session_pool']
+    diff_config = module.params['diff_config']
+    plan = module.params['plan_commands']
 
     try:
         # Importing the modules here allows us to catch them not being installed on remote hosts
@@ -91,128 +438,407 @@ def main():
     except ImportError:
         module.fail_json(msg="You must have the pexpect python module installed to use this Ansible module.")
 
+    if module.params['commands_file'] is not None:
+        if commands:
+            module.fail_json(msg="commands and commands_file can't be used together")
+        if module.params['targets'] is not None or session_pool or module.params['dialog'] is not None:
+            module.fail_json(msg="commands_file can't be used with targets, session_pool or dialog")
+    if module.params['targets'] is not None:
+        run_targets(module)
+    if password is None:
+        module.fail_json(msg="missing required arguments: password")
+
+    from ansible.module_utils.keyva_pexpect.cli_session import config_deltas, iter_deltas, parse_config, plan_commands
+    from ansible.module_utils.keyva_pexpect.state import state_path, load_json
+    from ansible.module_utils.keyva_pexpect.timeline import Timeline, Profiler, instrumentation
+    trace_path = module.params['timeline_trace']
+    timeline = None
+    if module.params['timeline'] or trace_path:
+        timeline = Timeline()
+    profiler = Profiler(module.params['profile'])
+    watchdog = None
+    if module.params['idle_timeout'] or module.params['step_history']:
+        from ansible.module_utils.keyva_pexpect.watchdog import Watchdog, history_path
+        history = None
+        if module.params['step_history']:
+            history = history_path(module.params['state_dir'], 'keyva_pexpect_cli', path)
+        watchdog = Watchdog(module.params['idle_timeout'], history, module.params['step_deadline_factor'],
+                            module.params['step_deadline_min'])
+    archive = None
+    if module.params['archive'] and not module.check_mode and not module.params['session_pool']:
+        from ansible.module_utils.keyva_pexpect.archive import ArchiveSession, DEFAULT_ARCHIVE_DIR
+        archive_dir = module.params['archive_dir']
+        if archive_dir is None and module.params['state_dir']:
+            archive_dir = os.path.join(module.params['state_dir'], 'archive')
+        try:
+            archive = ArchiveSession(archive_dir, 'keyva_pexpect_cli', path, redact=[password])
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Error: unable to archive the session in '{0}': {1}".format(
+                archive_dir or DEFAULT_ARCHIVE_DIR, err))
+    dialog = None
+    if module.params['dialog'] is not None:
+        if spawn_mode != 'direct' or session_pool:
+            module.fail_json(msg="dialog needs spawn_mode direct and can't be used with session_pool")
+        from ansible.module_utils.keyva_pexpect.dialog import compile_dialog, load_dialog
+        try:
+            dialog = compile_dialog(load_dialog(module.params['dialog']))
+        except (IOError, OSError, ImportError, ValueError) as err:
+            module.fail_json(msg="Invalid dialog: {0}".format(err))
+    command_file = None
+    if module.params['commands_file'] is not None:
+        from ansible.module_utils.keyva_pexpect.command_file import CommandFile
+        try:
+            command_file = CommandFile(module.params['commands_file'], module.params['state_dir'], path, options,
+                                       module.params['checkpoint_every'], module.params['resume'])
+        except RuntimeError as err:
+            module.fail_json(msg="{0}".format(err))
+    # The last config we read from this script, so check mode can answer without starting it
+    snapshot_path = state_path(module.params['state_dir'], 'cli_config', os.path.abspath(path), options)
+
+    # What the result says about how the run went, on success and failure alike
+    report = functools.partial(instrumentation, timeline, profiler, trace_path, watchdog, archive,
+                               command_file=command_file)
     try:
-        # Run our pexpect function
-        current_settings, changed, logfile = run_pexpect(path, options, commands, password, timeout)
+        if module.check_mode:
+            snapshot = load_json(snapshot_path)
+            max_age = module.params['config_cache_max_age']
+            # Only report a profile when the script was started, a saved snapshot has nothing to profile
+            profiled = None
+            if snapshot is None or (max_age and time.time() - snapshot['time'] > max_age):
+                # No usable snapshot, read the config without sending any commands
+                profiled = profiler
+                with profiler:
+                    current_settings, changed, logfile = run_pexpect(path, options, [], password, timeout,
+                                                                       pipeline, spawn_mode, timeline=timeline,
+                                                                       transcript=module.params['transcript'],
+                                                                       watchdog=watchdog)
+                snapshot = save_snapshot(module, snapshot_path, current_settings, logfile)
+            if command_file is not None:
+                # Stream the file, only the first commands to send are kept for the result
+                commands_to_send = []
+                count = 0
+                for command in iter_deltas(snapshot['config'],
+                                           (command for command, offset in command_file.commands(command_file.offset))):
+                    if count < MAX_LISTED_COMMANDS:
+                        commands_to_send.append(command)
+                    count += 1
+                module.exit_json(changed=bool(count), current_settings=snapshot['current_settings'],
+                                 logfile=snapshot['logfile'], config=snapshot['config'],
+                                 commands_to_send=commands_to_send, commands_to_send_count=count,
+                                 **instrumentation(timeline, profiled, trace_path, watchdog, archive))
+            if plan:
+                commands_to_send = plan_commands(snapshot['config'], commands, diff_config=True)
+            else:
+                commands_to_send = config_deltas(snapshot['config'], commands)
+            module.exit_json(changed=bool(commands_to_send), current_settings=snapshot['current_settings'],
+                             logfile=snapshot['logfile'], config=snapshot['config'],
+                             commands_to_send=commands_to_send,
+                             **instrumentation(timeline, profiled, trace_path, watchdog, archive))
+        try:
+            with profiler:
+                if session_pool:
+                    # Borrow a session that is already logged in from the broker on this host
+                    from ansible.module_utils.keyva_pexpect.session_pool import run_pooled
+                    current_settings, changed, logfile = run_pooled(path, options, commands, password, timeout,
+                                                                    pipeline, module.params['pool_socket'],
+                                                                    module.params['pool_idle_timeout'],
+                                                                    module.params['pool_max_sessions'], diff_config,
+                                                                    plan)
+                else:
+                    # Run our pexpect function
+                    current_settings, changed, logfile = run_pexpect(path, options, commands, password, timeout,
+                                                                       pipeline, spawn_mode, diff_config, timeline,
+                                                                       module.params['transcript'], watchdog=watchdog,
+                                                                       archive=archive, plan=plan, dialog=dialog,
+                                                                       command_file=command_file)
+        except Exception as err:
+            if archive is not None:
+                archive.finish('failed', err, module.params['archive_max_age'], module.params['archive_max_bytes'],
+                               warn=module.warn)
+            raise
+        if archive is not None:
+            archive.finish('ok', None, module.params['archive_max_age'], module.params['archive_max_bytes'],
+                           warn=module.warn)
+        if diff_config or plan:
+            # Those runs read the config anyway, keep it for the next check
+            config = save_snapshot(module, snapshot_path, current_settings, logfile)['config']
+        else:
+            config = parse_config(current_settings)
+        if watchdog is not None and not session_pool:
+            watchdog.save(warn=module.warn)
+        result = dict(changed=changed, current_settings=current_settings, logfile=logfile, config=config)
+        if module.params['logfile_scan'] and logfile:
+            from ansible.module_utils.keyva_pexpect.logscan import scan
+            scanned = scan(module.params['state_dir'], logfile, module.params['logfile_patterns'], warn=module.warn)
+            if scanned is not None:
+                result['logfile_scan'] = scanned
+        if module.params['transcript'] and not session_pool:
+            result['transcript'] = module.params['transcript']
+        result.update(report())
         # Exit on success and pass back objects to ansible, which are available as registered vars
-        module.exit_json(changed=changed, current_settings=current_settings, logfile=logfile)
+        module.exit_json(**result)
     # Use python exception handling to keep all our failure handling in our main function
     except pexpect.TIMEOUT as err:
-        module.fail_json(msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: {0}".format(err))
+        module.fail_json(msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: {0}".format(err),
+                         **report())
     except pexpect.EOF as err:
-        module.fail_json(msg="pexpect.EOF: Unexpected program termination: {0}".format(err))
+        module.fail_json(msg="pexpect.EOF: Unexpected program termination: {0}".format(err),
+                         **report())
     except pexpect.exceptions.ExceptionPexpect as err:
         # This catches any pexpect exceptions that are not EOF or TIMEOUT
         # This is the base exception class
-        module.fail_json(msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err))
+        module.fail_json(msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err),
+                         **report())
     except RuntimeError as err:
-        module.fail_json(msg="{0}".format(err))
+        module.fail_json(msg="{0}".format(err),
+                         **report())
+
 
+def run_targets(module):
+    """
+    Configure every target on one asyncio event loop and exit the module with a result per target
+    """
+    if sys.version_info.major == 2:
+        module.fail_json(msg="targets needs python 3 on the remote host")
+    import asyncio
+    from ansible.module_utils.keyva_pexpect import cli_async
+    from ansible.module_utils.keyva_pexpect.cli_session import config_deltas, plan_commands
+    from ansible.module_utils.keyva_pexpect.state import state_path, load_json
 
-def run_pexpect(script_path, options, commands, password, timeout=300):
+    targets = []
+    for target in module.params['targets']:
+        if not target.get('path'):
+            module.fail_json(msg="every target needs a path")
+        password = target.get('password', module.params['password'])
+        if password is None:
+            module.fail_json(msg="no password for target {0}".format(target['path']))
+        targets.append(dict(path=target['path'], options=target.get('options', module.params['options']),
+                            commands=target.get('commands', module.params['commands']), password=password,
+                            timeout=int(target.get('timeout', module.params['timeout'])),
+                            pipeline=module.params['pipeline'], diff_config=module.params['diff_config'],
+                            plan=module.params['plan_commands']))
+    snapshot_paths = [state_path(module.params['state_dir'], 'cli_config', os.path.abspath(target['path']),
+                                 target['options']) for target in targets]
+
+    if module.check_mode:
+        # Same as a single path, only the targets without a usable snapshot are started to read their config
+        max_age = module.params['config_cache_max_age']
+        snapshots = [load_json(snapshot_path) for snapshot_path in snapshot_paths]
+        to_read = [n for n, snapshot in enumerate(snapshots)
+                   if snapshot is None or (max_age and time.time() - snapshot['time'] > max_age)]
+        read_only = [dict(targets[n], commands=[], diff_config=False, plan=False) for n in to_read]
+        loop = asyncio.new_event_loop()
+        try:
+            read = loop.run_until_complete(cli_async.run_targets(read_only, module.params['concurrency']))
+        finally:
+            loop.close()
+        results = [dict(path=target['path'], options=target['options'], failed=False) for target in targets]
+        for n, result in zip(to_read, read):
+            if result['failed']:
+                results[n] = result
+                snapshots[n] = None
+            else:
+                snapshots[n] = save_snapshot(module, snapshot_paths[n], result['current_settings'], result['logfile'])
+        for target, result, snapshot in zip(targets, results, snapshots):
+            if snapshot is not None:
+                if target['plan']:
+                    commands_to_send = plan_commands(snapshot['config'], target['commands'], diff_config=True)
+                else:
+                    commands_to_send = config_deltas(snapshot['config'], target['commands'])
+                result.update(current_settings=snapshot['current_settings'], logfile=snapshot['logfile'],
+                              config=snapshot['config'], commands_to_send=commands_to_send)
+                result['changed'] = bool(result['commands_to_send'])
+    else:
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(cli_async.run_targets(targets, module.params['concurrency']))
+        finally:
+            loop.close()
+        for snapshot_path, result in zip(snapshot_paths, results):
+            if not result['failed'] and (module.params['diff_config'] or module.params['plan_commands']):
+                save_snapshot(module, snapshot_path, result['current_settings'], result['logfile'])
+
+    changed = any(result.get('changed') for result in results)
+    failed = [result for result in results if result['failed']]
+    if failed:
+        module.fail_json(msg="{0} of {1} targets failed: {2}".format(len(failed), len(results), failed[0]['msg']),
+                         changed=changed, targets=results)
+    module.exit_json(changed=changed, targets=results)
+
+
+def save_snapshot(module, snapshot_path, current_settings, logfile):
+    """
+    Save the config we just read so the next check mode run can use it. The run already did its work, so when
+    the snapshot can't be written that is only a warning.
+    """
+    from ansible.module_utils.keyva_pexpect.cli_session import parse_config
+    from ansible.module_utils.keyva_pexpect.state import save_json
+    snapshot = dict(time=time.time(), current_settings=current_settings, logfile=logfile,
+                    config=parse_config(current_settings))
+    try:
+        save_json(snapshot_path, snapshot)
+    except (IOError, OSError) as err:
+        module.warn("Unable to save the config snapshot '{0}', the next check reads the config again: {1}".format(
+            snapshot_path, err))
+    return snapshot
+
+
+def run_pexpect(script_path, options, commands, password, timeout=300, pipeline=0, spawn_mode='direct',
+                diff_config=False, timeline=None, transcript=None, spawn=None, watchdog=None, archive=None,
+                plan=False, dialog=None, command_file=None):
+    """
+    timeline is an optional Timeline that records every send and expect of the session
+    transcript is an optional path the session is recorded to
+    spawn is an optional callable used in place of pexpect.spawn, e.g. a transcript replayer
+    watchdog is an optional Watchdog that fails a step early when myscript stops answering
+    archive is an optional ArchiveSession the output of myscript is streamed to
+    plan sends the commands planned from the config read first, see cli_session.plan_commands()
+    dialog is an optional compiled keyva_pexpect.dialog.Dialog that runs the session instead of cli_session
+    command_file is an optional CommandFile sent in place of commands, see cli_session.run_command_file()
+    """
     import pexpect
-    changed = True
+    from ansible.module_utils.keyva_pexpect.cli_session import (login, start_config, run_session, run_command_file,
+                                                                exit_session)
+    from ansible.module_utils.keyva_pexpect.timeline import step
     if not os.path.exists(script_path):
         raise RuntimeError("Error: the script '{0}' does not exist!".format(script_path))
+    if spawn_mode == 'shell':
+        return run_pexpect_shell(script_path, options, commands, password, timeout, pipeline, diff_config, timeline,
+                                 transcript, spawn, watchdog, archive, plan, command_file)
+
+    # Run our script directly, no shell to start, no prompt to set and no 'echo $?' round trip at the end
+    spawn_start = time.time()
+    if spawn is None:
+        spawn = pexpect.spawn
+    if sys.version_info.major == 2:
+        child = spawn(script_path, args=shlex.split(options))
+    else:
+        child = spawn(script_path, args=shlex.split(options), encoding='utf-8')
+    if timeline is not None:
+        timeline.attach(child, spawn_start)
+    if watchdog is not None:
+        watchdog.attach(child)
+    if archive is not None:
+        archive.attach(child)
+    if transcript is not None:
+        from ansible.module_utils.keyva_pexpect.transcript import Recorder
+        Recorder(transcript, redact=[password]).attach(child)
+    if dialog is not None:
+        return run_dialog_session(child, dialog, commands, password, timeout)
+    try:
+        # Get past the logfile banner and password prompt
+        logfile = login(child, password)
+        # NOTE: Always use a timeout with automation, a huge timeout is better than not catching something stuck
+        child.timeout = timeout
+        try:
+            start_config(child)
+            # Run the commands, save them and read back the current config
+            if command_file is not None:
+                current_settings, changed = run_command_file(child, command_file, pipeline)
+            else:
+                current_settings, changed = run_session(child, commands, pipeline, diff_config, plan)
+            # Run the 'exit' command that is inside myscript and wait for it to go away
+            exit_session(child)
+        except pexpect.TIMEOUT as err:
+            # The first line says whether it was the timeout or the watchdog
+            raise RuntimeError("ERROR: timed out waiting for a prompt in myscript: {0}".format(
+                str(err).splitlines()[0]))
+    finally:
+        # Always try to close the pexpect process, this also collects its exit status
+        with step(child, 'close'):
+            child.close()
+    if child.exitstatus != 0:
+        raise RuntimeError("ERROR: The command returned a non-zero exit code! '{0}'".format(
+            child.exitstatus if child.exitstatus is not None else "signal {0}".format(child.signalstatus)))
+    return current_settings, changed, logfile
+
+
+def run_dialog_session(child, dialog, commands, password, timeout):
+    """
+    Run a whole session with myscript from a dialog given as data, from the logfile banner to exit
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.timeline import step
+    try:
+        variables = dialog.run(child, dict(password=password, timeout=timeout, commands=list(commands), changed=True))
+    except pexpect.TIMEOUT as err:
+        # The first line says whether it was the timeout or the watchdog
+        raise RuntimeError("ERROR: timed out waiting for a prompt in myscript: {0}".format(str(err).splitlines()[0]))
+    finally:
+        with step(child, 'close'):
+            child.close()
+    if child.exitstatus != 0:
+        raise RuntimeError("ERROR: The command returned a non-zero exit code! '{0}'".format(
+            child.exitstatus if child.exitstatus is not None else "signal {0}".format(child.signalstatus)))
+    return (variables.get('current_settings') or '').strip(), variables.get('changed', True), variables.get('logfile')
+
+
+def run_pexpect_shell(script_path, options, commands, password, timeout=300, pipeline=0, diff_config=False,
+                      timeline=None, transcript=None, spawn=None, watchdog=None, archive=None, plan=False,
+                      command_file=None):
+    """
+    Run our script from an interactive bash shell, useful when the script needs a login shell environment
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.cli_session import login, start_config, run_session, run_command_file
+    from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+    from ansible.module_utils.keyva_pexpect.timeline import step
 
     # This is what we set the prompt to so we can recognize bash prompts
     prompt = r'\[PEXPECT\]\$'
     # Here's another example of a prompt for RHEL if you didn't want to set it
     # prompt = r'\[{0}\@.+?\]\$'.format(getpass.getuser())
+    shell_prompt = PatternMatcher([prompt])
+    shell_prompt_or_eof = PatternMatcher([prompt, pexpect.EOF])
 
     # Note that the bash shell outputs in utf-8 in RHEL/CentOS 8, unlike a simple script
     # Using encoding will automatically encode/decode as needed
+    spawn_start = time.time()
+    if spawn is None:
+        spawn = pexpect.spawn
     if sys.version_info.major == "2":
-        child = pexpect.spawn('/bin/bash')
+        child = spawn('/bin/bash')
     else:
-        child = pexpect.spawn('/bin/bash', encoding='utf-8')
+        child = spawn('/bin/bash', encoding='utf-8')
+    if timeline is not None:
+        timeline.attach(child, spawn_start)
+    if watchdog is not None:
+        watchdog.attach(child)
+    if archive is not None:
+        archive.attach(child)
+    if transcript is not None:
+        from ansible.module_utils.keyva_pexpect.transcript import Recorder
+        Recorder(transcript, redact=[password]).attach(child)
     try:
         # Set our prompt so we recognize it
         child.sendline(r"PS1=[PEXPECT]\$")
         # Look for initial bash prompt
-        child.expect(prompt)
+        expect(child, shell_prompt)
         # Start our program
         child.sendline("{0} {1}".format(script_path, options))
-        # look for our scripts logfile prompt
-        # Example text seen in output: 'Logfile: /path/to/mylog.log'
-        child.expect(r'Logfile\:.+?/.+?\.log')
-        # Note that child.after contains the text of the matching regex
-        logfile = child.after.split()[1]
-        # Look for password prompt
-        i = child.expect([r"Enter password\:", '>'])
-        if i == 0:
-            # Send password
-            child.sendline(password)
+        # Get past the logfile banner and password prompt
+        logfile = login(child, password)
         # Increase timeout for longer running interactions after quick initial ones
         # NOTE: Always use a timeout with automation, a huge timeout is better than not catching something stuck
         child.timeout = timeout
         try:
-            # Look for program internal prompt or new config dialog
-            i = child.expect([r'Initialize New Config\?', '>'])
-            # pexpect will return the index of the regex it found first
-            if i == 0:
-                # Answer 'y' to initialize new config prompt
-                child.sendline('y')
-                child.expect('>')
-            # If any commands were passed in loop over them and run them one by one.
-            for command in commands:
-                child.sendline(command)
-                i = child.expect([r'ERROR.+?does not exist', r'ERROR.+?$', '>'])
-                if i == 0:
-                    # Attempt to intelligently add items that may have multiple instances and are missing
-                    # e.g. "socket.2" may need "add socket" run before it.
-                    # Try to allow the user just to use the set command and run add as needed
-                    try:
-                        new_item = child.after.split('"')[1].split('.')[0]
-                    except IndexError:
-                        raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
-                                           " file a bug\n  {0}".format(child.after))
-                    child.sendline('add {0}'.format(new_item))
-                    i = child.expect([r'ERROR.+?$', '>'])
-                    if i == 0:
-                        raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
-                                           " file a bug\n  {0}".format(child.after.strip()))
-                    # Retry the failed original command after the add
-                    child.sendline(command)
-                    i = child.expect([r'ERROR.+?$', '>'])
-                    if i == 0:
-                        raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
-                                           " file a bug\n  {0}".format(child.after.strip()))
-                elif i == 1:
-                    raise RuntimeError("ERROR: unspecified error running a myscript command\n"
-                                       "  {0}".format(child.after.strip()))
-            # Set timeout shorter for final commands
-            child.timeout = 15
-            # If we processed any commands run the save function last
-            if commands:
-                child.sendline('save')
-                # Using true loops with expect statements allow us to process multiple items in a block until
-                #    some kind of done or exit condition is met where we then call a break.
-                while True:
-                    i = child.expect([r'No changes made', r'ERROR.+?$', '>'])
-                    if i == 0:
-                        changed = False
-                    elif i == 1:
-                        raise RuntimeError("ERROR: unexpected error saving configuration\n"
-                                           "  {0}".format(child.after.strip()))
-                    elif i == 2:
-                        break
-            # Always print out the config data from out script and return it to the user
-            child.sendline('print config')
-            # Expect our command echo from pexpect
-            child.expect('print config')
-            child.expect('>')
-            # Note that child.before contains the output between the last two expects, up to the character limit
-            current_settings = child.before.strip()
+            start_config(child)
+            # Run the commands, save them and read back the current config
+            if command_file is not None:
+                current_settings, changed = run_command_file(child, command_file, pipeline)
+            else:
+                current_settings, changed = run_session(child, commands, pipeline, diff_config, plan)
             # Run the 'exit' command that is inside myscript
             child.sendline('exit')
             # Look for a linux prompt to see if we quit
-            child.expect(prompt)
-        except pexpect.TIMEOUT:
-            raise RuntimeError("ERROR: timed out waiting for a prompt in myscript")
+            expect(child, shell_prompt)
+        except pexpect.TIMEOUT as err:
+            # The first line says whether it was the timeout or the watchdog
+            raise RuntimeError("ERROR: timed out waiting for a prompt in myscript: {0}".format(
+                str(err).splitlines()[0]))
         # Get shell/bash return code of myscript
         child.sendline("echo $?")
-        child.expect(prompt)
+        expect(child, shell_prompt)
         # process the output into a variable and remove any whitespace
         exit_status = child.before.split('\r\n')[1].strip()
         if exit_status != "0":
@@ -222,14 +848,15 @@ def run_pexpect(script_path, options, commands, password, timeout=300):
         # run exit as many times as needed to exit the shell or subshells
         # This might be useful if you ran a script that put you into a new shell where you then ran some other scripts
         while True:
-            i = child.expect([prompt, pexpect.EOF])
+            i = expect(child, shell_prompt_or_eof)
             if i == 0:
                 child.sendline('exit 0')
             elif i == 1:
                 break
     finally:
         # Always try to close the pexpect process
-        child.close()
+        with step(child, 'close'):
+            child.close()
     return current_settings, changed, logfile
 
 
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
+import functools
 import os
 import tempfile
+import time
 
 DOCUMENTATION = '''
 ---
@@ -15,11 +17,13 @@ options:
     path:
         description:
             - Path to the script to run
-        required: true
+            - Required unless installers is given
+        required: false
     password:
         description:
             - Password needed to run demo script
-        required: true
+            - With installers this is the password for every installer that does not set its own
+        required: false
     timeout:
         description:
             - Timeout for running the script
@@ -30,6 +34,214 @@ options:
             - Run a failure test scenario
         choices: ['password', 'timeout', 'error_abort', 'die_early']
         required: false
+    password_check:
+        description:
+            - How to find out that the program rejected our password, it just exits without saying so
+            - event treats the program exiting with status 0 before it printed anything we look for as a rejected
+              password, there is no extra wait. Exiting with another status or on a signal at that point fails
+              the task with that status instead of calling it a bad password.
+            - probe waits 2 seconds for the program to exit after the password is sent and treats any exit as a
+              rejected password. This was the only behavior before event was added, and it is still the one to use
+              for a program that can exit 0 right after a good password.
+        choices: ['event', 'probe']
+        required: false
+        default: event
+    fingerprint:
+        description:
+            - After a successful install record a fingerprint of the installer, these parameters and the markers
+              files, and skip running the installer while it still matches
+            - The fingerprint no longer matches when the installer file changes, a marker file is removed or
+              modified, or the parameters change
+            - A fingerprint that can't be saved is a warning, the installer then runs again next time
+        required: false
+        default: false
+    markers:
+        description:
+            - Files the installer leaves behind when it succeeds, required with fingerprint
+            - e.g. /tmp/pexpect_mock_demo for mock_install.sh
+        required: false
+    force:
+        description:
+            - Run the installer even when the fingerprint matches, the fingerprint is recorded again afterwards
+        required: false
+        default: false
+    fingerprint_max_age:
+        description:
+            - Seconds after which a recorded fingerprint is ignored and the installer runs again, 0 means never
+        required: false
+        default: 0
+    state_dir:
+        description:
+            - Directory on the remote host where fingerprints and logfile offsets are kept
+        required: false
+        default: ~/.ansible/keyva_pexpect
+    output_capture:
+        description:
+            - How much of the program output to keep and return in script_output
+            - full keeps everything in a temp file and returns all of it
+            - bounded keeps only the first output_head_bytes and last output_tail_bytes plus the lines matching
+              capture_patterns, so memory use and the result size stay the same however much the program prints
+        choices: ['full', 'bounded']
+        required: false
+        default: full
+    output_head_bytes:
+        description:
+            - Bytes from the start of the output to keep in bounded mode
+        required: false
+        default: 65536
+    output_tail_bytes:
+        description:
+            - Bytes from the end of the output to keep in bounded mode
+        required: false
+        default: 65536
+    capture_patterns:
+        description:
+            - Regexes for the output lines returned in output_lines in bounded mode
+        required: false
+        default: ['ERROR', '(?i)warn', '(?i)log ?file:']
+    output_spool:
+        description:
+            - Path on the remote host to write the full output to as a gzip file in bounded mode
+        required: false
+    logfile_scan:
+        description:
+            - Scan the logfile the installer reports for lines matching logfile_patterns and return them
+            - Only the part written since the last scan is read, the offset reached is kept under state_dir.
+              The whole file is read again when it was replaced, truncated or rewritten.
+        required: false
+        default: false
+    logfile_patterns:
+        description:
+            - Regexes for the logfile lines returned by logfile_scan
+        required: false
+        default: ['ERROR', '(?i)warn']
+    dialog:
+        description:
+            - Drive the installer with a dialog written as data instead of the built-in one, a dict of states with
+              the patterns to wait for, what to send and which state comes next, see keyva_pexpect.dialog
+            - Either the dialog itself, the path of a JSON or YAML file on the remote host holding it, or install
+              for the built-in dialog written that way
+            - The dialog is started with the variables password, timeout and abort_on_errors. The module reads
+              logfile, errors, changed and failed from the variables it ends with, or output when the installer
+              said it was already installed.
+        required: false
+    buffer_engine:
+        description:
+            - How the output is buffered while we wait for the next prompt
+            - default is the plain pexpect spawn, fine for programs that print little
+            - ring keeps the output since the last prompt in one capped buffer and only searches the new part,
+              so time and memory stay flat for installers that print gigabytes. child.before then holds at most
+              the last 1MB before a prompt, use output_capture to keep the output itself.
+        choices: ['default', 'ring']
+        required: false
+        default: default
+    transcript:
+        description:
+            - Record the session with the installer to this file on the remote host, gzipped when it ends in .gz
+            - The password is redacted. The file can be replayed with keyva_pexpect.transcript to test changes to
+              the dialog without running the installer.
+        required: false
+    idle_timeout:
+        description:
+            - Fail when the installer prints nothing for this many seconds, counted from its last output or the last
+              thing we sent, instead of waiting for timeout. 0 turns it off.
+        required: false
+        default: 0
+    step_history:
+        description:
+            - Keep how long each step took on successful runs under state_dir and fail a step that takes much
+              longer than it used to, once it has 5 runs of history
+            - A step past its deadline still finishes while it keeps printing, it fails after 5 seconds without
+              output
+        required: false
+        default: false
+    step_deadline_factor:
+        description:
+            - The deadline of a step is the p99 of its earlier times multiplied by this
+        required: false
+        default: 3
+    step_deadline_min:
+        description:
+            - Seconds a step deadline from step_history is never shorter than
+        required: false
+        default: 10
+    archive:
+        description:
+            - Keep what the installer printed in a compressed archive under archive_dir, indexed by module, script,
+              start time and outcome, so a failed run can be looked at later. The password is redacted.
+            - Look at it on the host with 'python -m keyva_pexpect.archive --dir <archive_dir> list' and
+              'show <archive_id>', with module_utils on the PYTHONPATH
+        required: false
+        default: false
+    archive_dir:
+        description:
+            - Directory on the remote host for the archive
+        required: false
+        default: the archive directory under state_dir
+    archive_max_age:
+        description:
+            - Seconds archived sessions are kept, they are removed a whole segment of up to 64MB at a time
+        required: false
+        default: 2592000
+    archive_max_bytes:
+        description:
+            - Most bytes the archive may use, the oldest segments are removed to stay under it
+        required: false
+        default: 1073741824
+    progress:
+        description:
+            - Append a line of JSON to this file or FIFO on the remote host for every prompt matched, response
+              sent, error line seen and step started, and every progress_interval seconds the number of bytes
+              the installer printed so far, while it runs
+            - Many tasks can share one file, every line has the session id, which is the archive_id when archive
+              is set. Sent text is never written, only its length, and the password is redacted.
+            - A FIFO only gets events while something reads it, events that don't fit are dropped rather than
+              holding up the installer
+            - Follow it on the host with 'python -m keyva_pexpect.progress --follow <progress>', or --status for
+              one line per session, with module_utils on the PYTHONPATH
+        required: false
+    progress_interval:
+        description:
+            - Seconds between writes to the progress stream while nothing urgent happens, events in between are
+              written together
+        required: false
+        default: 1
+    installers:
+        description:
+            - Several installers to run in one task instead of path, each a dict with path and optionally name,
+              password, timeout, mock_failure and depends_on, which default to the module options of the same name.
+              name defaults to path.
+            - depends_on is a list of names of other installers that have to finish successfully first. Installers
+              that don't depend on each other run at the same time, each in a process of its own, so the task
+              takes about as long as the slowest chain of dependencies instead of the sum of all installs.
+            - An installer that fails does not stop the others, but everything that depends on it is not started
+              and reported as skipped. The task fails after all of them finished.
+            - password_check, buffer_engine, dialog, output_capture and progress apply to every installer.
+              fingerprint, output_spool, logfile_scan, transcript, idle_timeout, step_history, archive, timeline
+              and profile are not used for installers.
+        required: false
+    concurrency:
+        description:
+            - Most installers running at the same time
+        required: false
+        default: 4
+    timeline:
+        description:
+            - Return a timeline of every send and expect with the time it took, the pattern matched and the bytes
+              read, grouped into the steps spawn, password, install and close
+        required: false
+        default: false
+    timeline_trace:
+        description:
+            - Also write the timeline to this file on the remote host in Chrome trace format, for chrome://tracing
+              or ui.perfetto.dev. Turns on timeline.
+        required: false
+    profile:
+        description:
+            - Return a summary of the module's own python overhead from cProfile or tracemalloc
+        choices: ['none', 'cprofile', 'tracemalloc']
+        required: false
+        default: none
     
 author:
     - Brad Johnson, Keyva 
@@ -43,6 +255,72 @@ EXAMPLES = '''
     path: "mock.sh"
     password: "{{ pexpect_demo_password }}"
     timeout: 60
+
+- name: "Run a very chatty installer and only keep the interesting parts of its output"
+  keyva_pexpect_install:
+    path: "/path/to/vendor_installer.bin"
+    password: "{{ installer_password }}"
+    timeout: 3600
+    output_capture: bounded
+    output_spool: "/var/tmp/vendor_installer.log.gz"
+    buffer_engine: ring
+
+- name: "Only start the installer when it has not already been run on this host"
+  keyva_pexpect_install:
+    path: "mock.sh"
+    password: "{{ pexpect_demo_password }}"
+    fingerprint: true
+    markers:
+      - /tmp/pexpect_mock_demo
+
+- name: "Watch installs on this host while they run, with 'python -m keyva_pexpect.progress -f' on the host"
+  keyva_pexpect_install:
+    path: "/path/to/vendor_installer.bin"
+    password: "{{ installer_password }}"
+    timeout: 3600
+    progress: "/var/tmp/keyva_installs.jsonl"
+
+- name: "Answer the prompts of a different installer without changing the module"
+  keyva_pexpect_install:
+    path: "/path/to/other_installer.bin"
+    password: "{{ installer_password }}"
+    dialog:
+      start: password
+      states:
+        password:
+          timeout: 10
+          step: password
+          expect:
+            - {pattern: "Password:", send: "{password}", next: license}
+        license:
+          timeout: timeout
+          step: install
+          expect:
+            - {pattern: 'Accept the license\\? \\[y/n\\]', send: y}
+            - {pattern: 'Installed to \\S+', capture: logfile, word: -1}
+            - {pattern: 'ERROR:.+?\\r\\n', append: errors, error: true}
+            - {eof: true, end: true}
+
+- name: "Install the vendor components of a host at the same time, the agent only once the runtime is in"
+  keyva_pexpect_install:
+    password: "{{ installer_password }}"
+    timeout: 3600
+    installers:
+      - name: runtime
+        path: "/path/to/runtime_installer.bin"
+      - name: database
+        path: "/path/to/db_installer.bin"
+        password: "{{ db_installer_password }}"
+      - name: agent
+        path: "/path/to/agent_installer.bin"
+        depends_on: [runtime]
+    concurrency: 2
+
+- name: "Return only the errors and warnings this run added to the installer's daily logfile"
+  keyva_pexpect_install:
+    path: "mock.sh"
+    password: "{{ pexpect_demo_password }}"
+    logfile_scan: true
 '''
 
 RETURN = '''
@@ -52,6 +330,55 @@ output: String containing output from script
 logfile: String containing logfile location on the remote host from our script
     type: str
     returned: On success
+output_lines: Output lines that matched capture_patterns
+    type: list
+    returned: When output_capture is bounded
+output_bytes: Total number of bytes the program printed
+    type: int
+    returned: When output_capture is bounded
+output_spool: Path of the gzip file holding the full output
+    type: str
+    returned: When output_spool is set
+fingerprint_matched: True when the installer was not started because the recorded fingerprint still matches
+    type: bool
+    returned: When fingerprint is set
+logfile_scan: Lines matching logfile_patterns written to the logfile since the last scan, with lines_dropped
+              past the first 200, the start and end offset scanned, bytes read and restarted when the file
+              was scanned from the top again
+    type: dict
+    returned: When logfile_scan is set and the logfile exists
+transcript: Path of the session transcript written on the remote host
+    type: str
+    returned: When transcript is set
+watchdog: idle_timeout, the step_deadlines taken from step_history and what fired when the watchdog failed
+          a step
+    type: dict
+    returned: When idle_timeout or step_history is set
+archive_id: Id of this session in the archive
+    type: str
+    returned: When archive is set
+progress: path of the progress stream, the session id used in it, the number of events and how many were
+          dropped because a FIFO reader could not keep up
+    type: dict
+    returned: When progress is set
+timeline: summary with totals per step and the list of send, expect and step events
+    type: dict
+    returned: When timeline or timeline_trace is set
+timeline_trace: Path of the Chrome trace file written on the remote host
+    type: str
+    returned: When timeline_trace is set
+installers: One result per installer in the order given, with name, path, failed, changed, start_s and
+            duration_s, plus script_output, logfile, return_code and errors_found when it ran, msg on failure
+            and skipped when it was not started because an installer it depends on failed
+    type: list
+    returned: When installers is given
+schedule: elapsed_s of the whole batch, serial_s the installs would have taken one after the other, and the
+          critical_path, the chain of dependencies with the longest total duration, with its critical_path_s
+    type: dict
+    returned: When installers is given
+profile: cProfile functions by cumulative time or tracemalloc allocation sites by size
+    type: dict
+    returned: When profile is not none
 '''
 
 
@@ -62,17 +389,52 @@ def main():
     # input argument information, it also enforces input types
     module = AnsibleModule(
         argument_spec=dict(
-            path=dict(required=True, type='str'),
-            password=dict(required=True, type='str', no_log=True),
+            path=dict(required=False, type='str'),
+            password=dict(required=False, type='str', no_log=True),
             timeout=dict(required=False, type='int', default='60'),
             mock_failure=dict(required=False, type='str', default=None,
-                              choices=['password', 'timeout', 'error_abort', 'die_early'])
-        )
+                              choices=['password', 'timeout', 'error_abort', 'die_early']),
+            password_check=dict(required=False, type='str', default='event', choices=['event', 'probe']),
+            output_capture=dict(required=False, type='str', default='full', choices=['full', 'bounded']),
+            output_head_bytes=dict(required=False, type='int', default=65536),
+            output_tail_bytes=dict(required=False, type='int', default=65536),
+            capture_patterns=dict(required=False, type='list', default=None),
+            output_spool=dict(required=False, type='path', default=None),
+            fingerprint=dict(required=False, type='bool', default=False),
+            markers=dict(required=False, type='list', default=[]),
+            force=dict(required=False, type='bool', default=False),
+            fingerprint_max_age=dict(required=False, type='int', default=0),
+            state_dir=dict(required=False, type='path', default=None),
+            logfile_scan=dict(required=False, type='bool', default=False),
+            logfile_patterns=dict(required=False, type='list', default=None),
+            dialog=dict(required=False, type='raw', default=None),
+            buffer_engine=dict(required=False, type='str', default='default', choices=['default', 'ring']),
+            transcript=dict(required=False, type='path', default=None),
+            idle_timeout=dict(required=False, type='int', default=0),
+            step_history=dict(required=False, type='bool', default=False),
+            step_deadline_factor=dict(required=False, type='float', default=3.0),
+            step_deadline_min=dict(required=False, type='float', default=10.0),
+            archive=dict(required=False, type='bool', default=False),
+            archive_dir=dict(required=False, type='path', default=None),
+            archive_max_age=dict(required=False, type='int', default=2592000),
+            archive_max_bytes=dict(required=False, type='int', default=1073741824),
+            progress=dict(required=False, type='path', default=None),
+            progress_interval=dict(required=False, type='float', default=1.0),
+            installers=dict(required=False, type='list', elements='dict', default=None),
+            concurrency=dict(required=False, type='int', default=4),
+            timeline=dict(required=False, type='bool', default=False),
+            timeline_trace=dict(required=False, type='path', default=None),
+            profile=dict(required=False, type='str', default='none', choices=['none', 'cprofile', 'tracemalloc'])
+        ),
+        required_if=[('fingerprint', True, ['markers'])],
+        required_one_of=[['path', 'installers']],
+        mutually_exclusive=[['path', 'installers']]
     )
     path = module.params['path']
     password = module.params['password']
     timeout = module.params['timeout']
     mock_failure = module.params['mock_failure']
+    password_check = module.params['password_check']
 
     try:
         # Importing the modules here allows us to catch them not being installed on remote hosts
@@ -81,47 +443,292 @@ def main():
     except ImportError:
         module.fail_json(msg="You must have the pexpect python module installed to use this Ansible module.")
 
+    if module.params['installers'] is not None:
+        run_installers(module)
+    if password is None:
+        module.fail_json(msg="missing required arguments: password")
+
+    capture = None
+    if module.params['output_capture'] == 'bounded':
+        from ansible.module_utils.keyva_pexpect.capture import BoundedCapture
+        try:
+            capture = BoundedCapture(module.params['output_head_bytes'], module.params['output_tail_bytes'],
+                                     module.params['capture_patterns'], spool_path=module.params['output_spool'],
+                                     redact=[password])
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Error: unable to open the output spool '{0}': {1}".format(
+                module.params['output_spool'], err))
+
+    from ansible.module_utils.keyva_pexpect.timeline import Timeline, Profiler, instrumentation
+    trace_path = module.params['timeline_trace']
+    timeline = None
+    if module.params['timeline'] or trace_path:
+        timeline = Timeline()
+    profiler = Profiler(module.params['profile'])
+    watchdog = None
+    if module.params['idle_timeout'] or module.params['step_history']:
+        from ansible.module_utils.keyva_pexpect.watchdog import Watchdog, history_path
+        history = None
+        if module.params['step_history']:
+            history = history_path(module.params['state_dir'], 'keyva_pexpect_install', path)
+        watchdog = Watchdog(module.params['idle_timeout'], history, module.params['step_deadline_factor'],
+                            module.params['step_deadline_min'])
+
+    dialog = None
+    if module.params['dialog'] is not None:
+        from ansible.module_utils.keyva_pexpect.dialog import compile_dialog, load_dialog
+        try:
+            dialog = compile_dialog(load_dialog(module.params['dialog']))
+        except (IOError, OSError, ImportError, ValueError) as err:
+            module.fail_json(msg="Invalid dialog: {0}".format(err))
+
+    state_dir = module.params['state_dir']
+    use_fingerprint = module.params['fingerprint']
+    if use_fingerprint:
+        from ansible.module_utils.keyva_pexpect import fingerprint
+        markers = module.params['markers']
+        # Everything here changes what the installer does, the password and timeout do not
+        fingerprint_params = dict(path=os.path.abspath(path), mock_failure=mock_failure,
+                                  dialog=module.params['dialog'])
+        if not module.params['force']:
+            record = fingerprint.check(state_dir, path, fingerprint_params, markers,
+                                       module.params['fingerprint_max_age'])
+            if record is not None:
+                # Already installed and nothing changed since, don't even start the installer
+                result = dict(changed=False, script_output="", logfile=record['result']['logfile'],
+                              return_code=record['result']['return_code'], errors_found=[],
+                              fingerprint_matched=True)
+                result.update(scan_logfile(module, state_dir, result['logfile']))
+                module.exit_json(**result)
+
+    archive = None
+    if module.params['archive']:
+        from ansible.module_utils.keyva_pexpect.archive import ArchiveSession, DEFAULT_ARCHIVE_DIR
+        archive_dir = module.params['archive_dir']
+        if archive_dir is None and state_dir:
+            archive_dir = os.path.join(state_dir, 'archive')
+        try:
+            archive = ArchiveSession(archive_dir, 'keyva_pexpect_install', path, redact=[password])
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Error: unable to archive the session in '{0}': {1}".format(
+                archive_dir or DEFAULT_ARCHIVE_DIR, err))
+    progress = None
+    if module.params['progress']:
+        from ansible.module_utils.keyva_pexpect.progress import ProgressStream
+        try:
+            progress = ProgressStream(module.params['progress'], 'keyva_pexpect_install', path, redact=[password],
+                                      interval=module.params['progress_interval'],
+                                      session_id=archive.id if archive is not None else None)
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Error: unable to open the progress stream '{0}': {1}".format(
+                module.params['progress'], err))
+
+    # What the result says about how the run went, on success and failure alike
+    report = functools.partial(instrumentation, timeline, profiler, trace_path, watchdog, archive, progress)
     try:
         # Run our pexpect function
-        script_output, install_logfile, changed, child_exitstatus, errors_found = run_pexpect(path, password, timeout, mock_failure)
+        try:
+            with profiler:
+                script_output, install_logfile, changed, child_exitstatus, errors_found = run_pexpect(
+                    path, password, timeout, mock_failure, capture, password_check, timeline,
+                    module.params['buffer_engine'], module.params['transcript'], watchdog=watchdog,
+                    archive=archive, progress=progress, dialog=dialog)
+        except Exception as err:
+            if use_fingerprint:
+                # Whatever we recorded before may no longer be true after a failed run
+                fingerprint.invalidate(state_dir, path)
+            if archive is not None:
+                archive.finish('failed', err, module.params['archive_max_age'], module.params['archive_max_bytes'],
+                               warn=module.warn)
+            if progress is not None:
+                progress.finish('failed', err)
+            raise
+        if archive is not None:
+            archive.finish('ok', None, module.params['archive_max_age'], module.params['archive_max_bytes'],
+                           warn=module.warn)
+        if progress is not None:
+            progress.finish('ok')
+        if use_fingerprint:
+            if isinstance(install_logfile, bytes):
+                install_logfile = install_logfile.decode('utf-8')
+            try:
+                fingerprint.save(state_dir, path, fingerprint_params, markers,
+                                 dict(logfile=install_logfile, return_code=child_exitstatus))
+            except (IOError, OSError) as err:
+                # The install went through, only the next run loses the shortcut
+                fingerprint.invalidate(state_dir, path)
+                module.warn("Unable to save the install fingerprint, the installer runs again next time: {0}".format(
+                    err))
+        if watchdog is not None:
+            watchdog.save(warn=module.warn)
+        result = dict(changed=changed, script_output=script_output,
+                      logfile=install_logfile, return_code=child_exitstatus, errors_found=errors_found)
+        if capture is not None:
+            result.update(output_lines=capture.lines, output_bytes=capture.total)
+            if capture.spool_path:
+                result['output_spool'] = capture.spool_path
+        if use_fingerprint:
+            result['fingerprint_matched'] = False
+        result.update(scan_logfile(module, state_dir, install_logfile))
+        if module.params['transcript']:
+            result['transcript'] = module.params['transcript']
+        result.update(report())
 
         # Exit on success and pass back objects to ansible, which are available as registered vars
-        module.exit_json(changed=changed, script_output=script_output,
-                         logfile=install_logfile, return_code=child_exitstatus, errors_found=errors_found)
+        module.exit_json(**result)
 
     # Use python exception handling to keep all our failure handling in our main function
     except pexpect.TIMEOUT as err:
-        module.fail_json(msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: {0}".format(err))
+        module.fail_json(msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: {0}".format(err),
+                         **report())
 
     except pexpect.EOF as err:
-        module.fail_json(msg="pexpect.EOF: Unexpected program termination: {0}".format(err))
+        module.fail_json(msg="pexpect.EOF: Unexpected program termination: {0}".format(err),
+                         **report())
 
     except pexpect.exceptions.ExceptionPexpect as err:
         # This catches any pexpect exceptions that are not EOF or TIMEOUT
         # This is the base exception class
-        module.fail_json(msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err))
+        module.fail_json(msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err),
+                         **report())
 
     # We use this to exit on failure instead of a sys.exit call.
     except RuntimeError as err:
+        module.fail_json(msg="{0}".format(err),
+                         **report())
+
+
+def run_installers(module):
+    """
+    Run every installer in a process of its own in dependency order and exit the module with a result per installer
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.install_batch import run_batch, schedule_summary
+
+    installers = []
+    for installer in module.params['installers']:
+        if not installer.get('path'):
+            module.fail_json(msg="every installer needs a path")
+        password = installer.get('password', module.params['password'])
+        if password is None:
+            module.fail_json(msg="no password for installer {0}".format(installer['path']))
+        depends_on = installer.get('depends_on') or []
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        installers.append(dict(name='{0}'.format(installer.get('name', installer['path'])), path=installer['path'],
+                               password=password, timeout=int(installer.get('timeout', module.params['timeout'])),
+                               mock_failure=installer.get('mock_failure', module.params['mock_failure']),
+                               depends_on=['{0}'.format(name) for name in depends_on]))
+    dialog = None
+    if module.params['dialog'] is not None:
+        from ansible.module_utils.keyva_pexpect.dialog import compile_dialog, load_dialog
+        try:
+            dialog = compile_dialog(load_dialog(module.params['dialog']))
+        except (IOError, OSError, ImportError, ValueError) as err:
+            module.fail_json(msg="Invalid dialog: {0}".format(err))
+
+    def text(value):
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+    def run(installer):
+        """
+        The same as a task with a single path, in the forked process for this installer
+        """
+        capture = None
+        if module.params['output_capture'] == 'bounded':
+            from ansible.module_utils.keyva_pexpect.capture import BoundedCapture
+            capture = BoundedCapture(module.params['output_head_bytes'], module.params['output_tail_bytes'],
+                                     module.params['capture_patterns'], redact=[installer['password']])
+        progress = None
+        if module.params['progress']:
+            from ansible.module_utils.keyva_pexpect.progress import ProgressStream
+            try:
+                progress = ProgressStream(module.params['progress'], 'keyva_pexpect_install', installer['path'],
+                                          redact=[installer['password']],
+                                          interval=module.params['progress_interval'])
+            except (IOError, OSError) as err:
+                return dict(failed=True, msg="Error: unable to open the progress stream '{0}': {1}".format(
+                    module.params['progress'], err))
+        error = None
+        try:
+            script_output, install_logfile, changed, child_exitstatus, errors_found = run_pexpect(
+                installer['path'], installer['password'], installer['timeout'], installer['mock_failure'], capture,
+                module.params['password_check'], buffer_engine=module.params['buffer_engine'], progress=progress,
+                dialog=dialog)
+        except pexpect.TIMEOUT as err:
+            error = err
+            result = dict(failed=True, msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: "
+                                           "{0}".format(err))
+        except pexpect.EOF as err:
+            error = err
+            result = dict(failed=True, msg="pexpect.EOF: Unexpected program termination: {0}".format(err))
+        except pexpect.exceptions.ExceptionPexpect as err:
+            error = err
+            result = dict(failed=True, msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err))
+        except RuntimeError as err:
+            error = err
+            result = dict(failed=True, msg="{0}".format(err))
+        else:
+            # The result goes back to the module as JSON, the installer output is bytes
+            result = dict(failed=False, changed=changed, script_output=text(script_output),
+                          logfile=text(install_logfile), return_code=child_exitstatus,
+                          errors_found=[text(found) for found in errors_found])
+            if capture is not None:
+                result.update(output_lines=[text(line) for line in capture.lines], output_bytes=capture.total)
+        if progress is not None:
+            progress.finish('failed' if error is not None else 'ok', error)
+            result['progress'] = progress.result()
+        return result
+
+    start = time.time()
+    try:
+        results = run_batch(installers, run, module.params['concurrency'])
+    except ValueError as err:
         module.fail_json(msg="{0}".format(err))
+    schedule = schedule_summary(installers, results, time.time() - start)
+    changed = any(result.get('changed') for result in results)
+    failed = [result for result in results if result['failed']]
+    if failed:
+        module.fail_json(msg="{0} of {1} installers failed: {2}".format(len(failed), len(results), failed[0]['msg']),
+                         changed=changed, installers=results, schedule=schedule)
+    module.exit_json(changed=changed, installers=results, schedule=schedule)
 
 
-def run_pexpect(script_path, password, timeout=60, mock_failure=None):
+def scan_logfile(module, state_dir, logfile):
+    """
+    The logfile_scan result for the logfile the installer reported, empty when it is not wanted or not there
+    """
+    if not module.params['logfile_scan'] or not logfile:
+        return {}
+    from ansible.module_utils.keyva_pexpect.logscan import scan
+    scanned = scan(state_dir, logfile, module.params['logfile_patterns'], warn=module.warn)
+    if scanned is None:
+        return {}
+    return dict(logfile_scan=scanned)
+
+
+def run_pexpect(script_path, password, timeout=60, mock_failure=None, capture=None, password_check='event',
+                timeline=None, buffer_engine='default', transcript=None, spawn=None, watchdog=None,
+                archive=None, progress=None, dialog=None):
     """
     mock_failure can cause intentional failure when set to: 'password', 'timeout', 'error_abort', or 'die_early'
     This variable is for demo purposes only, please remove it if you want to reuse this code.
+    capture is an optional BoundedCapture used as the child logfile instead of a temp file.
+    timeline is an optional Timeline that records every send and expect of the installer.
+    buffer_engine 'ring' uses RingSpawn, which keeps expect fast however much the installer prints.
+    transcript is an optional path the session is recorded to.
+    spawn is an optional callable used in place of pexpect.spawn, e.g. a transcript replayer.
+    watchdog is an optional Watchdog that fails the installer early when it stops printing.
+    archive is an optional ArchiveSession the installer output is streamed to.
+    progress is an optional ProgressStream the prompts, sends and error lines are reported to as they happen.
+    dialog is an optional compiled keyva_pexpect.dialog.Dialog to drive the installer instead of install_dialog().
     """
     import pexpect
+    from ansible.module_utils.keyva_pexpect.timeline import mark
     if not os.path.exists(script_path):
         raise RuntimeError("Error: the script '{0}' does not exist!".format(script_path))
 
-    # Set some default variables
-    changed = True
-    program_failed = False
-    install_logfile = None
-
     # Set some variables for error catch and handling
-    errors_found = []
     if mock_failure == 'error_abort':
         fail_on_errors = True
     else:
@@ -133,77 +740,156 @@ def run_pexpect(script_path, password, timeout=60, mock_failure=None):
 
     # Create a temp log file and start our program
     #   it is automatically deleted after the block exits
-    with tempfile.NamedTemporaryFile() as tmp_output:
+    if capture is None:
+        tmp_output = tempfile.NamedTemporaryFile()
+    else:
+        # Only keep the head, tail and interesting lines of the output
+        tmp_output = capture
+    with tmp_output:
         # Use a try block here so we can always run the close finally statement
         try:
             # Start our program
             # Note that calling a simple script does not need the encoding option
             # A bash shell would need encoding='utf-8'
-            child = pexpect.spawn(script_path)
-            child.logfile = tmp_output
-
-            # If you have a program with TONS of output use these options to deal with it.
-            # child = pexpect.spawn(script_path, maxread=100000000, searchwindowsize=2000)
-
-            # make sure we don't wait long for a password prompt
-            child.timeout = 10
-            # Look for password prompt
-            i = child.expect([r"Please enter your password", r'(?i)software already installed.+?$'])
-            if i == 1:
-                changed = False
-                child.close()
-                return child.after.strip(), None, changed, child.exitstatus, errors_found
-            # Send password
-            if mock_failure == 'password':
-                child.sendline()
+            spawn_start = time.time()
+            if spawn is not None:
+                child = spawn(script_path)
+            elif buffer_engine == 'ring':
+                # For programs with TONS of output, reads are appended in place and only the new output is searched
+                from ansible.module_utils.keyva_pexpect.ring_spawn import RingSpawn
+                child = RingSpawn(script_path)
             else:
-                child.sendline(password)
-            try:
-                child.timeout = 2
-                child.expect(pexpect.EOF)
-            except pexpect.TIMEOUT:
-                pass
+                child = pexpect.spawn(script_path)
+            if timeline is not None:
+                timeline.attach(child, spawn_start)
+            if watchdog is not None:
+                watchdog.attach(child)
+            if archive is not None:
+                archive.attach(child)
+            if progress is not None:
+                progress.attach(child)
+            if transcript is not None:
+                from ansible.module_utils.keyva_pexpect.transcript import Recorder
+                Recorder(transcript, redact=[password]).attach(child)
+            if capture is None:
+                child.logfile = tmp_output
             else:
-                raise RuntimeError("This program is really bad and doesn't even tell us about bad passwords...")
-            # Set the timeout to run the main program
-            # NOTE: Always use a timeout with automation, a huge timeout is better than not catching something stuck
-            child.timeout = timeout
-            while True:
-                # Note that using the pseudo tty causes \r\n line endings even on linux
-                i = child.expect([r'ERROR:.+?\r\n',
-                                  r'(?i)do you wish to continue',
-                                  r'(?i)log file:.+?\r\n',
-                                  r'FATAL ERROR',
-                                  pexpect.EOF])
-                if i == 0:
-                    errors_found.append(child.after.strip())
-                elif i == 1:
-                    if mock_failure == 'timeout':
-                        child.expect(r'bad expect this will cause a pexpect.TIMEOUT')
-                    if fail_on_errors and errors_found:
-                        child.sendline('n')
-                    else:
-                        child.sendline('y')
-                elif i == 2:
-                    install_logfile = child.after.split()[-1]
-                elif i == 3:
-                    program_failed = True
-                elif i == 4:
-                    # The program exited with an EOF
-                    break
+                # Only what the program prints, it still echoes the password, BoundedCapture redacts that
+                child.logfile_read = tmp_output
+
+            if dialog is not None:
+                # The dialog was given as data, see keyva_pexpect.dialog
+                variables = dialog.run(child, dict(password='' if mock_failure == 'password' else password,
+                                                   timeout=timeout, abort_on_errors=fail_on_errors, errors=[]))
+            else:
+                variables = install_dialog(child, password, timeout, mock_failure, password_check, fail_on_errors)
+            errors_found = list(variables.get('errors') or [])
+            if 'output' in variables:
+                # Already installed, the program told us so and exited
+                child.close()
+                return variables['output'], None, False, child.exitstatus, errors_found
+            changed = variables.get('changed', True)
+            install_logfile = variables.get('logfile')
+            program_failed = bool(variables.get('failed'))
 
             # Now let's take our temporary log file and turn it into a variable
             tmp_output.flush()
-            tmp_output.seek(0)
-            script_output = tmp_output.read()
+            if capture is None:
+                tmp_output.seek(0)
+                script_output = tmp_output.read()
+            else:
+                script_output = capture.getvalue()
         finally:
             # Always hang up on the process and close the pty
+            mark(child, 'close')
             child.close()
+            mark(child, None)
         if program_failed:
             raise RuntimeError("The program failed to run properly.\nOutput:\n{0}".format(script_output))
 
     return script_output, install_logfile, changed, child.exitstatus, errors_found
 
 
+def install_dialog(child, password, timeout, mock_failure, password_check, fail_on_errors):
+    """
+    The dialog with the installer written out by hand, returns the same variables as dialog.INSTALL_DIALOG:
+    output when it was already installed, otherwise changed, failed, logfile and errors
+    """
+    import pexpect
+    from ansible.module_utils.keyva_pexpect.dialog import exit_variables
+    from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+    from ansible.module_utils.keyva_pexpect.timeline import mark
+    from ansible.module_utils.keyva_pexpect.progress import progress_event
+    program_failed = False
+    install_logfile = None
+    errors_found = []
+    # Set once the program gets far enough to print something we look for after the password
+    password_accepted = False
+
+    # Compile the pattern lists once, the main loop below runs them after every read of installer output
+    password_prompts = PatternMatcher([r"Please enter your password", r'(?i)software already installed.+?$'])
+    install_prompts = PatternMatcher([r'ERROR:.+?\r\n',
+                                      r'(?i)do you wish to continue',
+                                      r'(?i)log file:.+?\r\n',
+                                      r'FATAL ERROR',
+                                      pexpect.EOF])
+
+    # make sure we don't wait long for a password prompt
+    child.timeout = 10
+    mark(child, 'password')
+    # Look for password prompt
+    i = expect(child, password_prompts)
+    if i == 1:
+        return dict(output=child.after.strip(), errors=errors_found)
+    # Send password
+    if mock_failure == 'password':
+        child.sendline()
+    else:
+        child.sendline(password)
+    if password_check == 'probe':
+        try:
+            child.timeout = 2
+            child.expect(pexpect.EOF)
+        except pexpect.TIMEOUT:
+            pass
+        else:
+            raise RuntimeError("This program is really bad and doesn't even tell us about bad passwords...")
+    # Set the timeout to run the main program
+    # NOTE: Always use a timeout with automation, a huge timeout is better than not catching something stuck
+    child.timeout = timeout
+    mark(child, 'install')
+    while True:
+        # Note that using the pseudo tty causes \r\n line endings even on linux
+        i = expect(child, install_prompts)
+        if i == 0:
+            errors_found.append(child.after.strip())
+            progress_event(child, 'error', text=child.after)
+        elif i == 1:
+            if mock_failure == 'timeout':
+                child.expect(r'bad expect this will cause a pexpect.TIMEOUT')
+            if fail_on_errors and errors_found:
+                child.sendline('n')
+            else:
+                child.sendline('y')
+        elif i == 2:
+            install_logfile = child.after.split()[-1]
+        elif i == 3:
+            program_failed = True
+        elif i == 4:
+            # The program exited with an EOF
+            if not password_accepted and password_check == 'event':
+                # It quit right after the password without printing anything else. Exiting with 0 is how this
+                #   program says the password was wrong, anything else is the program failing.
+                status = exit_variables(child)
+                if status['clean_exit']:
+                    raise RuntimeError("This program is really bad and doesn't even tell us about bad "
+                                       "passwords...")
+                raise RuntimeError("The program {0} right after the password was sent, before it printed anything "
+                                   "we look for".format(status['exited']))
+            break
+        password_accepted = True
+    return dict(changed=True, failed=program_failed, logfile=install_logfile, errors=errors_found)
+
+
 if __name__ == '__main__':
     main()
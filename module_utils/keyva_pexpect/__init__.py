@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+__author__ = "Brad Johnson, Keyva"
+__version__ = "0.1"
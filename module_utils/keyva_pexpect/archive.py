@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+An on-host archive of what our programs printed, so a failed run can be looked at after the fact.
+
+Layout of the archive directory:
+    index.jsonl          one line of JSON per session: id, module, script, start, end, outcome, error,
+                         exitstatus, bytes, and the segment, offset and length of its transcript
+    segment-<n>.gz       transcripts appended one after another, each one a complete gzip member
+    spool/               transcripts of sessions that are still running
+
+While a session runs its output is compressed as it is read and written to a spool file, so the archive adds
+a little CPU per read and nothing else. When the module knows the outcome the compressed transcript is appended
+to the newest segment and its index line is written, both under a lock so parallel tasks on one host can share
+an archive. A segment is closed once it is over SEGMENT_SIZE bytes.
+Reading one transcript seeks to its offset and decompresses just its member, however big the segment is.
+
+Old sessions are evicted a whole segment at a time, when its newest session is older than max_age seconds
+or when the archive is over max_bytes, oldest segments first.
+Only output is archived, not what we send; text to redact, like the password, is replaced in the output
+because some programs echo it.
+
+To look at an archive on a host:
+    PYTHONPATH=module_utils python -m keyva_pexpect.archive --dir ~/.ansible/keyva_pexpect/archive list
+    PYTHONPATH=module_utils python -m keyva_pexpect.archive --dir ~/.ansible/keyva_pexpect/archive show <id>
+"""
+import argparse
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+
+from .redact import Redactor
+from .state import DEFAULT_STATE_DIR
+
+DEFAULT_ARCHIVE_DIR = os.path.join(DEFAULT_STATE_DIR, 'archive')
+INDEX = 'index.jsonl'
+SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Spool files this old belong to a module that died before it could archive them
+STALE_SPOOL = 24 * 3600
+COPY_SIZE = 1024 * 1024
+
+
+class ArchiveSession(object):
+    """
+    The transcript of one session on its way into the archive
+    """
+
+    def __init__(self, archive_dir, module, script, redact=None):
+        self.archive_dir = archive_dir or DEFAULT_ARCHIVE_DIR
+        self.module = module
+        self.script = os.path.abspath(script)
+        self.redactor = Redactor(redact)
+        self.id = uuid.uuid4().hex[:16]
+        self.start = time.time()
+        self.bytes = 0
+        self.exitstatus = None
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        spool_dir = os.path.join(self.archive_dir, 'spool')
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir, 0o700)
+        handle, self.spool_path = tempfile.mkstemp(dir=spool_dir, prefix=self.id)
+        self.spool = os.fdopen(handle, 'wb')
+
+    def attach(self, child):
+        """
+        Archive everything read from child, the compressed stream is completed when child is closed
+        """
+        read_nonblocking = child.read_nonblocking
+        close = child.close
+
+        def archived_read_nonblocking(size=1, timeout=-1):
+            data = read_nonblocking(size, timeout)
+            self.write(data)
+            return data
+
+        def archived_close(*args, **kwargs):
+            try:
+                return close(*args, **kwargs)
+            finally:
+                self.exitstatus = child.exitstatus if child.exitstatus is not None else child.signalstatus
+                self.close()
+
+        child.read_nonblocking = archived_read_nonblocking
+        child.close = archived_close
+
+    def write(self, data):
+        if self.spool is None:
+            return
+        self.emit(self.redactor.feed(data))
+
+    def emit(self, data):
+        self.bytes += len(data)
+        self.spool.write(self.compressor.compress(data))
+
+    def close(self):
+        """
+        Finish the compressed stream, the session is only in the archive once finish() is called
+        """
+        if self.spool is None:
+            return
+        self.emit(self.redactor.release())
+        self.spool.write(self.compressor.flush())
+        self.spool.close()
+        self.spool = None
+
+    def finish(self, outcome, error=None, max_age=DEFAULT_MAX_AGE, max_bytes=DEFAULT_MAX_BYTES, warn=None):
+        """
+        Move the transcript into the archive with its outcome, 'ok' or 'failed', and evict what is too old.
+        With warn, e.g. module.warn, a session that can't be archived is reported through it and None returned,
+        so the task still ends the way the run did.
+        """
+        try:
+            return self.append(outcome, error, max_age, max_bytes)
+        except (IOError, OSError) as err:
+            if warn is None:
+                raise
+            warn("Unable to archive the session in '{0}': {1}".format(self.archive_dir, err))
+            return None
+
+    def append(self, outcome, error, max_age, max_bytes):
+        self.close()
+        entry = {'id': self.id, 'module': self.module, 'script': self.script, 'start': self.start,
+                 'end': time.time(), 'outcome': outcome, 'exitstatus': self.exitstatus, 'bytes': self.bytes}
+        if error is not None:
+            entry['error'] = '{0}: {1}'.format(type(error).__name__, (str(error).splitlines() or [''])[0])
+        try:
+            with ArchiveLock(self.archive_dir):
+                segment, offset = current_segment(self.archive_dir)
+                with open(os.path.join(self.archive_dir, segment), 'ab') as segment_file:
+                    with open(self.spool_path, 'rb') as spool:
+                        for block in iter(lambda: spool.read(COPY_SIZE), b''):
+                            segment_file.write(block)
+                    entry.update(segment=segment, offset=offset, length=segment_file.tell() - offset)
+                with open(os.path.join(self.archive_dir, INDEX), 'a') as index:
+                    index.write(json.dumps(entry, sort_keys=True) + '\n')
+                evict(self.archive_dir, max_age, max_bytes, locked=True)
+        finally:
+            os.unlink(self.spool_path)
+        return entry
+
+
+class ArchiveLock(object):
+    """
+    Exclusive lock on an archive directory, for appending and evicting
+    """
+
+    def __init__(self, archive_dir):
+        self.path = os.path.join(archive_dir, '.lock')
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+def segments(archive_dir):
+    """
+    Segment file names oldest first
+    """
+    names = [name for name in os.listdir(archive_dir) if name.startswith('segment-') and name.endswith('.gz')]
+    return sorted(names, key=lambda name: int(name[len('segment-'):-len('.gz')]))
+
+
+def current_segment(archive_dir):
+    """
+    The segment to append to and its size, a new one when the newest is full
+    """
+    names = segments(archive_dir)
+    if names:
+        size = os.path.getsize(os.path.join(archive_dir, names[-1]))
+        if size < SEGMENT_SIZE:
+            return names[-1], size
+        number = int(names[-1][len('segment-'):-len('.gz')]) + 1
+    else:
+        number = 0
+    return 'segment-{0}.gz'.format(number), 0
+
+
+def entries(archive_dir):
+    try:
+        with open(os.path.join(archive_dir or DEFAULT_ARCHIVE_DIR, INDEX)) as index:
+            for line in index:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A line cut short by a full disk, the rest of the index is still good
+                    continue
+    except (IOError, OSError):
+        return
+
+
+def find(archive_dir=None, module=None, script=None, since=None, until=None, outcome=None):
+    """
+    Index entries matching every filter given, oldest first
+    """
+    if script is not None:
+        script = os.path.abspath(script)
+    found = []
+    for entry in entries(archive_dir):
+        if ((module is not None and entry['module'] != module) or
+                (script is not None and entry['script'] != script) or
+                (since is not None and entry['start'] < since) or
+                (until is not None and entry['start'] > until) or
+                (outcome is not None and entry['outcome'] != outcome)):
+            continue
+        found.append(entry)
+    return found
+
+
+def fetch(archive_dir, session_id):
+    """
+    The transcript of one session as bytes, or None when it is not in the archive
+    """
+    archive_dir = archive_dir or DEFAULT_ARCHIVE_DIR
+    for entry in entries(archive_dir):
+        if entry['id'] == session_id:
+            break
+    else:
+        return None
+    with open(os.path.join(archive_dir, entry['segment']), 'rb') as segment:
+        segment.seek(entry['offset'])
+        return zlib.decompress(segment.read(entry['length']), 31)
+
+
+def evict(archive_dir, max_age=DEFAULT_MAX_AGE, max_bytes=DEFAULT_MAX_BYTES, locked=False):
+    """
+    Remove whole segments whose sessions are all older than max_age, then the oldest segments until the archive
+    fits in max_bytes. The segment being appended to is only removed for age. Returns the segments removed.
+    """
+    archive_dir = archive_dir or DEFAULT_ARCHIVE_DIR
+    if not locked:
+        with ArchiveLock(archive_dir):
+            return evict(archive_dir, max_age, max_bytes, locked=True)
+    names = segments(archive_dir)
+    newest = {}
+    for entry in entries(archive_dir):
+        newest[entry['segment']] = max(newest.get(entry['segment'], 0), entry['end'])
+    sizes = dict((name, os.path.getsize(os.path.join(archive_dir, name))) for name in names)
+    now = time.time()
+    removed = [name for name in names if max_age and now - newest.get(name, 0) > max_age]
+    total = sum(sizes[name] for name in names if name not in removed)
+    for name in names[:-1]:
+        if not max_bytes or total <= max_bytes:
+            break
+        if name not in removed:
+            removed.append(name)
+            total -= sizes[name]
+    if removed:
+        # Drop their index lines first, a crash in between leaves segments nobody points to rather than the reverse
+        kept = [entry for entry in entries(archive_dir) if entry['segment'] not in removed]
+        handle, tmp_path = tempfile.mkstemp(dir=archive_dir, prefix='.tmp')
+        with os.fdopen(handle, 'w') as index:
+            for entry in kept:
+                index.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.rename(tmp_path, os.path.join(archive_dir, INDEX))
+        for name in removed:
+            os.unlink(os.path.join(archive_dir, name))
+    spool_dir = os.path.join(archive_dir, 'spool')
+    if os.path.isdir(spool_dir):
+        for name in os.listdir(spool_dir):
+            path = os.path.join(spool_dir, name)
+            if now - os.path.getmtime(path) > STALE_SPOOL:
+                os.unlink(path)
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Look at the keyva_pexpect session archive on this host')
+    parser.add_argument('--dir', default=DEFAULT_ARCHIVE_DIR, help='archive directory')
+    commands = parser.add_subparsers(dest='command')
+    listing = commands.add_parser('list', help='list archived sessions, oldest first')
+    listing.add_argument('--module')
+    listing.add_argument('--script')
+    listing.add_argument('--outcome', choices=['ok', 'failed'])
+    listing.add_argument('--since', type=float, help='only sessions started after this unix time')
+    show = commands.add_parser('show', help='print the transcript of one session')
+    show.add_argument('id')
+    args = parser.parse_args(argv)
+    if args.command == 'list':
+        for entry in find(args.dir, args.module, args.script, args.since, outcome=args.outcome):
+            print('{0}  {1}  {2:<7} {3:<22} {4} {5}'.format(
+                entry['id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['start'])), entry['outcome'],
+                entry['module'], entry['script'], entry.get('error', '')))
+        return 0
+    if args.command == 'show':
+        transcript = fetch(args.dir, args.id)
+        if transcript is None:
+            sys.stderr.write('No session {0} in {1}\n'.format(args.id, args.dir))
+            return 1
+        getattr(sys.stdout, 'buffer', sys.stdout).write(transcript)
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
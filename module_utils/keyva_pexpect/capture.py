@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed size capture of a child's output.
+
+BoundedCapture is used as child.logfile_read in place of a temp file. It keeps the first head_size bytes, a ring
+buffer of the last tail_size bytes and the lines matching a few patterns (errors, warnings, log paths), so
+memory use and the size of the module result stay the same no matter how much the program prints.
+The full transcript can still be kept by spooling it to a gzip file on the host.
+The program echoes what we type, so text to redact, like the password, is replaced before the output is kept
+anywhere, in the spool file as well.
+"""
+import gzip
+
+from .matcher import PatternMatcher
+from .redact import Redactor, coerce
+
+DEFAULT_LINE_PATTERNS = [r'ERROR', r'(?i)warn', r'(?i)log ?file:']
+# A line longer than this is cut off before it is matched, output without newlines must not grow our buffer
+MAX_LINE = 4096
+
+
+class BoundedCapture(object):
+    def __init__(self, head_size=65536, tail_size=65536, line_patterns=None, max_lines=200, spool_path=None,
+                 redact=None):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.max_lines = max_lines
+        self.head = bytearray()
+        # Ring buffer for the tail, self.ring_pos is where the next byte goes once it has filled up
+        self.ring = bytearray()
+        self.ring_pos = 0
+        self.total = 0
+        self.lines = []
+        self.lines_dropped = 0
+        self.partial = bytearray()
+        patterns = DEFAULT_LINE_PATTERNS if line_patterns is None else line_patterns
+        self.line_matcher = PatternMatcher(patterns) if patterns else None
+        self.redactor = Redactor(redact)
+        self.spool_path = spool_path
+        self.spool = gzip.open(spool_path, 'wb') if spool_path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        if not self.redactor.secrets:
+            self.store(coerce(data))
+            return
+        self.store(self.redactor.feed(data))
+
+    def release(self):
+        """
+        Store what write() held back, the output is complete
+        """
+        data = self.redactor.release()
+        if data:
+            self.store(data)
+
+    def store(self, data):
+        self.total += len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+        if len(self.head) < self.head_size:
+            self.head += data[:self.head_size - len(self.head)]
+        self.write_tail(data)
+        if self.line_matcher is not None:
+            self.scan_lines(data)
+
+    def write_tail(self, data):
+        size = self.tail_size
+        if not size:
+            return
+        if len(data) >= size:
+            self.ring = bytearray(data[-size:])
+            self.ring_pos = 0
+            return
+        if len(self.ring) < size:
+            # Still filling up, only wrap around once the ring is full
+            room = size - len(self.ring)
+            self.ring += data[:room]
+            data = data[room:]
+            if not data:
+                return
+        end = self.ring_pos + len(data)
+        if end <= size:
+            self.ring[self.ring_pos:end] = data
+        else:
+            split = size - self.ring_pos
+            self.ring[self.ring_pos:] = data[:split]
+            self.ring[:end - size] = data[split:]
+        self.ring_pos = end % size
+
+    def scan_lines(self, data):
+        start = 0
+        while True:
+            newline = data.find(b'\n', start)
+            if newline < 0:
+                self.partial += data[start:start + MAX_LINE - len(self.partial)]
+                return
+            self.partial += data[start:newline][:MAX_LINE - len(self.partial)]
+            self.match_line(bytes(self.partial))
+            self.partial = bytearray()
+            start = newline + 1
+
+    def match_line(self, line):
+        if self.line_matcher.find(line) is None:
+            return
+        if len(self.lines) < self.max_lines:
+            self.lines.append(line.strip())
+        else:
+            self.lines_dropped += 1
+
+    def tail(self):
+        if len(self.ring) < self.tail_size:
+            return bytes(self.ring)
+        return bytes(self.ring[self.ring_pos:] + self.ring[:self.ring_pos])
+
+    def getvalue(self):
+        """
+        The head and tail of the output with a marker for what was left out between them
+        """
+        self.release()
+        if self.total <= len(self.head) + len(self.ring):
+            # Nothing was dropped, the tail starts where the head stops
+            return bytes(self.head) + self.tail()[len(self.ring) - (self.total - len(self.head)):]
+        omitted = self.total - len(self.head) - len(self.ring)
+        return bytes(self.head) + '\n... [{0} bytes omitted] ...\n'.format(omitted).encode('utf-8') + self.tail()
+
+    def flush(self):
+        # pexpect flushes its logfile after every read, a gzip flush each time would ruin the compression.
+        #   The spool is complete once the capture is closed.
+        pass
+
+    def close(self):
+        self.release()
+        if self.partial and self.line_matcher is not None:
+            self.match_line(bytes(self.partial))
+            self.partial = bytearray()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
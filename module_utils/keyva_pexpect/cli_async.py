@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Drive several myscript sessions at once on one asyncio event loop.
+
+The dialog itself is the one in cli_session.py, drive_async() runs it with every expect awaited instead of
+blocking, so while one program is slow to answer the loop keeps reading and writing for all the others.
+
+pexpect has its own expect(async_=True) but in pexpect 4.8 it is built on asyncio.coroutine, which is gone
+from Python 3.11. expect_async() below drives pexpect's own Expecter from loop.add_reader() instead, that
+works on every Python 3 and keeps our PatternMatcher.
+
+Python 3 only, only import this when targets are given.
+"""
+import asyncio
+import os
+import shlex
+import signal
+
+import pexpect
+from pexpect.expect import Expecter
+
+from .cli_session import (Pause, Steps, exit_dialog, login_dialog, parse_config, run_session_dialog,
+                          start_config_dialog, timeout_message)
+from .matcher import Searcher
+
+# How long a program that was told to exit gets to go away before it is killed
+EXIT_WAIT = 1.0
+
+
+async def expect_async(child, matcher, timeout=-1):
+    """
+    expect(child, matcher) that waits on the event loop instead of blocking it
+    """
+    if timeout == -1:
+        timeout = child.timeout
+    expecter = Expecter(child, Searcher(matcher), -1)
+    # Data read by an earlier expect may already hold the match
+    index = expecter.existing_data()
+    if index is not None:
+        return index
+    loop = asyncio.get_event_loop()
+    found = loop.create_future()
+
+    def readable():
+        if found.done():
+            return
+        try:
+            data = child.read_nonblocking(child.maxread, 0)
+        except pexpect.TIMEOUT:
+            # Woken up without data, wait for the next read
+            return
+        except pexpect.EOF as err:
+            try:
+                found.set_result(expecter.eof(err))
+            except pexpect.EOF as eof:
+                found.set_exception(eof)
+            return
+        except Exception as err:
+            expecter.errored()
+            found.set_exception(err)
+            return
+        index = expecter.new_data(data)
+        if index is not None:
+            found.set_result(index)
+
+    loop.add_reader(child.child_fd, readable)
+    try:
+        return await asyncio.wait_for(found, timeout)
+    except asyncio.TimeoutError as err:
+        return expecter.timeout(err)
+    finally:
+        loop.remove_reader(child.child_fd)
+
+
+async def drive_async(child, dialog):
+    """
+    cli_session.drive() for the event loop, a timeout is raised in the dialog as a RuntimeError saying where
+    """
+    steps = Steps(dialog)
+    request = steps.advance()
+    while request is not None:
+        if isinstance(request, Pause):
+            await asyncio.sleep(request.seconds)
+            request = steps.advance()
+            continue
+        try:
+            index = await expect_async(child, request)
+        except pexpect.TIMEOUT:
+            request = steps.advance(error=RuntimeError(timeout_message(child, request, child.timeout)))
+        except Exception as err:
+            request = steps.advance(error=err)
+        else:
+            request = steps.advance(index)
+    return steps.result
+
+
+async def close_async(child, wait=0):
+    """
+    Close child without blocking the loop. pexpect's close() sleeps and then waits for the program to exit, so
+    give it up to wait seconds to go away on its own, hang it up or kill it when it doesn't, and only then close.
+    """
+    for sig, seconds in ((None, wait), (signal.SIGHUP, 0.1), (signal.SIGKILL, EXIT_WAIT)):
+        if sig is not None and child.isalive():
+            child.kill(sig)
+        for _ in range(int(seconds / 0.01)):
+            if not child.isalive():
+                break
+            await asyncio.sleep(0.01)
+    child.ptyproc.delayafterclose = 0
+    child.ptyproc.delayafterterminate = 0
+    child.close(force=True)
+
+
+async def run_targets(targets, concurrency=4):
+    """
+    Run every target and return one result dict per target in the same order.
+    A target that fails gets failed=True and msg instead of stopping the others.
+    """
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run_limited(target):
+        async with limit:
+            return await run_target(target)
+
+    return await asyncio.gather(*[run_limited(target) for target in targets])
+
+
+async def run_target(target):
+    result = dict(path=target['path'], options=target['options'])
+    try:
+        current_settings, changed, logfile = await run_cli(target['path'], target['options'],
+                                                           target['commands'], target['password'],
+                                                           target['timeout'], target['pipeline'],
+                                                           target['diff_config'], target.get('plan', False))
+    except pexpect.TIMEOUT as err:
+        result.update(failed=True, msg="pexpect.TIMEOUT: Unexpected timeout waiting for prompt or command: "
+                                       "{0}".format(err))
+    except pexpect.EOF as err:
+        result.update(failed=True, msg="pexpect.EOF: Unexpected program termination: {0}".format(err))
+    except pexpect.exceptions.ExceptionPexpect as err:
+        result.update(failed=True, msg="pexpect.exceptions.{0}: {1}".format(type(err).__name__, err))
+    except RuntimeError as err:
+        result.update(failed=True, msg="{0}".format(err))
+    else:
+        result.update(failed=False, changed=changed, current_settings=current_settings, logfile=logfile,
+                      config=parse_config(current_settings))
+    return result
+
+
+async def run_cli(script_path, options, commands, password, timeout=300, pipeline=0, diff_config=False,
+                  plan=False):
+    if not os.path.exists(script_path):
+        raise RuntimeError("Error: the script '{0}' does not exist!".format(script_path))
+    child = pexpect.spawn(script_path, args=shlex.split(options), encoding='utf-8')
+    finished = False
+    try:
+        logfile = await drive_async(child, login_dialog(child, password))
+        # NOTE: Always use a timeout with automation, a huge timeout is better than not catching something stuck
+        child.timeout = timeout
+        await drive_async(child, start_config_dialog(child))
+        current_settings, changed = await drive_async(child, run_session_dialog(child, commands, pipeline,
+                                                                                diff_config, plan))
+        await drive_async(child, exit_dialog(child))
+        finished = True
+    finally:
+        # Only a program that was told to exit gets time to do so, on errors it is hung up on at once
+        await close_async(child, EXIT_WAIT if finished else 0)
+    if child.exitstatus != 0:
+        raise RuntimeError("ERROR: The command returned a non-zero exit code! '{0}'".format(
+            child.exitstatus if child.exitstatus is not None else "signal {0}".format(child.signalstatus)))
+    return current_settings, changed, logfile
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+The dialog used to drive myscript once it is running.
+These functions only talk to an already spawned pexpect child, so they can be shared by the
+keyva_pexpect_cli module and the session pool broker that keeps children logged in between tasks.
+Every pattern list is compiled once here into a PatternMatcher.
+
+Each part of the dialog is written once as a generator, e.g. save_config_dialog(), that yields the
+PatternMatcher it waits for and gets back the index that matched, or yields another dialog to run it.
+drive() does the waiting with blocking expects and cli_async.py does it on an event loop, so both run the
+same dialog. A dialog yields Return(value) last to hand back a value and Pause(seconds) to wait.
+login(), run_session() and the other plain functions run their dialog with drive().
+"""
+import time
+import types
+
+import pexpect
+
+from .matcher import PatternMatcher, expect
+from .timeline import step
+
+# Upper limit on the bytes we write ahead of the prompt in pipelined mode.
+# Typed ahead input sits in the pty line discipline until the program reads it and that queue is
+#   only 4k on linux, anything past it is silently dropped, so stay well under it.
+PIPELINE_MAX_BYTES = 2048
+# pexpect waits this long before every send in case a program prints its password prompt before turning echo
+#   off. We only need it before the password.
+PASSWORD_DELAY = 0.05
+
+# Replies to a command, multiline so an error line is still found when the prompt after it was read
+#   in the same chunk, which is the normal case when replies are pipelined.
+REPLY_PATTERNS = [r'ERROR.+?does not exist', r'(?m)ERROR.+?$', '>']
+
+LOGFILE = PatternMatcher([r'Logfile\:.+?/.+?\.log'])
+PASSWORD_PROMPTS = PatternMatcher([r"Enter password\:", '>'])
+START_PROMPTS = PatternMatcher([r'Initialize New Config\?', '>'])
+PROMPT = PatternMatcher(['>'])
+REPLIES = PatternMatcher(REPLY_PATTERNS)
+ADD_REPLIES = PatternMatcher([r'ERROR.+?$', '>'])
+SAVE_REPLIES = PatternMatcher([r'No changes made', r'ERROR.+?$', '>'])
+PRINT_CONFIG_ECHO = PatternMatcher(['print config'])
+EXITED = PatternMatcher([pexpect.EOF])
+
+
+class Return(object):
+    """
+    Yielded by a dialog as its last step to hand value back to whoever runs it
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Pause(object):
+    """
+    Yielded by a dialog to wait, time.sleep() in drive() and asyncio.sleep() on an event loop
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Steps(object):
+    """
+    Walks a dialog and the dialogs it yields and hands out what to wait for next, a PatternMatcher or a Pause.
+    Whoever runs it does the waiting, so the same dialog runs with blocking expects or on an event loop.
+    """
+
+    def __init__(self, dialog):
+        self.stack = [dialog]
+        self.result = None
+
+    def advance(self, value=None, error=None):
+        """
+        Resume the dialog with the index that matched or the error raised while waiting. Returns the next
+        PatternMatcher or Pause, or None once the dialog is done and the value it returned is in result.
+        """
+        while self.stack:
+            try:
+                if error is not None:
+                    request = self.stack[-1].throw(error)
+                else:
+                    request = self.stack[-1].send(value)
+            except StopIteration:
+                self.stack.pop()
+                value, error = None, None
+                continue
+            except Exception as err:
+                # Not handled by this dialog, raise it in the one that yielded it
+                self.stack.pop()
+                if not self.stack:
+                    raise
+                value, error = None, err
+                continue
+            value, error = None, None
+            if isinstance(request, Return):
+                self.stack.pop().close()
+                value = request.value
+            elif isinstance(request, types.GeneratorType):
+                self.stack.append(request)
+            else:
+                return request
+        self.result = value
+        return None
+
+
+def drive(child, dialog):
+    """
+    Run a dialog with blocking expects on child, returns the value it returns
+    """
+    steps = Steps(dialog)
+    request = steps.advance()
+    while request is not None:
+        if isinstance(request, Pause):
+            time.sleep(request.seconds)
+            request = steps.advance()
+            continue
+        try:
+            index = expect(child, request)
+        except Exception as err:
+            request = steps.advance(error=err)
+        else:
+            request = steps.advance(index)
+    return steps.result
+
+
+def login(child, password):
+    """
+    Get from a freshly started myscript to its password prompt and log in, returns the logfile path
+    """
+    return drive(child, login_dialog(child, password))
+
+
+def start_config(child):
+    """
+    Answer the new config dialog if there is one and wait for the first program prompt
+    """
+    drive(child, start_config_dialog(child))
+
+
+def run_session(child, commands, pipeline=0, diff_config=False, plan=False):
+    """
+    Run commands from the program prompt, save them and return (current_settings, changed), see
+    run_session_dialog()
+    """
+    return drive(child, run_session_dialog(child, commands, pipeline, diff_config, plan))
+
+
+def run_command(child, command):
+    """
+    Send one command and wait for its prompt, adding missing item instances as needed
+    """
+    drive(child, run_command_dialog(child, command))
+
+
+def run_commands_pipelined(child, commands, window):
+    """
+    Send commands up to window at a time, see run_commands_pipelined_dialog()
+    """
+    drive(child, run_commands_pipelined_dialog(child, commands, window))
+
+
+def add_missing_item(child, command, error):
+    """
+    Add the item instance error says is missing and send command again
+    """
+    drive(child, add_missing_item_dialog(child, command, error))
+
+
+def save_config(child):
+    """
+    Save the settings, returns False when the program says nothing changed
+    """
+    return drive(child, save_config_dialog(child))
+
+
+def print_config(child):
+    """
+    Always print out the config data from our script so it can be returned to the user
+    """
+    return drive(child, print_config_dialog(child))
+
+
+def exit_session(child):
+    """
+    Run the 'exit' command that is inside myscript and wait for it to go away
+    """
+    drive(child, exit_dialog(child))
+
+
+def timeout_message(child, matcher, timeout):
+    """
+    Say which step and command of the dialog timed out and what it was waiting for
+    """
+    name, detail = getattr(child, 'keyva_step', None) or (None, None)
+    where = "in step '{0}'".format(name) if name is not None else "before the first step"
+    if detail is not None:
+        where += " of '{0}'".format(detail)
+    waiting = ', '.join('EOF' if pattern is pexpect.EOF else repr(getattr(pattern, 'pattern', pattern))
+                        for pattern in matcher.patterns)
+    return "ERROR: timed out after {0}s waiting for a prompt in myscript {1}, expected one of: {2}".format(
+        timeout, where, waiting)
+
+
+def login_dialog(child, password):
+    with step(child, 'login'):
+        # We only type at the program prompt after the password, don't wait before every send
+        child.delaybeforesend = None
+        # look for our scripts logfile prompt
+        # Example text seen in output: 'Logfile: /path/to/mylog.log'
+        yield LOGFILE
+        # Note that child.after contains the text of the matching regex
+        logfile = child.after.split()[1]
+        # Look for password prompt
+        i = yield PASSWORD_PROMPTS
+        if i == 0:
+            # In case the program prints its password prompt before turning echo off
+            yield Pause(PASSWORD_DELAY)
+            # Send password
+            child.sendline(password)
+    yield Return(logfile)
+
+
+def start_config_dialog(child):
+    with step(child, 'start_config'):
+        # Look for program internal prompt or new config dialog
+        i = yield START_PROMPTS
+        # pexpect will return the index of the regex it found first
+        if i == 0:
+            # Answer 'y' to initialize new config prompt
+            child.sendline('y')
+            yield PROMPT
+
+
+def run_session_dialog(child, commands, pipeline=0, diff_config=False, plan=False):
+    """
+    Run commands from the program prompt, save them and return (current_settings, changed).
+    With diff_config the config is read first and only the commands that change something are sent, save is
+    skipped when there are none. With plan the config is read first as well and the commands are replaced by
+    plan_commands(), so missing item instances are added up front instead of one failed set at a time.
+    The child is left sitting at the program prompt so it can be used again.
+    """
+    changed = True
+    if diff_config or plan:
+        current_settings = yield print_config_dialog(child)
+        config = parse_config(current_settings)
+        commands = plan_commands(config, commands, diff_config) if plan else config_deltas(config, commands)
+        if diff_config and not commands:
+            yield Return((current_settings, False))
+    if pipeline > 1:
+        # Write commands ahead of the prompts and match the replies back in order
+        yield run_commands_pipelined_dialog(child, commands, pipeline)
+    else:
+        # If any commands were passed in loop over them and run them one by one.
+        for command in commands:
+            yield run_command_dialog(child, command)
+    # Set timeout shorter for final commands
+    child.timeout = 15
+    # If we processed any commands run the save function last
+    if commands:
+        changed = yield save_config_dialog(child)
+    current_settings = yield print_config_dialog(child)
+    yield Return((current_settings, changed))
+
+
+def run_command_file(child, command_file, pipeline=0):
+    """
+    run_session() for the commands of a CommandFile, sent a chunk at a time with a save and a checkpoint after
+    every chunk. Returns (current_settings, changed), changed when any of the saves changed something.
+    """
+    changed = False
+    timeout = child.timeout
+    for commands, offset in command_file.chunks():
+        with step(child, 'chunk', command_file.done):
+            if pipeline > 1:
+                run_commands_pipelined(child, commands, pipeline)
+            else:
+                for command in commands:
+                    run_command(child, command)
+            child.timeout = 15
+            changed = save_config(child) or changed
+            child.timeout = timeout
+        command_file.checkpoint(offset, len(commands))
+    command_file.finish()
+    child.timeout = 15
+    return print_config(child), changed
+
+
+def parse_config(text):
+    """
+    Turn the output of 'print config' into a dict, e.g. 'port: 7000' becomes {'port': '7000'}.
+    Lines without a value like the 'Fake Config:' header are skipped.
+    """
+    config = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(':')
+        if sep and key.strip() and value.strip():
+            config[key.strip()] = value.strip()
+    return config
+
+
+def config_deltas(config, commands):
+    """
+    The commands that would change config, in their original order.
+    'set <key> <value>' is dropped when the key already has that value at that point. Anything else can't be
+    compared with the config so it is always kept, as is every set that comes after it since it may depend on it.
+    """
+    return list(iter_deltas(config, commands))
+
+
+def iter_deltas(config, commands):
+    """
+    config_deltas() one command at a time, for commands streamed from a file
+    """
+    # What the config will look like after the commands kept so far have run
+    expected = dict(config)
+    comparable = True
+    for command in commands:
+        words = command.split(None, 2)
+        if len(words) == 3 and words[0] == 'set':
+            if comparable and expected.get(words[1]) == words[2].strip():
+                continue
+            expected[words[1]] = words[2].strip()
+        else:
+            comparable = False
+        yield command
+
+
+def plan_commands(config, commands, diff_config=False):
+    """
+    The commands to send for config so that none of them fails, in an order that gives the same result.
+    A set that a later set of the same key overrides is dropped, with diff_config so are the sets that don't
+    change anything, see config_deltas(). Then 'add <item>' is put in front of the first set of an instance
+    that is not in config yet, e.g. two adds before 'set socket.3.port 80' when config only has socket.1.
+    Anything but set and add can't be planned around, nothing is dropped before it or added after it and a
+    set that still fails gets its item added by run_command() as without a plan.
+    """
+    # Walk back from the end, a set is overridden when the same key is set again before the next other command
+    kept = []
+    overridden = set()
+    for command in reversed(commands):
+        words = command.split(None, 2)
+        if len(words) == 3 and words[0] == 'set':
+            if words[1] in overridden:
+                continue
+            overridden.add(words[1])
+        else:
+            overridden = set()
+        kept.append(command)
+    kept.reverse()
+    if diff_config:
+        kept = config_deltas(config, kept)
+    # Instances are numbered from 1 and 'add <item>' makes the next one, so the count is the highest number seen
+    instances = {}
+    for key in config:
+        item, number = item_instance(key)
+        if item is not None:
+            instances[item] = max(instances.get(item, 0), number)
+    planned = []
+    plannable = True
+    for command in kept:
+        words = command.split(None, 2)
+        if plannable and len(words) == 3 and words[0] == 'set':
+            item, number = item_instance(words[1])
+            while item is not None and instances.get(item, 0) < number:
+                planned.append('add {0}'.format(item))
+                instances[item] = instances.get(item, 0) + 1
+        elif plannable and len(words) == 2 and words[0] == 'add':
+            instances[words[1]] = instances.get(words[1], 0) + 1
+        elif len(words) != 3 or words[0] != 'set':
+            plannable = False
+        planned.append(command)
+    return planned
+
+
+def item_instance(key):
+    """
+    The item and instance number a setting belongs to, e.g. ('socket', 2) for socket.2.port, or (None, None)
+    """
+    parts = key.split('.')
+    if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 0:
+        return parts[0], int(parts[1])
+    return None, None
+
+
+def run_command_dialog(child, command):
+    with step(child, 'command', command):
+        child.sendline(command)
+        i = yield REPLIES
+        if i == 0:
+            # Consume the prompt printed after the error so the next expect lines up with the next reply
+            error = child.after
+            yield PROMPT
+            yield add_missing_item_dialog(child, command, error)
+        elif i == 1:
+            raise RuntimeError("ERROR: unspecified error running a myscript command\n"
+                               "  {0}".format(child.after.strip()))
+
+
+def run_commands_pipelined_dialog(child, commands, window):
+    """
+    Write up to 'window' commands at once and then read their replies back in order.
+    The program still answers one command at a time, we just don't wait for each prompt before sending
+    the next command. A command that needs an item added has the add and retry run on their own, then
+    every command written after it is sent again so the final order of the settings is preserved.
+    """
+    position = 0
+    while position < len(commands):
+        batch = next_batch(commands, position, window, child.linesep)
+        missing = None
+        with step(child, 'batch', len(batch)):
+            # One write for the whole window instead of one per command
+            child.send(child.linesep.join(batch) + child.linesep)
+            # Each reply is an optional error line followed by a prompt, match them back to the batch in order
+            for n, command in enumerate(batch):
+                i = yield REPLIES
+                if i == 2:
+                    continue
+                error = child.after
+                yield PROMPT
+                if i == 1:
+                    raise RuntimeError("ERROR: unspecified error running a myscript command\n"
+                                       "  {0}".format(error.strip()))
+                if missing is None:
+                    missing = (n, error)
+        if missing is None:
+            position += len(batch)
+            continue
+        # Fix the first failed command and start the next window right after it
+        n, error = missing
+        yield add_missing_item_dialog(child, batch[n], error)
+        position += n + 1
+
+
+def add_missing_item_dialog(child, command, error):
+    """
+    Attempt to intelligently add items that may have multiple instances and are missing
+    e.g. "socket.2" may need "add socket" run before it.
+    Try to allow the user just to use the set command and run add as needed
+    """
+    with step(child, 'add', command):
+        child.sendline('add {0}'.format(missing_item_name(error)))
+        i = yield ADD_REPLIES
+        if i == 0:
+            raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
+                               " file a bug\n  {0}".format(child.after.strip()))
+        # Retry the failed original command after the add
+        child.sendline(command)
+        i = yield ADD_REPLIES
+        if i == 0:
+            raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
+                               " file a bug\n  {0}".format(child.after.strip()))
+
+
+def next_batch(commands, position, window, linesep):
+    """
+    The commands to write in one go from position, no more than window and within the type ahead limit of the pty
+    """
+    batch = [commands[position]]
+    size = len(commands[position]) + len(linesep)
+    for command in commands[position + 1:position + window]:
+        size += len(command) + len(linesep)
+        if size > PIPELINE_MAX_BYTES:
+            break
+        batch.append(command)
+    return batch
+
+
+def missing_item_name(error):
+    """
+    The item type to add from an error like 'ERROR: "socket.2" does not exist', e.g. socket
+    """
+    try:
+        return error.split('"')[1].split('.')[0]
+    except IndexError:
+        raise RuntimeError("ERROR: unable to automatically add new item in myscript,"
+                           " file a bug\n  {0}".format(error))
+
+
+def save_config_dialog(child):
+    with step(child, 'save'):
+        changed = True
+        child.sendline('save')
+        # Using true loops with expect statements allow us to process multiple items in a block until
+        #    some kind of done or exit condition is met where we then call a break.
+        while True:
+            i = yield SAVE_REPLIES
+            if i == 0:
+                changed = False
+            elif i == 1:
+                raise RuntimeError("ERROR: unexpected error saving configuration\n"
+                                   "  {0}".format(child.after.strip()))
+            elif i == 2:
+                break
+    yield Return(changed)
+
+
+def print_config_dialog(child):
+    with step(child, 'print_config'):
+        child.sendline('print config')
+        # Expect our command echo from pexpect
+        yield PRINT_CONFIG_ECHO
+        yield PROMPT
+    # Note that child.before contains the output between the last two expects, up to the character limit
+    yield Return(child.before.strip())
+
+
+def exit_dialog(child):
+    with step(child, 'exit'):
+        child.sendline('exit')
+        yield EXITED
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Commands for myscript read from a file on the host a chunk at a time, for configs too big to pass as a list.
+
+The file has one command per line, blank lines and lines starting with # are skipped. chunks() yields at most
+checkpoint_every commands at a time, so memory use depends on the chunk size and not on the size of the file.
+After every chunk the session saves the config and checkpoint() records the byte offset reached under
+state_dir. When a run fails partway through, the next run for the same script, options and file starts after
+the last checkpoint instead of from the top, as long as the file was not changed in between.
+The commands sent after the last checkpoint are sent again on resume, they were never saved.
+"""
+import os
+
+from .fingerprint import file_stat
+from .state import state_path, load_json, save_json, remove
+
+KIND = 'cli_command_file'
+DEFAULT_CHECKPOINT_EVERY = 1000
+
+
+class CommandFile(object):
+    def __init__(self, path, state_dir, script_path, options, checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+                 resume=True):
+        self.path = os.path.abspath(path)
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.record = state_path(state_dir, KIND, os.path.abspath(script_path), options, self.path)
+        self.stat = file_stat(self.path)
+        if self.stat is None:
+            raise RuntimeError("Error: the commands_file '{0}' does not exist!".format(path))
+        self.offset = 0
+        self.done = 0
+        self.resumed_from = 0
+        if resume:
+            saved = load_json(self.record)
+            if saved is not None and saved.get('stat') == self.stat:
+                self.offset = saved['offset']
+                self.done = self.resumed_from = saved['done']
+        self.sent = 0
+        self.checkpoints = 0
+        self.complete = False
+
+    def commands(self, offset=0):
+        """
+        Every command in the file from offset on, with the offset of the line after it
+        """
+        with open(self.path, 'rb') as command_file:
+            command_file.seek(offset)
+            for line in iter(command_file.readline, b''):
+                offset += len(line)
+                try:
+                    command = line.decode('utf-8').strip()
+                except UnicodeDecodeError as err:
+                    raise RuntimeError("Error: line {0} of the commands_file '{1}' is not UTF-8: {2}".format(
+                        line_number(self.path, offset - len(line)), self.path, err))
+                if command and not command.startswith('#'):
+                    yield command, offset
+
+    def chunks(self):
+        """
+        Lists of up to checkpoint_every commands from the last checkpoint on, with the offset after each list
+        """
+        chunk = []
+        offset = self.offset
+        for command, offset in self.commands(self.offset):
+            chunk.append(command)
+            if len(chunk) >= self.checkpoint_every:
+                yield chunk, offset
+                chunk = []
+        if chunk:
+            yield chunk, offset
+
+    def checkpoint(self, offset, count):
+        """
+        A chunk of count commands ending at offset was sent and saved
+        """
+        self.offset = offset
+        self.sent += count
+        self.done += count
+        self.checkpoints += 1
+        save_json(self.record, {'stat': self.stat, 'offset': offset, 'done': self.done})
+
+    def finish(self):
+        """
+        Every command was sent and saved, the next run starts from the top again
+        """
+        self.complete = True
+        remove(self.record)
+
+    def result(self):
+        return {'path': self.path, 'complete': self.complete, 'commands_sent': self.sent,
+                'commands_done': self.done, 'resumed_from': self.resumed_from, 'checkpoints': self.checkpoints,
+                'offset': self.offset, 'size': self.stat['size']}
+
+
+def line_number(path, offset):
+    """
+    The number of the line starting at offset, only for error messages since it reads the file up to there
+    """
+    newlines = 0
+    with open(path, 'rb') as command_file:
+        while offset > 0:
+            block = command_file.read(min(offset, 1024 * 1024))
+            if not block:
+                break
+            newlines += block.count(b'\n')
+            offset -= len(block)
+    return newlines + 1
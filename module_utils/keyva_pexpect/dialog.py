@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Dialogs written down as data instead of as if i == 0 / elif i == 1 ladders around expect.
+
+A dialog is a dict of states. In each state we wait for one of its patterns, and the rule of the pattern that
+matched says what to send, what to keep and which state comes next:
+
+    {'start': 'password',
+     'states': {
+         'password': {'timeout': 10, 'step': 'password', 'expect': [
+             {'pattern': 'Please enter your password', 'send': '{password}', 'next': 'install'}]},
+         'install': {'timeout': 'timeout', 'step': 'install', 'expect': [
+             {'pattern': 'ERROR:.+?\\r\\n', 'append': 'errors'},
+             {'pattern': '(?i)log file:.+?\\r\\n', 'capture': 'logfile', 'word': -1},
+             {'pattern': '(?i)do you wish to continue', 'send': 'y'},
+             {'eof': True, 'end': True}]}}}
+
+State keys:
+    expect      the rules, tried in the order given like the pattern list of an expect call
+    extends     another state whose rules come after these, e.g. a state that differs in how one pattern is handled
+    next        where the rules of this state go when they don't say, by default they stay in it
+    timeout     seconds, or the name of a number in the variables, for every expect in this state
+    step        timeline step to mark when the state is entered, also seen by the watchdog and progress stream
+    send        a line to send when the state is entered
+    send_each   name of a list in the variables, entering the state sends its next item as a line, or when
+                there is none left goes to the state named by done without waiting for anything
+    item        variable to keep the item send_each sent last in, e.g. to send it again after fixing something
+    delaybeforesend
+                set child.delaybeforesend when the state is entered, null once only the program prompt is left
+Rule keys:
+    pattern     a regex, or eof / timeout set to true to handle the program exiting or going quiet
+    when        variable name or list of names that must all be true for the rule to apply, '!name' for false.
+                Rules with the same pattern are tried in order and the first one that applies is used.
+    send        a line to send, formatted with the variables like '{password}'
+    capture     keep the match in this variable, with word the nth word of it and with from: before the text
+                before the match instead
+    extract     with capture, a regex whose first group is kept instead, when it is found in the text
+    append      add the match to this list variable
+    error       report the match as an error line to a progress stream attached to the child
+    set         dict of variables to set
+    fail        raise RuntimeError with this message, formatted with the variables and {match}
+    end         stop here and return the variables
+    next        the state to go to, entering it again when it is this state
+
+When the program exits, before an eof rule is applied the variables get exitstatus and signalstatus, clean_exit
+when it exited with 0 and exited saying how it went for a message, e.g. 'exited with 1'.
+
+Everything is checked and every state's patterns are built into one PatternMatcher when the dialog is compiled.
+The variables only exist once it runs, so a template or timeout naming one that isn't set, or a word past the
+end of what was captured, is a RuntimeError naming the state.
+Running it is a table lookup per match, as fast as the hand-written loops. compile_dialog() keeps what it built
+for every dialog it has seen, so a process running many sessions, like the session pool broker or a module
+configuring many targets, compiles each dialog once. INSTALL_DIALOG and CLI_DIALOG are the built-in dialogs of
+keyva_pexpect_install and keyva_pexpect_cli written this way.
+"""
+import hashlib
+import json
+import os
+import re
+import string
+import time
+
+import pexpect
+
+from .matcher import PatternMatcher, expect
+from .progress import progress_event
+from .timeline import mark
+
+STATE_KEYS = frozenset(['expect', 'extends', 'next', 'timeout', 'step', 'send', 'send_each', 'item', 'done',
+                        'delaybeforesend'])
+RULE_KEYS = frozenset(['pattern', 'eof', 'timeout', 'when', 'send', 'capture', 'extract', 'word', 'from', 'append',
+                       'error', 'set', 'fail', 'end', 'next'])
+# How long a program whose output ended gets to exit before we stop waiting for its exit status
+EXIT_WAIT = 1.0
+# Compiled dialogs by the digest of their spec
+_compiled = {}
+
+INSTALL_DIALOG = {
+    'start': 'password',
+    'states': {
+        'password': {'timeout': 10, 'step': 'password', 'expect': [
+            {'pattern': 'Please enter your password', 'send': '{password}', 'next': 'password_sent'},
+            {'pattern': '(?i)software already installed.+?$', 'capture': 'output', 'set': {'changed': False},
+             'end': True}]},
+        # Like install, except that the program exiting with 0 before it printed anything means a bad password
+        'password_sent': {'timeout': 'timeout', 'step': 'install', 'extends': 'install', 'next': 'install',
+                          'expect': [{'eof': True, 'when': 'clean_exit',
+                                      'fail': "This program is really bad and doesn't even tell us about bad "
+                                              "passwords..."},
+                                     {'eof': True, 'fail': "The program {exited} right after the password was sent, "
+                                                           "before it printed anything we look for"}]},
+        'install': {'expect': [
+            {'pattern': 'ERROR:.+?\\r\\n', 'append': 'errors', 'error': True},
+            {'pattern': '(?i)do you wish to continue', 'when': ['abort_on_errors', 'errors'], 'send': 'n'},
+            {'pattern': '(?i)do you wish to continue', 'send': 'y'},
+            {'pattern': '(?i)log file:.+?\\r\\n', 'capture': 'logfile', 'word': -1},
+            {'pattern': 'FATAL ERROR', 'set': {'failed': True}},
+            {'eof': True, 'end': True}]},
+    },
+}
+
+CLI_DIALOG = {
+    'start': 'logfile',
+    'states': {
+        'logfile': {'step': 'login', 'expect': [
+            {'pattern': 'Logfile\\:.+?/.+?\\.log', 'capture': 'logfile', 'word': 1, 'next': 'password'}]},
+        'password': {'expect': [
+            {'pattern': 'Enter password\\:', 'send': '{password}', 'next': 'start_config'},
+            {'pattern': '>', 'next': 'start_config'}]},
+        'start_config': {'step': 'start_config', 'timeout': 'timeout', 'delaybeforesend': None, 'expect': [
+            {'pattern': 'Initialize New Config\\?', 'send': 'y', 'next': 'first_prompt'},
+            {'pattern': '>', 'next': 'command'}]},
+        'first_prompt': {'expect': [{'pattern': '>', 'next': 'command'}]},
+        'command': {'step': 'command', 'send_each': 'commands', 'item': 'command', 'done': 'save', 'expect': [
+            # e.g. 'ERROR: "socket.2" does not exist', add a socket and send the command again
+            {'pattern': 'ERROR.+?does not exist', 'capture': 'missing', 'extract': '"([^".]+)', 'next': 'missing'},
+            {'pattern': '(?m)ERROR.+?$', 'fail': 'ERROR: unspecified error running a myscript command\n  {match}'},
+            {'pattern': '>', 'next': 'command'}]},
+        'missing': {'expect': [{'pattern': '>', 'next': 'add'}]},
+        'add': {'step': 'add', 'send': 'add {missing}', 'expect': [
+            {'pattern': 'ERROR.+?$', 'fail': 'ERROR: unable to automatically add new item in myscript, file a bug\n'
+                                             '  {match}'},
+            {'pattern': '>', 'next': 'retry'}]},
+        'retry': {'send': '{command}', 'expect': [
+            {'pattern': 'ERROR.+?$', 'fail': 'ERROR: unable to automatically add new item in myscript, file a bug\n'
+                                             '  {match}'},
+            {'pattern': '>', 'next': 'command'}]},
+        'save': {'step': 'save', 'timeout': 15, 'send': 'save', 'expect': [
+            {'pattern': 'No changes made', 'set': {'changed': False}},
+            {'pattern': 'ERROR.+?$', 'fail': 'ERROR: unexpected error saving configuration\n  {match}'},
+            {'pattern': '>', 'next': 'print_config'}]},
+        'print_config': {'step': 'print_config', 'send': 'print config', 'expect': [
+            {'pattern': 'print config', 'next': 'config'}]},
+        'config': {'expect': [{'pattern': '>', 'capture': 'current_settings', 'from': 'before', 'next': 'exit'}]},
+        'exit': {'step': 'exit', 'send': 'exit', 'expect': [{'eof': True, 'end': True}]},
+    },
+}
+
+BUILTIN = {'install': INSTALL_DIALOG, 'cli': CLI_DIALOG}
+
+
+class Dialog(object):
+    """
+    A dialog compiled into one PatternMatcher and a rule table per state, see compile_dialog()
+    """
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get('states'), dict) or not spec['states']:
+            raise ValueError("a dialog needs a dict of states")
+        self.start = spec.get('start')
+        if self.start not in spec['states']:
+            raise ValueError("dialog start '{0}' is not one of its states".format(self.start))
+        self.states = dict((name, compile_state(spec['states'], name)) for name in spec['states'])
+        for name, state in self.states.items():
+            targets = [state['next'], state['done']] + [rule['next'] for rules in state['table'] for rule in rules]
+            for target in targets:
+                if target is not None and target not in self.states:
+                    raise ValueError("dialog state '{0}' goes to unknown state '{1}'".format(name, target))
+
+    def run(self, child, variables):
+        """
+        Drive child from the start state until a rule ends the dialog, returns the variables it ended with.
+        Raises RuntimeError for a rule that fails and pexpect.EOF or TIMEOUT when no rule handles them.
+        """
+        variables = dict(variables)
+        # How far each send_each list has been sent
+        sent = {}
+        name = self.start
+        entered = True
+        while True:
+            state = self.states[name]
+            if entered:
+                if state['step'] is not None:
+                    mark(child, state['step'])
+                if state['set_delay']:
+                    child.delaybeforesend = state['delaybeforesend']
+                if state['send_each'] is not None:
+                    items = variables.get(state['send_each']) or []
+                    position = sent.get(state['send_each'], 0)
+                    if position >= len(items):
+                        name = state['done']
+                        continue
+                    sent[state['send_each']] = position + 1
+                    if state['item'] is not None:
+                        variables[state['item']] = items[position]
+                    child.sendline(items[position])
+                if state['send'] is not None:
+                    child.sendline(formatted(state['send'], variables, name))
+            timeout = state['timeout']
+            if isinstance(timeout, str):
+                if timeout not in variables:
+                    raise RuntimeError("dialog state '{0}' waits for timeout '{1}', which is not a variable".format(
+                        name, timeout))
+                timeout = variables[timeout]
+            i = expect(child, state['matcher'], -1 if timeout is None else timeout)
+            if i == state['matcher'].eof_index:
+                variables.update(exit_variables(child))
+            for rule in state['table'][i]:
+                if all(bool(variables.get(variable)) == wanted for variable, wanted in rule['when']):
+                    break
+            else:
+                # Nothing applies, keep waiting in this state
+                entered = False
+                continue
+            match = child.after if isinstance(child.after, (str, bytes)) else ''
+            if rule['capture'] is not None:
+                value = (child.before if rule['from'] == 'before' else match).strip()
+                if rule['extract'] is not None:
+                    found = rule['extract'].search(value)
+                    value = found.group(1) if found else value
+                if rule['word'] is not None:
+                    value = nth_word(value, rule['word'], name)
+                variables[rule['capture']] = value
+            if rule['append'] is not None:
+                variables[rule['append']] = list(variables.get(rule['append']) or []) + [match.strip()]
+            if rule['error']:
+                progress_event(child, 'error', text=match)
+            variables.update(rule['set'])
+            if rule['send'] is not None:
+                child.sendline(formatted(rule['send'], variables, name))
+            if rule['fail'] is not None:
+                raise RuntimeError(formatted(rule['fail'], dict(variables, match=match.strip()), name))
+            if rule['end']:
+                mark(child, None)
+                return variables
+            entered = rule['next'] is not None
+            if entered:
+                name = rule['next']
+            elif state['next'] is not None:
+                name = state['next']
+                entered = True
+
+
+def compile_state(states, name):
+    """
+    The matcher and rule table of one state, with the rules of the states it extends after its own
+    """
+    state = states[name]
+    check_keys(state, STATE_KEYS, "dialog state '{0}'".format(name))
+    if state.get('send_each') is not None and state.get('done') is None:
+        raise ValueError("dialog state '{0}' has send_each without done".format(name))
+    timeout = state.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float, str, type(u'')))):
+        raise ValueError("dialog state '{0}' has timeout {1!r}, not seconds or a variable name".format(name, timeout))
+    check_template(state.get('send'), name)
+    rules = []
+    chain = [name]
+    extended = state
+    while True:
+        rules.extend(extended.get('expect') or [])
+        base = extended.get('extends')
+        if base is None:
+            break
+        if base in chain or base not in states:
+            raise ValueError("dialog state '{0}' extends '{1}', which is unknown or extends it".format(name, base))
+        chain.append(base)
+        extended = states[base]
+    patterns = []
+    table = []
+    for rule in rules:
+        check_keys(rule, RULE_KEYS, "a rule of dialog state '{0}'".format(name))
+        if rule.get('word') is not None and (isinstance(rule['word'], bool) or not isinstance(rule['word'], int)):
+            raise ValueError("a rule of dialog state '{0}' has word {1!r}, not a number".format(name, rule['word']))
+        check_template(rule.get('send'), name)
+        check_template(rule.get('fail'), name)
+        if rule.get('eof'):
+            pattern = pexpect.EOF
+        elif rule.get('timeout'):
+            pattern = pexpect.TIMEOUT
+        elif isinstance(rule.get('pattern'), (str, type(u''))) and rule['pattern']:
+            pattern = rule['pattern']
+        else:
+            raise ValueError("every rule of dialog state '{0}' needs a pattern, eof or timeout".format(name))
+        # Rules for the same pattern share its index and are told apart by when
+        if pattern not in patterns:
+            patterns.append(pattern)
+            table.append([])
+        when = rule.get('when') or []
+        if isinstance(when, str):
+            when = [when]
+        table[patterns.index(pattern)].append({
+            'when': [(variable.lstrip('!'), not variable.startswith('!')) for variable in when],
+            'capture': rule.get('capture'), 'extract': re.compile(rule['extract']) if rule.get('extract') else None,
+            'word': rule.get('word'), 'from': rule.get('from', 'after'),
+            'append': rule.get('append'), 'error': bool(rule.get('error')), 'set': dict(rule.get('set') or {}),
+            'send': rule.get('send'),
+            'fail': rule.get('fail'), 'end': bool(rule.get('end')), 'next': rule.get('next')})
+    if not patterns:
+        raise ValueError("dialog state '{0}' has nothing to expect".format(name))
+    return {'matcher': PatternMatcher(patterns), 'table': table, 'timeout': state.get('timeout'),
+            'step': state.get('step'), 'send': state.get('send'), 'send_each': state.get('send_each'),
+            'item': state.get('item'), 'done': state.get('done'), 'next': state.get('next'),
+            'set_delay': 'delaybeforesend' in state, 'delaybeforesend': state.get('delaybeforesend')}
+
+
+def exit_variables(child, timeout=EXIT_WAIT):
+    """
+    How a child whose output just ended exited, waiting up to timeout for it to go away: exitstatus,
+    signalstatus, clean_exit when it exited with 0 and exited for a message
+    """
+    deadline = time.time() + timeout
+    alive = child.isalive()
+    while alive and time.time() < deadline:
+        time.sleep(0.01)
+        alive = child.isalive()
+    if alive:
+        exited = 'closed its output without exiting'
+    elif child.signalstatus is not None:
+        exited = 'was killed by signal {0}'.format(child.signalstatus)
+    else:
+        exited = 'exited with {0}'.format(child.exitstatus)
+    return {'exitstatus': child.exitstatus, 'signalstatus': child.signalstatus,
+            'clean_exit': not alive and child.exitstatus == 0, 'exited': exited}
+
+
+def check_keys(spec, allowed, what):
+    if not isinstance(spec, dict):
+        raise ValueError("{0} is not a dict".format(what))
+    unknown = set(spec) - allowed
+    if unknown:
+        raise ValueError("{0} has unknown keys {1}".format(what, sorted(unknown)))
+
+
+def check_template(template, name):
+    """
+    Raise ValueError for a send or fail template that can't be formatted whatever the variables are
+    """
+    if template is None:
+        return
+    try:
+        fields = [field for text, field, spec, conversion in string.Formatter().parse(template) if field is not None]
+    except ValueError as err:
+        raise ValueError("dialog state '{0}' has an invalid template {1!r}: {2}".format(name, template, err))
+    for field in fields:
+        if not field or field[0].isdigit():
+            raise ValueError("dialog state '{0}' has a template {1!r} with a positional field, name a variable "
+                             "instead".format(name, template))
+
+
+def formatted(template, variables, name):
+    """
+    template.format() with the variables, bytes are decoded so they read the same as text in a message.
+    name is the state, a template using a variable that isn't set is a RuntimeError saying where.
+    """
+    values = dict((key, value.decode('utf-8', 'replace') if isinstance(value, bytes) else value)
+                  for key, value in variables.items())
+    try:
+        return template.format(**values)
+    except KeyError as err:
+        raise RuntimeError("dialog state '{0}' formats {1!r}, but {2} is not a variable".format(name, template, err))
+    except (IndexError, AttributeError) as err:
+        raise RuntimeError("dialog state '{0}' can't format {1!r}: {2}".format(name, template, err))
+
+
+def nth_word(value, word, name):
+    words = value.split()
+    if not -len(words) <= word < len(words):
+        raise RuntimeError("dialog state '{0}' captures word {1} of {2!r}, which has {3} words".format(
+            name, word, value, len(words)))
+    return words[word]
+
+
+def compile_dialog(spec):
+    """
+    The compiled Dialog for spec, built once per process for every distinct spec
+    """
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+    if digest not in _compiled:
+        _compiled[digest] = Dialog(spec)
+    return _compiled[digest]
+
+
+def load_dialog(dialog):
+    """
+    A dialog spec given as a dict, the name of a built-in one or the path of a JSON or YAML file holding one
+    """
+    if isinstance(dialog, dict):
+        return dialog
+    if dialog in BUILTIN:
+        return BUILTIN[dialog]
+    path = os.path.expanduser(dialog)
+    with open(path) as dialog_file:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            return yaml.safe_load(dialog_file)
+        return json.load(dialog_file)
+
+
+def run_dialog(child, dialog, variables):
+    """
+    Compile dialog if needed and run it on child, returns the variables it ended with
+    """
+    if not isinstance(dialog, Dialog):
+        dialog = compile_dialog(load_dialog(dialog))
+    return dialog.run(child, variables)
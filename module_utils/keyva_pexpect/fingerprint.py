@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+State fingerprints so an installer that already ran is not started again.
+
+After a successful install we record a fingerprint of everything the result depends on:
+    - the installer itself, by path and a sha256 of its content
+    - the module parameters that change what gets installed (never the password)
+    - the marker files the install leaves behind, e.g. /tmp/pexpect_mock_demo for mock_install.sh
+A later run whose fingerprint still matches can return changed=false without spawning anything.
+
+The record is thrown away, and the installer runs again, when:
+    - the installer file is replaced or edited
+    - any of the parameters change
+    - a marker file is removed or modified
+    - the record is older than max_age seconds, when a max_age is given
+    - the installer fails, or the caller forces a run
+Hashing a big installer on every run would cost as much as we save, so the content hash is only
+recomputed when the size, mtime or inode of the file changed since it was recorded.
+"""
+import hashlib
+import json
+import os
+import time
+
+from .state import state_path, load_json, save_json, remove
+
+KIND = 'install_fingerprint'
+
+
+def record_path(state_dir, script_path):
+    return state_path(state_dir, KIND, os.path.abspath(script_path))
+
+
+def file_stat(path):
+    """
+    The parts of a file's stat that change when it is replaced or modified, None when it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as installer:
+        for block in iter(lambda: installer.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def installer_state(script_path, previous=None):
+    stat = file_stat(script_path)
+    if stat is None:
+        return None
+    if previous is not None and previous.get('stat') == stat:
+        # Same file as last time, skip reading it again
+        return previous
+    return {'stat': stat, 'sha256': file_sha256(script_path)}
+
+
+def fingerprint(installer, params, markers):
+    data = json.dumps({'installer': installer['sha256'], 'params': params,
+                       'markers': sorted(markers.items())}, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def check(state_dir, script_path, params, markers, max_age=0):
+    """
+    Returns the saved record when the install it describes is still in place, otherwise None
+    """
+    path = record_path(state_dir, script_path)
+    record = load_json(path)
+    if record is None:
+        return None
+    if max_age and time.time() - record['time'] > max_age:
+        return None
+    installer = installer_state(script_path, record.get('installer'))
+    if installer is None:
+        return None
+    marker_stats = dict((marker, file_stat(marker)) for marker in markers)
+    if any(stat is None for stat in marker_stats.values()):
+        # Something removed what the installer left behind, it has to run again
+        return None
+    if fingerprint(installer, params, marker_stats) != record['fingerprint']:
+        return None
+    return record
+
+
+def save(state_dir, script_path, params, markers, result):
+    """
+    Record a successful install. Does nothing when a marker is missing, the install can't be proven then.
+    """
+    installer = installer_state(script_path)
+    marker_stats = dict((marker, file_stat(marker)) for marker in markers)
+    if installer is None or any(stat is None for stat in marker_stats.values()):
+        invalidate(state_dir, script_path)
+        return None
+    record = {'time': time.time(), 'installer': installer, 'markers': marker_stats, 'result': result,
+              'fingerprint': fingerprint(installer, params, marker_stats)}
+    save_json(record_path(state_dir, script_path), record)
+    return record
+
+
+def invalidate(state_dir, script_path):
+    remove(record_path(state_dir, script_path))
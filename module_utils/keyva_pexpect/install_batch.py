@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Run several installers at once, each in a process of its own, in the order their depends_on allow.
+
+The install dialog blocks on every expect, so instead of rewriting it for an event loop like cli_async.py does
+for myscript, every installer is run by a forked copy of the module that sends its result back over a pipe.
+At most concurrency of them run at the same time. An installer starts as soon as everything it depends on
+finished successfully, so a batch takes about as long as its slowest chain of dependencies rather than the sum
+of all installs. When an installer fails, everything that depends on it directly or through others is not
+started at all and gets failed and skipped instead. Installers that don't depend on it carry on.
+"""
+import json
+import os
+import select
+import signal
+import sys
+import time
+
+
+class Installer(object):
+    """
+    One installer of the batch while it runs, the forked process and what it has sent back so far
+    """
+
+    def __init__(self, spec, pid, fd, start):
+        self.spec = spec
+        self.pid = pid
+        self.fd = fd
+        self.start = start
+        self.data = []
+
+
+def plan_installers(installers):
+    """
+    Check the names and depends_on of installers, returns a dict of name to the set of names it depends on.
+    Raises ValueError for a duplicate name, an unknown dependency or a dependency cycle.
+    """
+    depends = {}
+    for installer in installers:
+        if installer['name'] in depends:
+            raise ValueError("installer name '{0}' is used more than once".format(installer['name']))
+        depends[installer['name']] = set(installer.get('depends_on') or [])
+    for name in depends:
+        unknown = sorted(depends[name] - set(depends))
+        if unknown:
+            raise ValueError("installer '{0}' depends on unknown installer '{1}'".format(name, unknown[0]))
+    # Take away installers with nothing left to wait for until none are left, what remains is in a cycle
+    waiting = dict((name, set(names)) for name, names in depends.items())
+    while waiting:
+        ready = [name for name, names in waiting.items() if not names]
+        if not ready:
+            raise ValueError("installers depend on each other in a cycle: {0}".format(
+                ', '.join(sorted(waiting))))
+        for name in ready:
+            del waiting[name]
+        for names in waiting.values():
+            names.difference_update(ready)
+    return depends
+
+
+def dependents(depends, name):
+    """
+    Every installer that depends on name, directly or through other installers
+    """
+    found = set()
+    todo = [name]
+    while todo:
+        current = todo.pop()
+        for other, names in depends.items():
+            if current in names and other not in found:
+                found.add(other)
+                todo.append(other)
+    return found
+
+
+def run_batch(installers, run, concurrency=4):
+    """
+    Call run(installer) for every installer in a forked process and return one result dict per installer in the
+    same order. run returns a JSON serializable dict with failed set, an exception it raises is a failure too.
+    Every result gets name, path, start_s and duration_s, and skipped when it was not started.
+    """
+    depends = plan_installers(installers)
+    specs = dict((installer['name'], installer) for installer in installers)
+    results = {}
+    running = {}
+    batch_start = time.time()
+    try:
+        while len(results) < len(installers):
+            # Start what is ready in the order given, as long as there is room
+            for installer in installers:
+                name = installer['name']
+                if len(running) >= max(1, concurrency):
+                    break
+                if name in results or name in running:
+                    continue
+                if all(results.get(other, {}).get('failed') is False for other in depends[name]):
+                    running[name] = start(installer, run)
+            ready, _, _ = select.select([job.fd for job in running.values()], [], [])
+            for name, job in list(running.items()):
+                if job.fd not in ready:
+                    continue
+                data = os.read(job.fd, 65536)
+                if data:
+                    job.data.append(data)
+                    continue
+                del running[name]
+                results[name] = finish(job, batch_start)
+                if results[name]['failed']:
+                    for other in dependents(depends, name):
+                        if other not in results:
+                            results[other] = dict(name=other, path=specs[other]['path'], failed=True,
+                                                  skipped=True, changed=False,
+                                                  msg="not run, it depends on installer '{0}' which failed".format(
+                                                      name))
+    finally:
+        # Only when we are failing ourselves, don't leave installers running with nobody to collect them
+        for job in running.values():
+            try:
+                os.kill(job.pid, signal.SIGTERM)
+                os.waitpid(job.pid, 0)
+            except OSError:
+                pass
+            os.close(job.fd)
+    return [results[installer['name']] for installer in installers]
+
+
+def start(installer, run):
+    """
+    Fork a process that calls run(installer) and writes the result to a pipe as JSON
+    """
+    read_fd, write_fd = os.pipe()
+    # Anything still buffered would be written twice, once by each process
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                result = run(installer)
+            except Exception as err:
+                result = dict(failed=True, msg="{0}: {1}".format(type(err).__name__, err))
+            data = json.dumps(result).encode('utf-8')
+            while data:
+                data = data[os.write(write_fd, data):]
+        except BaseException:
+            status = 1
+        finally:
+            # Skip the exit handlers of the module, the parent still owns stdout
+            os._exit(status)
+    os.close(write_fd)
+    return Installer(installer, pid, read_fd, time.time())
+
+
+def finish(job, batch_start):
+    """
+    Collect the process of a job whose pipe was closed and turn what it sent into its result
+    """
+    os.close(job.fd)
+    _, status = os.waitpid(job.pid, 0)
+    end = time.time()
+    try:
+        result = json.loads(b''.join(job.data).decode('utf-8'))
+    except ValueError:
+        if os.WIFSIGNALED(status):
+            reason = "was killed by signal {0}".format(os.WTERMSIG(status))
+        else:
+            reason = "exited with {0}".format(os.WEXITSTATUS(status))
+        result = dict(failed=True, msg="the process running the installer {0} before it sent a result".format(
+            reason))
+    result.update(name=job.spec['name'], path=job.spec['path'], start_s=round(job.start - batch_start, 3),
+                  duration_s=round(end - job.start, 3))
+    result.setdefault('changed', False)
+    return result
+
+
+def schedule_summary(installers, results, elapsed):
+    """
+    How long the batch took against running the installers one after the other, and its critical path: the chain
+    of dependencies with the longest total duration, which is as fast as the batch can get
+    """
+    depends = plan_installers(installers)
+    # Installers that were skipped took no time and are left out of the path
+    durations = dict((result['name'], result['duration_s']) for result in results if not result.get('skipped'))
+    longest = {}
+
+    def chain(name):
+        if name not in longest:
+            before = max([chain(other) for other in depends[name]] or [(0.0, [])])
+            if name in durations:
+                longest[name] = (before[0] + durations[name], before[1] + [name])
+            else:
+                longest[name] = before
+        return longest[name]
+
+    total, path = max([chain(installer['name']) for installer in installers] or [(0.0, [])])
+    return {'elapsed_s': round(elapsed, 3), 'serial_s': round(sum(durations.values()), 3),
+            'critical_path': path, 'critical_path_s': round(total, 3)}
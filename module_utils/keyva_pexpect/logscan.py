@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental scanning of the logfiles our programs append to, like /tmp/pexpect_mock_demo.YYYYMMDD.log.
+
+Those logs only ever grow during a day, so reading them in full after every run gets slower with each run.
+scan() remembers how far it got in a small index under the state dir, keyed by the logfile path:
+    - the byte offset just after the last complete line it scanned
+    - the inode of the file
+    - a sha1 of the last bytes before that offset
+and on the next call maps only the part appended since then. When the file was replaced (new inode), truncated
+(shorter than the offset) or rewritten in place (the bytes before the offset changed) it starts from the top.
+A line that is still being written is left for the next call.
+
+The appended region is mmapped and searched with a PatternMatcher, so the regex engine walks the new data
+without copying it and only the lines that match are decoded.
+"""
+import hashlib
+import mmap
+import os
+import time
+
+from .matcher import PatternMatcher
+from .state import state_path, load_json, save_json
+
+KIND = 'logscan'
+DEFAULT_LOG_PATTERNS = [r'ERROR', r'(?i)warn']
+# Bytes before the offset that have to be unchanged for the file to count as the one we scanned before
+SIGNATURE_SIZE = 64
+
+
+def index_path(state_dir, logfile):
+    return state_path(state_dir, KIND, os.path.abspath(logfile))
+
+
+def signature(log, offset):
+    start = max(0, offset - SIGNATURE_SIZE)
+    log.seek(start)
+    return hashlib.sha1(log.read(offset - start)).hexdigest()
+
+
+def scan(state_dir, logfile, patterns=None, max_lines=200, warn=None):
+    """
+    Scan what was appended to logfile since the last scan, returns a dict with the matching lines and where
+    the scan started and ended. Returns None when the logfile does not exist.
+    When the index can't be saved the lines are still returned and warn, e.g. module.warn, is called with why.
+    """
+    if isinstance(logfile, bytes):
+        logfile = logfile.decode('utf-8')
+    matcher = PatternMatcher(DEFAULT_LOG_PATTERNS if patterns is None else patterns)
+    path = index_path(state_dir, logfile)
+    try:
+        log = open(logfile, 'rb')
+    except (IOError, OSError):
+        return None
+    with log:
+        st = os.fstat(log.fileno())
+        index = load_json(path) or {}
+        start = index.get('offset', 0)
+        restarted = False
+        if start and (index.get('inode') != st.st_ino or st.st_size < start or
+                      signature(log, start) != index.get('signature')):
+            # Rotated, truncated or rewritten, none of what we scanned before is there any more
+            start = 0
+            restarted = True
+        lines, dropped, end = scan_region(log, start, st.st_size, matcher, max_lines)
+        try:
+            save_json(path, {'time': time.time(), 'inode': st.st_ino, 'offset': end,
+                             'signature': signature(log, end)})
+        except (IOError, OSError) as err:
+            if warn is not None:
+                warn("Unable to save where the scan of '{0}' ended, the next scan repeats these lines: {1}".format(
+                    logfile, err))
+    return {'lines': lines, 'lines_dropped': dropped, 'start': start, 'end': end, 'bytes': end - start,
+            'restarted': restarted}
+
+
+def scan_region(log, start, size, matcher, max_lines):
+    """
+    The lines matching matcher between start and the last newline before size, plus how many matching lines
+    didn't fit in max_lines and the offset the next scan starts at
+    """
+    if size <= start:
+        return [], 0, start
+    # mmap offsets have to be a multiple of the allocation granularity
+    map_start = start - start % mmap.ALLOCATIONGRANULARITY
+    region = mmap.mmap(log.fileno(), size - map_start, offset=map_start, access=mmap.ACCESS_READ)
+    try:
+        first = start - map_start
+        # Stop at the last complete line, the rest may still be written
+        last = region.rfind(b'\n', first) + 1
+        if last <= 0:
+            return [], 0, start
+        lines = []
+        dropped = 0
+        position = first
+        while position < last:
+            found = matcher.find(region, position, last)
+            if found is None:
+                break
+            line_start = region.rfind(b'\n', first, found[1]) + 1 or first
+            line_end = region.find(b'\n', found[1], last)
+            if line_end < 0:
+                break
+            if len(lines) < max_lines:
+                lines.append(region[line_start:line_end].strip().decode('utf-8', 'replace'))
+            else:
+                dropped += 1
+            position = line_end + 1
+        return lines, dropped, map_start + last
+    finally:
+        region.close()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+A single pass matcher for the pattern lists we hand to expect.
+
+pexpect's own searcher runs every regex in the list over the whole buffer each time a read comes in.
+PatternMatcher compiles a list once into one combined regex plus a list of literal strings and only searches
+the data that arrived since the last search, plus as much before it as a match could start at, so matching
+no longer grows with the buffer. pexpect's expect loop still copies the whole buffer to hand it to us after
+every read, that copy is left as it is unless the child is a RingSpawn, see ring_spawn.py.
+
+It follows the same rules as child.expect(): the earliest match in the buffer wins, ties go to the pattern
+listed first, and pexpect.EOF / pexpect.TIMEOUT may be put in the list. Patterns without regex syntax, after
+escapes like '\\:' are taken off, skip the regex engine and are found with a plain substring search.
+Use it through expect():
+
+    PROMPTS = PatternMatcher([r"Enter password\\:", '>'])
+    i = expect(child, PROMPTS)
+
+child.after and child.before work as usual. child.match is the match of the combined regex, so use
+child.match.group(0) rather than numbered groups.
+"""
+import re
+
+import pexpect
+
+# Characters that make a pattern a regex unless they are escaped
+REGEX_CHARS = '.^$*+?{}[]|()'
+# Global flags at the start of a pattern like (?i), these have to be scoped once patterns are combined
+LEADING_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+# Name of the group wrapping each pattern in the combined regex, followed by the pattern index
+GROUP_PREFIX = '_keyva_'
+
+
+class PatternMatcher(object):
+    """
+    Compiled form of an expect pattern list, built once and reused for every expect call.
+    Create one per pattern list at module level or before a loop, not per expect call.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.eof_index = -1
+        self.timeout_index = -1
+        self.literals = []
+        regexes = []
+        for n, pattern in enumerate(self.patterns):
+            if pattern is pexpect.EOF:
+                self.eof_index = n
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = n
+            elif not isinstance(pattern, (str, bytes)):
+                # Already compiled regexes keep their own flags
+                regexes.append((n, pattern.pattern, pattern.flags))
+            elif as_literal(pattern) is None:
+                regexes.append((n, pattern, 0))
+            else:
+                self.literals.append((n, as_literal(pattern)))
+        self.regexes = regexes
+        # How far before the fresh data a literal match could have started
+        self.longest_literal = max([len(s) for n, s in self.literals] or [0])
+        # A regex match can only start before the fresh data if it can span a line break, when none of the
+        #   patterns can we only rescan from the start of the last line instead of the whole buffer.
+        self.line_local = all(line_local(p, f) for n, p, f in regexes)
+        self._compiled = {}
+
+    def __str__(self):
+        lines = ['PatternMatcher:']
+        for n, pattern in enumerate(self.patterns):
+            if pattern is pexpect.EOF:
+                lines.append('    {0}: EOF'.format(n))
+            elif pattern is pexpect.TIMEOUT:
+                lines.append('    {0}: TIMEOUT'.format(n))
+            else:
+                lines.append('    {0}: {1!r}'.format(n, getattr(pattern, 'pattern', pattern)))
+        return '\n'.join(lines)
+
+    def compiled(self, string_type):
+        """
+        The combined regex and literals for str or bytes buffers, built the first time each is needed
+        """
+        if string_type not in self._compiled:
+            literals = [(n, coerce(s, string_type)) for n, s in self.literals]
+            combined = None
+            separate = []
+            if self.regexes:
+                parts = [named_group(n, scope_flags(pattern, flags, string_type), string_type)
+                         for n, pattern, flags in self.regexes]
+                try:
+                    combined = re.compile(coerce('|', string_type).join(parts))
+                except re.error:
+                    # Patterns that can't share one regex, e.g. the same group name used twice, are run one by one
+                    separate = [(n, re.compile(coerce(pattern, string_type), flags))
+                                for n, pattern, flags in self.regexes]
+            self._compiled[string_type] = (combined, separate, literals)
+        return self._compiled[string_type]
+
+    def rescan_start(self, buffer, fresh_start):
+        """
+        Where a search must start so that no match overlapping the fresh data is missed
+        """
+        start = fresh_start
+        if self.literals:
+            start = min(start, fresh_start - self.longest_literal + 1)
+        if self.regexes:
+            if self.line_local:
+                newline = b'\n' if isinstance(buffer, (bytes, bytearray)) else '\n'
+                start = min(start, buffer.rfind(newline, 0, fresh_start) + 1)
+            else:
+                start = 0
+        return max(0, start)
+
+    def find(self, buffer, start=0, end=None):
+        """
+        Find the earliest match in buffer[start:end], returns (index, match_start, match_end, match) or None.
+        The buffer may be str, bytes or a bytearray, nothing is copied.
+        """
+        if end is None:
+            end = len(buffer)
+        combined, separate, literals = self.compiled(str if isinstance(buffer, str) else bytes)
+        best = None
+        if combined is not None:
+            match = combined.search(buffer, start, end)
+            if match is not None:
+                best = (int(match.lastgroup[len(GROUP_PREFIX):]), match.start(), match.end(), match)
+        for n, regex in separate:
+            match = regex.search(buffer, start, end)
+            if match is not None and (best is None or match.start() < best[1]):
+                best = (n, match.start(), match.end(), match)
+        for n, literal in literals:
+            # A literal can only win if it starts before the best match so far
+            limit = end if best is None else min(end, best[1] + len(literal))
+            position = buffer.find(literal, start, limit)
+            if position < 0:
+                continue
+            if best is None or position < best[1] or (position == best[1] and n < best[0]):
+                best = (n, position, position + len(literal), literal)
+        return best
+
+
+class Searcher(object):
+    """
+    The searcher interface pexpect's expect loop calls with the buffer after every read.
+    A new one is made for every expect call so one PatternMatcher can be shared between threads.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.eof_index = matcher.eof_index
+        self.timeout_index = matcher.timeout_index
+        self.start = self.end = self.match = None
+
+    def __str__(self):
+        return str(self.matcher)
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        fresh_start = len(buffer) - freshlen
+        start = self.matcher.rescan_start(buffer, fresh_start)
+        if searchwindowsize:
+            start = max(start, len(buffer) - searchwindowsize)
+        found = self.matcher.find(buffer, start)
+        if found is None:
+            return -1
+        index, self.start, self.end, self.match = found
+        return index
+
+
+def expect(child, matcher, timeout=-1):
+    """
+    child.expect() for a PatternMatcher, returns the index of the pattern that matched
+    """
+    # Like child.expect(), -1 means the child's own timeout
+    if timeout == -1:
+        timeout = child.timeout
+    return child.expect_loop(Searcher(matcher), timeout)
+
+
+def coerce(pattern, string_type):
+    if string_type is bytes and not isinstance(pattern, bytes):
+        return pattern.encode('utf-8')
+    if string_type is str and isinstance(pattern, bytes):
+        return pattern.decode('utf-8')
+    return pattern
+
+
+def as_literal(pattern):
+    """
+    The plain text a pattern matches when it has no regex syntax once escapes are removed, otherwise None
+    """
+    text = coerce(pattern, str)
+    literal = []
+    escaped = False
+    for c in text:
+        if escaped:
+            # Escapes like \d or \n mean something to the regex engine, escaped punctuation is just text
+            if c.isalnum():
+                return None
+            literal.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in REGEX_CHARS:
+            return None
+        else:
+            literal.append(c)
+    if escaped:
+        return None
+    return coerce(''.join(literal), type(pattern))
+
+
+def named_group(n, pattern, string_type):
+    return coerce('(?P<{0}{1}>'.format(GROUP_PREFIX, n), string_type) + pattern + coerce(')', string_type)
+
+
+def scope_flags(pattern, flags, string_type):
+    """
+    Turn leading global flags like (?i) and flags from a compiled pattern into a scoped group
+    """
+    text = coerce(pattern, str)
+    inline = ''
+    found = LEADING_FLAGS.match(text)
+    if found:
+        inline = found.group(1)
+        text = text[found.end():]
+    for flag, letter in ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'), (re.VERBOSE, 'x')):
+        if flags & flag and letter not in inline:
+            inline += letter
+    # Only these can be scoped, the rest of the global flags don't change what our patterns match
+    inline = ''.join(c for c in inline if c in 'imsx')
+    if inline:
+        text = '(?{0}:{1})'.format(inline, text)
+    return coerce(text, string_type)
+
+
+def line_local(pattern, flags):
+    """
+    True when a match of the pattern can not contain a line break except as its last character
+    """
+    text = coerce(pattern, str)
+    found = LEADING_FLAGS.match(text)
+    if flags & re.DOTALL or (found and 's' in found.group(1)) or '(?s' in text:
+        return False
+    body = text[:-2] if text.endswith('\\n') else text
+    # These can all match a line break
+    for token in ('\\n', '\\s', '\\W', '\\D', '[^', '\n'):
+        if token in body:
+            return False
+    return True
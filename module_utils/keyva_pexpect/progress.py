@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+A live feed of what a module is doing with its program, for watching long installs while the task still runs.
+
+ProgressStream.attach() wraps send, read_nonblocking, expect_loop and close on one child, the same way a
+Timeline does, and appends one line of JSON per event to a file or a FIFO on the host:
+
+    {"t": 1700000000.123, "session": "3f2a...", "seq": 4, "event": "match", "step": "install",
+     "pattern": "(?i)do you wish to continue", "text": "Do you wish to continue", "bytes": 5120}
+
+The events are start, step, send (the length only, sent text is never written), match, timeout, eof, error,
+output (how many bytes the program printed so far, at most once per interval while it prints), close and
+end with the outcome. Every line has the session id so many installs can share one file.
+Lines are held in memory and written with one write() when a step starts, something goes wrong or interval
+seconds have passed, so a chatty program costs one write per interval rather than one per read. While we wait
+for a quiet program, what is held is still written once interval seconds have passed.
+
+A FIFO only gets events while something reads it. When nobody does, or the reader can't keep up, events are
+dropped and counted rather than holding up the program, and a reader that goes away stops the stream.
+Writes to a FIFO are split on line boundaries into PIPE_BUF sized chunks so lines from parallel tasks never
+interleave.
+
+To follow a stream on a host:
+    PYTHONPATH=module_utils python -m keyva_pexpect.progress --follow /var/tmp/installs.jsonl
+    PYTHONPATH=module_utils python -m keyva_pexpect.progress --status /var/tmp/installs.jsonl
+"""
+import argparse
+import errno
+import json
+import os
+import select
+import stat
+import sys
+import time
+import uuid
+
+import pexpect
+
+from .timeline import pattern_name
+
+DEFAULT_INTERVAL = 1.0
+# Flush early once this much is waiting, so memory stays small when events come in fast
+MAX_PENDING_BYTES = 64 * 1024
+# Matched text is cut to this many characters, a prompt is short but a regex can match a lot of output
+MAX_TEXT = 200
+# Writes up to this size to a FIFO are atomic, POSIX guarantees at least 512
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+REDACTED = '<redacted>'
+FOLLOW_POLL = 0.2
+
+
+class ProgressStream(object):
+    def __init__(self, path, module, script, redact=None, interval=DEFAULT_INTERVAL, session_id=None):
+        """
+        session_id defaults to a new one, pass the archive id to find the session in the archive later
+        """
+        self.path = path
+        self.interval = interval
+        self.redact = [secret for secret in (redact or []) if secret]
+        self.session = session_id or uuid.uuid4().hex[:16]
+        self.seq = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.flushed = time.time()
+        self.reported = self.flushed
+        self.bytes = 0
+        self.dropped = 0
+        self.current_step = None
+        self.fd = None
+        self.fifo = False
+        try:
+            self.fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+        except OSError:
+            pass
+        try:
+            if self.fifo:
+                # Never block, with no reader this fails with ENXIO and the stream stays off
+                self.fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            else:
+                self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        except OSError as err:
+            if not self.fifo or err.errno != errno.ENXIO:
+                raise
+        self.event('start', module=module, script=os.path.abspath(script), pid=os.getpid())
+        self.flush()
+
+    def attach(self, child):
+        """
+        Report every send, expect and read of child, the stream is flushed when child is closed
+        """
+        child.keyva_progress = self
+        send = child.send
+        read_nonblocking = child.read_nonblocking
+        expect_loop = child.expect_loop
+        close = child.close
+
+        def reported_send(s):
+            count = send(s)
+            self.event('send', bytes=len(s))
+            return count
+
+        def reported_read_nonblocking(size=1, timeout=-1):
+            if timeout == -1:
+                timeout = child.timeout
+            deadline = None if timeout is None else time.time() + timeout
+            data = None
+            while data is None:
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                due = self.flushed + self.interval - time.time() if self.pending else None
+                if due is not None and due <= 0:
+                    self.flush()
+                elif due is None or (remaining is not None and remaining <= due):
+                    data = read_nonblocking(size, remaining)
+                else:
+                    # Events are waiting, don't keep them back for longer than interval while the program is quiet
+                    try:
+                        data = read_nonblocking(size, due)
+                    except pexpect.TIMEOUT:
+                        self.flush()
+            self.bytes += len(data)
+            if time.time() - self.reported >= self.interval:
+                self.event('output', bytes=self.bytes)
+            return data
+
+        def reported_expect_loop(searcher, timeout=-1, searchwindowsize=-1):
+            try:
+                index = expect_loop(searcher, timeout, searchwindowsize)
+            except pexpect.TIMEOUT:
+                self.event('timeout', bytes=self.bytes, urgent=True)
+                raise
+            except pexpect.EOF:
+                self.event('eof', bytes=self.bytes, urgent=True)
+                raise
+            details = dict(pattern=pattern_name(searcher, index), bytes=self.bytes)
+            if isinstance(child.after, (str, bytes)):
+                details['text'] = self.clean(child.after)
+            self.event('match', **details)
+            return index
+
+        def reported_close(*args, **kwargs):
+            try:
+                return close(*args, **kwargs)
+            finally:
+                self.event('close', exitstatus=child.exitstatus, signalstatus=child.signalstatus, bytes=self.bytes,
+                           urgent=True)
+
+        child.send = reported_send
+        child.read_nonblocking = reported_read_nonblocking
+        child.expect_loop = reported_expect_loop
+        child.close = reported_close
+
+    def clean(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        for secret in self.redact:
+            text = text.replace(secret, REDACTED)
+        return text.strip()[:MAX_TEXT]
+
+    def step(self, name, detail=None):
+        self.current_step = name
+        details = {'name': name}
+        if detail is not None:
+            details['detail'] = self.clean('{0}'.format(detail))
+        self.event('step', urgent=True, **details)
+
+    def error(self, text):
+        """
+        An error line the module found in the output
+        """
+        self.event('error', text=self.clean(text), urgent=True)
+
+    def event(self, kind, urgent=False, **details):
+        """
+        Queue one event, urgent ones and everything queued before them are written at once
+        """
+        if self.fd is None:
+            return
+        now = time.time()
+        self.seq += 1
+        details.update(t=round(now, 3), session=self.session, seq=self.seq, event=kind)
+        if self.current_step is not None and 'step' not in details:
+            details['step'] = self.current_step
+        line = json.dumps(details, sort_keys=True) + '\n'
+        self.pending.append(line)
+        self.pending_bytes += len(line)
+        if 'bytes' in details:
+            self.reported = now
+        if urgent or self.pending_bytes >= MAX_PENDING_BYTES or now - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.fd is None or not self.pending:
+            return
+        data = ''.join(self.pending).encode('utf-8')
+        self.pending = []
+        self.pending_bytes = 0
+        self.flushed = time.time()
+        chunks = line_chunks(data, PIPE_BUF) if self.fifo else [data]
+        for n, chunk in enumerate(chunks):
+            try:
+                os.write(self.fd, chunk)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    # The reader is behind, drop what doesn't fit rather than wait for it
+                    self.dropped += sum(chunk.count(b'\n') for chunk in chunks[n:])
+                    return
+                if err.errno == errno.EPIPE:
+                    # The reader went away, nobody is watching any more
+                    self.dropped += sum(chunk.count(b'\n') for chunk in chunks[n:])
+                    self.stop()
+                    return
+                raise
+
+    def finish(self, outcome, error=None):
+        """
+        Write the end event with the outcome of the run, 'ok' or 'failed', and close the stream
+        """
+        details = dict(outcome=outcome, bytes=self.bytes, dropped=self.dropped)
+        if error is not None:
+            details['error'] = '{0}: {1}'.format(type(error).__name__,
+                                                 self.clean((str(error).splitlines() or [''])[0]))
+        self.event('end', urgent=True, **details)
+        self.stop()
+
+    def stop(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def result(self):
+        return {'path': self.path, 'session': self.session, 'events': self.seq, 'dropped': self.dropped}
+
+
+def line_chunks(data, size):
+    """
+    data split into chunks of at most size bytes that end on a line, a longer line is a chunk of its own
+    """
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = start + size
+        if end < len(data):
+            newline = data.rfind(b'\n', start, end)
+            end = newline + 1 if newline >= start else data.find(b'\n', end) + 1 or len(data)
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def progress_event(child, kind, **details):
+    """
+    Report an event on the child's progress stream, does nothing when none is attached
+    """
+    stream = getattr(child, 'keyva_progress', None)
+    if stream is None:
+        return
+    if kind == 'error':
+        stream.error(details['text'])
+    else:
+        stream.event(kind, **details)
+
+
+def read_events(path, follow=False):
+    """
+    Yield the events in a progress file or FIFO, with follow keep waiting for more like tail -f
+    """
+    fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+    with open(path, 'rb') as stream:
+        partial = b''
+        while True:
+            data = stream.readline()
+            if not data:
+                if not follow:
+                    return
+                if not fifo and os.path.getsize(path) < stream.tell():
+                    # Truncated or replaced, start over from the top
+                    stream.seek(0)
+                    partial = b''
+                time.sleep(FOLLOW_POLL)
+                continue
+            partial += data
+            if not partial.endswith(b'\n'):
+                # A line still being written
+                continue
+            line, partial = partial, b''
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+
+
+def describe(event):
+    details = ' '.join('{0}={1}'.format(key, json.dumps(value)) for key, value in sorted(event.items())
+                       if key not in ('t', 'session', 'seq', 'event', 'step'))
+    return '{0}  {1}  {2:<14} {3:<8} {4}'.format(
+        time.strftime('%H:%M:%S', time.localtime(event['t'])), event['session'], event.get('step') or '-',
+        event['event'], details)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read a keyva_pexpect progress stream')
+    parser.add_argument('path', help='progress file or FIFO')
+    parser.add_argument('--follow', '-f', action='store_true', help='keep waiting for new events')
+    parser.add_argument('--session', help='only events of this session')
+    parser.add_argument('--status', action='store_true',
+                        help='one line per session with where it is now, read up to the end of what is there')
+    parser.add_argument('--json', action='store_true', help='print the events as they are')
+    args = parser.parse_args(argv)
+    sessions = {}
+    try:
+        for event in read_events(args.path, args.follow and not args.status):
+            if args.session and event.get('session') != args.session:
+                continue
+            if args.status:
+                state = sessions.setdefault(event['session'], {'errors': 0})
+                state.update(last=event['t'], step=event.get('step', state.get('step')))
+                if event['event'] == 'start':
+                    state['script'] = event['script']
+                elif event['event'] == 'error':
+                    state['errors'] += 1
+                elif event['event'] == 'end':
+                    state['outcome'] = event['outcome']
+                if 'bytes' in event:
+                    state['bytes'] = event['bytes']
+                continue
+            print(json.dumps(event, sort_keys=True) if args.json else describe(event))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    for session, state in sorted(sessions.items(), key=lambda item: item[1]['last']):
+        print('{0}  {1:<8} {2:<14} {3:>12} bytes {4} errors  {5}'.format(
+            session, state.get('outcome', 'running'), state.get('step') or '-', state.get('bytes', 0),
+            state['errors'], state.get('script', '')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
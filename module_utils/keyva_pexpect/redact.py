@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Redaction of secrets, like the password, from output that comes in one read at a time.
+
+The programs echo what we type, so the password shows up in their output, and nothing stops it from being split
+over two reads. Redactor holds back the end of every read that could still be the start of a secret until the
+next read shows whether it is one, so a secret is always replaced whole. BoundedCapture and ArchiveSession use
+it before anything is kept.
+"""
+REDACTED = b'<redacted>'
+
+
+class Redactor(object):
+    def __init__(self, secrets=None):
+        self.secrets = [coerce(secret) for secret in (secrets or []) if secret]
+        # Output is held back by this much so a secret split over two reads is still found
+        self.keep = max([len(secret) for secret in self.secrets] or [1]) - 1
+        self.pending = b''
+
+    def feed(self, data):
+        """
+        Redacted output that is safe to keep, what could be the start of a secret stays held back
+        """
+        data = self.pending + coerce(data)
+        cut = max(0, len(data) - self.keep)
+        moved = True
+        while moved:
+            moved = False
+            for secret in self.secrets:
+                # Don't cut a secret in half, hold all of it back
+                position = data.find(secret, max(0, cut - len(secret) + 1))
+                if 0 <= position < cut < position + len(secret):
+                    cut = position
+                    moved = True
+        self.pending = data[cut:]
+        return self.redact(data[:cut])
+
+    def release(self):
+        """
+        Redacted output that was held back, once the output is complete
+        """
+        data, self.pending = self.pending, b''
+        return self.redact(data)
+
+    def redact(self, data):
+        for secret in self.secrets:
+            data = data.replace(secret, REDACTED)
+        return data
+
+
+def coerce(data):
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return data.encode('utf-8')
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+A pexpect.spawn for programs that print a lot, like installers writing gigabytes of build output.
+
+With the default spawn every read appends to an io buffer and expect then copies the whole buffer out with
+getvalue() to search it, so the work per read grows with the output and a long run ends up quadratic. Raising
+maxread and setting searchwindowsize, as people usually suggest, only works when you know how far back a
+match can start.
+
+RingSpawn keeps the output read since the last match in one bytearray. A read is appended in place, data
+consumed by a match is dropped from the front (cheap for a bytearray, it just moves its start), and the
+PatternMatcher only searches from where a match overlapping the new data could begin. The search window
+therefore comes from the patterns themselves: the start of the last line for line local regexes, the longest
+literal for plain strings, the whole kept data otherwise. Nothing is copied until a match is found, then
+child.before and child.after are cut out of the buffer once.
+
+The kept data is capped at before_size bytes so memory use stays flat however much is printed. When more
+than that arrives without a match only the last before_size bytes stay in child.before, count the rest in
+child.before_dropped. Keep the full output with logfile_read, e.g. a BoundedCapture.
+
+It always works in bytes, the way keyva_pexpect_install uses pexpect. before_text and after_text decode just
+the part you ask for. expect calls with plain pexpect patterns, expect_exact, readline and so on still work,
+they go through pexpect's own loop. Only async expect is not supported.
+"""
+import io
+import time
+
+import pexpect
+
+DEFAULT_BEFORE_SIZE = 1024 * 1024
+# Bigger reads mean fewer trips through the loop when the program prints fast
+DEFAULT_MAXREAD = 65536
+
+
+class RingSpawn(pexpect.spawn):
+    def __init__(self, command, args=[], timeout=30, maxread=DEFAULT_MAXREAD, before_size=DEFAULT_BEFORE_SIZE,
+                 text_encoding='utf-8', **kwargs):
+        if kwargs.get('encoding') is not None:
+            raise ValueError("RingSpawn works in bytes, decode with before_text or after_text instead of encoding")
+        self._pending = bytearray()
+        # True while one of pexpect's own expect loops owns the data
+        self._handed_over = False
+        self.before_size = before_size
+        self.before_dropped = 0
+        self.text_encoding = text_encoding
+        super(RingSpawn, self).__init__(command, args, timeout=timeout, maxread=maxread, **kwargs)
+
+    def _get_buffer(self):
+        if self._handed_over:
+            return self._buffer.getvalue()
+        return bytes(self._pending)
+
+    def _set_buffer(self, value):
+        if self._handed_over:
+            self._buffer = io.BytesIO()
+            self._buffer.write(value)
+        else:
+            self._pending = bytearray(value)
+
+    buffer = property(_get_buffer, _set_buffer)
+
+    @property
+    def before_text(self):
+        return self.decode(self.before)
+
+    @property
+    def after_text(self):
+        return self.decode(self.after)
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            return data.decode(self.text_encoding, 'replace')
+        return data
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+        matcher = getattr(searcher, 'matcher', None)
+        if matcher is None:
+            return self.handed_over(super(RingSpawn, self).expect_loop, searcher, timeout, searchwindowsize)
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        pending = self._pending
+        # Everything already buffered is new to this pattern list
+        found = matcher.find(pending)
+        try:
+            while found is None:
+                if timeout is not None and timeout < 0:
+                    raise pexpect.TIMEOUT('Timeout exceeded.')
+                data = self.read_nonblocking(self.maxread, timeout)
+                if self.delayafterread is not None:
+                    time.sleep(self.delayafterread)
+                fresh_start = len(pending)
+                pending += data
+                start = matcher.rescan_start(pending, fresh_start)
+                found = matcher.find(pending, start)
+                if found is None:
+                    self.trim(matcher, start)
+                if timeout is not None:
+                    timeout = end_time - time.time()
+        except pexpect.EOF as err:
+            return self.finish(searcher, searcher.eof_index, pexpect.EOF, err)
+        except pexpect.TIMEOUT as err:
+            return self.finish(searcher, searcher.timeout_index, pexpect.TIMEOUT, err)
+        except Exception:
+            self.before = bytes(pending)
+            self.after = self.match = self.match_index = None
+            raise
+        # Search once more in a copy so child.match refers to data that stays put once the buffer moves on
+        window = bytes(pending)
+        index, start, end, match = matcher.find(window, found[1])
+        del pending[:end]
+        self.before = window[:start]
+        self.after = window[start:end]
+        self.match = match
+        self.match_index = index
+        searcher.start, searcher.end, searcher.match = start, end, match
+        return index
+
+    def trim(self, matcher, search_start):
+        """
+        Drop data from the front once more than before_size bytes are kept without a match
+        """
+        pending = self._pending
+        excess = len(pending) - self.before_size
+        if excess <= 0:
+            return
+        if matcher.line_local or not matcher.regexes:
+            # Keep whatever a later match could still start in, unless a single line got absurdly long
+            if len(pending) - search_start < 2 * self.before_size:
+                excess = min(excess, search_start)
+        if excess > 0:
+            del pending[:excess]
+            self.before_dropped += excess
+
+    def finish(self, searcher, index, kind, err):
+        """
+        Set before and after for an EOF or TIMEOUT, returning index when it was expected and raising otherwise
+        """
+        self.before = bytes(self._pending)
+        if kind is pexpect.EOF:
+            del self._pending[:]
+        self.after = kind
+        if index >= 0:
+            self.match = kind
+            self.match_index = index
+            return index
+        self.match = self.match_index = None
+        exc = kind('{0}\n{1}\nsearcher: {2}'.format(err, self, searcher))
+        exc.__cause__ = None
+        raise exc
+
+    def expect_list(self, pattern_list, timeout=-1, searchwindowsize=-1, async_=False, **kw):
+        if async_ or kw.get('async'):
+            raise ValueError("RingSpawn has no async expect")
+        return self.handed_over(super(RingSpawn, self).expect_list, pattern_list, timeout, searchwindowsize)
+
+    def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1, async_=False, **kw):
+        if async_ or kw.get('async'):
+            raise ValueError("RingSpawn has no async expect")
+        return self.handed_over(super(RingSpawn, self).expect_exact, pattern_list, timeout, searchwindowsize)
+
+    def handed_over(self, call, *args):
+        """
+        Run one of pexpect's own expect loops, for patterns that aren't ours, with our buffer handed over and back
+        """
+        self._buffer = io.BytesIO()
+        self._buffer.write(bytes(self._pending))
+        self._before = io.BytesIO()
+        self._before.write(bytes(self._pending))
+        del self._pending[:]
+        self._handed_over = True
+        try:
+            return call(*args)
+        finally:
+            self._handed_over = False
+            self._pending += self._before.getvalue()
+            self._buffer = io.BytesIO()
+            self._before = io.BytesIO()
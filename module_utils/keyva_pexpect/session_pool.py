@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+A small resident broker that keeps myscript sessions logged in between tasks.
+
+The first keyva_pexpect_cli task that asks for a pooled session starts the broker in the background on the
+managed host. The broker holds pexpect children that are already sitting at the program prompt, keyed by
+(path, options), and runs each task's commands in one of them. Sessions that are idle for longer than
+idle_timeout are closed, the oldest idle session is closed to make room when max_sessions is reached and the
+broker exits on its own once it has no sessions left.
+
+The broker talks one line of JSON each way over a unix socket that only the owning user can reach.
+To try it locally against the mock CLI:
+    PYTHONPATH=module_utils python -m keyva_pexpect.session_pool --socket /tmp/pool.sock
+"""
+import errno
+import hashlib
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# The broker imports everything it will ever need up front. It is started from the AnsiballZ payload of the
+#   task that launched it and that payload is deleted as soon as the task finishes.
+import pexpect
+
+from .cli_session import login, start_config, run_session
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.ansible', 'keyva_pexpect', 'pool.sock')
+# How long a task waits for a newly started broker to start listening
+STARTUP_TIMEOUT = 10
+
+
+class PooledSession(object):
+    def __init__(self, child, logfile, password_digest):
+        self.child = child
+        self.logfile = logfile
+        self.password_digest = password_digest
+        self.last_used = time.time()
+        self.in_use = False
+
+
+class SessionBroker(object):
+    def __init__(self, socket_path, idle_timeout=300, max_sessions=8):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.last_activity = time.time()
+        # Guards the sessions dict, each session is only used by one task at a time through its in_use flag
+        self.lock = threading.Condition()
+        self.server = None
+
+    def serve_forever(self):
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                response = broker.handle(request)
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            try:
+                # Two tasks can race to start the broker, the one that loses leaves the other one running
+                send_request(self.socket_path, {'op': 'ping'}, 1)
+                return
+            except (socket.error, RuntimeError):
+                remove_socket(self.socket_path)
+        # Only the user running the tasks may talk to the broker, it holds logged in sessions
+        old_umask = os.umask(0o077)
+        try:
+            self.server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        reaper = threading.Thread(target=self.reap)
+        reaper.daemon = True
+        reaper.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.close_all()
+            remove_socket(self.socket_path)
+
+    def handle(self, request):
+        """
+        Run one task's commands in a pooled session and return the result or the error for the caller to raise
+        """
+        if request.get('op') == 'ping':
+            return {'ok': True}
+        try:
+            key, session = self.borrow(request)
+        except Exception as err:
+            return error_response(err)
+        try:
+            session.child.timeout = request['timeout']
+            current_settings, changed = run_session(session.child, request['commands'], request['pipeline'],
+                                                    request.get('diff_config', False), request.get('plan', False))
+        except Exception as err:
+            # We don't know where in the dialog the program was left so never hand this session out again
+            self.release(key, session, discard=True)
+            return error_response(err)
+        self.release(key, session)
+        return {'ok': True, 'current_settings': current_settings, 'changed': changed, 'logfile': session.logfile}
+
+    def borrow(self, request):
+        key = (request['path'], request['options'])
+        digest = hashlib.sha256(request['password'].encode('utf-8')).hexdigest()
+        with self.lock:
+            # Tasks for the same program take turns in the one session we keep for it
+            while key in self.sessions and self.sessions[key].in_use:
+                self.lock.wait()
+            session = self.sessions.get(key)
+            if session is not None and (not session.child.isalive() or session.password_digest != digest):
+                # Log in again if the program went away or the password changed since it was started
+                del self.sessions[key]
+                close_session(session)
+                session = None
+            if session is None:
+                self.make_room()
+                # Reserve the slot while we log in without holding the lock
+                session = PooledSession(None, None, digest)
+                self.sessions[key] = session
+            session.in_use = True
+            self.last_activity = time.time()
+        if session.child is None:
+            try:
+                session.child, session.logfile = spawn_session(request['path'], request['options'],
+                                                               request['password'], request['timeout'])
+            except Exception:
+                self.release(key, session, discard=True)
+                raise
+        return key, session
+
+    def release(self, key, session, discard=False):
+        with self.lock:
+            session.in_use = False
+            session.last_used = self.last_activity = time.time()
+            if discard:
+                if self.sessions.get(key) is session:
+                    del self.sessions[key]
+                close_session(session)
+            self.lock.notify_all()
+
+    def make_room(self):
+        # Called with the lock held
+        while len(self.sessions) >= self.max_sessions:
+            idle = [(s.last_used, k) for k, s in self.sessions.items() if not s.in_use]
+            if not idle:
+                raise RuntimeError("ERROR: the session pool is full, all {0} sessions are in use".format(
+                    self.max_sessions))
+            key = min(idle)[1]
+            close_session(self.sessions.pop(key))
+
+    def reap(self):
+        """
+        Close idle sessions and shut the broker down once there has been nothing to do for idle_timeout
+        """
+        while True:
+            time.sleep(max(1, min(30, self.idle_timeout / 2.0)))
+            now = time.time()
+            with self.lock:
+                for key, session in list(self.sessions.items()):
+                    if not session.in_use and now - session.last_used > self.idle_timeout:
+                        close_session(self.sessions.pop(key))
+                if not self.sessions and now - self.last_activity > self.idle_timeout:
+                    break
+        self.server.shutdown()
+
+    def close_all(self):
+        with self.lock:
+            for session in self.sessions.values():
+                close_session(session)
+            self.sessions.clear()
+
+
+def spawn_session(path, options, password, timeout):
+    """
+    Start myscript directly, log in and leave it at the program prompt
+    """
+    if not os.path.exists(path):
+        raise RuntimeError("Error: the script '{0}' does not exist!".format(path))
+    child = pexpect.spawn(path, args=shlex.split(options), encoding='utf-8')
+    try:
+        logfile = login(child, password)
+        child.timeout = timeout
+        start_config(child)
+    except Exception:
+        child.close()
+        raise
+    return child, logfile
+
+
+def close_session(session):
+    if session.child is None:
+        return
+    try:
+        # Ask the program to exit cleanly before hanging up on it
+        session.child.sendline('exit')
+        session.child.expect(pexpect.EOF, timeout=5)
+    except (pexpect.exceptions.ExceptionPexpect, OSError):
+        pass
+    session.child.close(force=True)
+
+
+def error_response(err):
+    if isinstance(err, pexpect.exceptions.ExceptionPexpect):
+        return {'ok': False, 'error_type': type(err).__name__, 'msg': str(err)}
+    return {'ok': False, 'error_type': 'RuntimeError', 'msg': str(err)}
+
+
+def run_pooled(path, options, commands, password, timeout=300, pipeline=0, socket_path=None,
+               idle_timeout=300, max_sessions=8, diff_config=False, plan=False):
+    """
+    Run commands in a pooled session, starting the broker if it is not running yet.
+    Returns (current_settings, changed, logfile) and raises the same exceptions as running the session directly.
+    """
+    socket_path = socket_path or DEFAULT_SOCKET
+    request = {'op': 'run', 'path': os.path.abspath(path), 'options': options, 'commands': commands,
+               'password': password, 'timeout': timeout, 'pipeline': pipeline, 'diff_config': diff_config,
+               'plan': plan}
+    try:
+        response = send_request(socket_path, request, timeout)
+    except socket.error as err:
+        if err.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise
+        start_broker(socket_path, idle_timeout, max_sessions)
+        response = send_request(socket_path, request, timeout)
+    if response['ok']:
+        return response['current_settings'], response['changed'], response['logfile']
+    # Raise what the broker hit so the module reports it the same way as an unpooled run
+    error_class = getattr(pexpect, response['error_type'], None) or \
+        getattr(pexpect.exceptions, response['error_type'], RuntimeError)
+    raise error_class(response['msg'])
+
+
+def send_request(socket_path, request, timeout):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Give the broker time to log in and run every command before we give up on it
+    wait = timeout * 2 + STARTUP_TIMEOUT
+    client.settimeout(wait)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        reader = client.makefile('rb')
+        line = reader.readline()
+        reader.close()
+    except socket.timeout:
+        # An OSError without an errno, tell it apart from a broker that isn't running
+        raise RuntimeError("ERROR: the session pool broker did not answer within {0}s".format(wait))
+    finally:
+        client.close()
+    if not line:
+        raise RuntimeError("ERROR: the session pool broker closed the connection without answering")
+    return json.loads(line.decode('utf-8'))
+
+
+def remove_socket(socket_path):
+    try:
+        os.unlink(socket_path)
+    except OSError as err:
+        # A broker starting or stopping at the same time got to it first
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def start_broker(socket_path, idle_timeout, max_sessions):
+    """
+    Start the broker detached from this task and wait until it answers
+    """
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    # The broker imports this package on its own from the module_utils directory it was loaded from, also when
+    #   that is a directory inside the AnsiballZ zip, and nothing else from the task's sys.path
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(package_dir)
+    bootstrap = "import sys; from {0}.session_pool import main; main(sys.argv[1:])".format(
+        os.path.basename(package_dir))
+    devnull = open(os.devnull, 'r+b')
+    try:
+        subprocess.Popen([sys.executable, '-c', bootstrap, '--socket', socket_path,
+                          '--idle-timeout', str(idle_timeout), '--max-sessions', str(max_sessions)],
+                         stdin=devnull, stdout=devnull, stderr=devnull, env=env, close_fds=True,
+                         preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+    deadline = time.time() + STARTUP_TIMEOUT
+    while True:
+        try:
+            send_request(socket_path, {'op': 'ping'}, 1)
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise RuntimeError("ERROR: the session pool broker did not start listening on "
+                                   "'{0}'".format(socket_path))
+            time.sleep(0.05)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Keep myscript sessions logged in for keyva_pexpect_cli")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--idle-timeout', type=int, default=300)
+    parser.add_argument('--max-sessions', type=int, default=8)
+    args = parser.parse_args(argv)
+    SessionBroker(args.socket, args.idle_timeout, args.max_sessions).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Small on-host state files kept between module runs, like the last config snapshot read from myscript.
+
+Everything lives under one directory per user, ~/.ansible/keyva_pexpect unless a module is given a state_dir.
+Files are JSON and are replaced atomically so a module killed halfway through never leaves a torn file.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser('~'), '.ansible', 'keyva_pexpect')
+
+
+def state_path(state_dir, kind, *key):
+    """
+    Path of the state file of a given kind for a key made of any number of strings, e.g. (path, options)
+    """
+    digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return os.path.join(state_dir or DEFAULT_STATE_DIR, kind, digest + '.json')
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError):
+        # Missing or unreadable state is the same as no state, the caller just does the slow thing
+        return default
+
+
+def save_json(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as state_file:
+            json.dump(data, state_file)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
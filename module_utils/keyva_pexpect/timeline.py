@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing of everything a module does with its pexpect child, to find out where a slow task spends its time.
+
+Timeline.attach() wraps send, read_nonblocking and expect_loop on one child object, so every send and every
+expect is recorded with how long it took, which pattern matched and how much was read, without changing the
+code that drives the child. Events are grouped into named steps like 'login', 'command' or 'save' with
+    with step(child, 'save'):
+or mark(child, 'install') in straight line code, both do nothing when no timeline is attached so the dialog
+code can always call them. They also tell a Watchdog and a ProgressStream attached to the child which step it
+is in.
+The result is a dict for the module result and optionally a Chrome trace file, open it in chrome://tracing
+or https://ui.perfetto.dev to see the steps on a time line.
+
+Profiler wraps a block in cProfile or tracemalloc and summarizes the module's own python overhead.
+Sent text is never recorded, only its length, so passwords can't end up in the results.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import pexpect
+
+# Stop recording events past this, a long command list must not turn into a huge module result
+MAX_EVENTS = 10000
+PROFILE_LINES = 25
+
+
+class Timeline(object):
+    def __init__(self, max_events=MAX_EVENTS):
+        self.start = time.time()
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.steps = []
+        self.marked = None
+        self.bytes_read = 0
+
+    def attach(self, child, spawn_start=None):
+        """
+        Record every send and expect of child. Pass the time taken before spawning to record the spawn as a step.
+        """
+        child.keyva_timeline = self
+        if spawn_start is not None:
+            self.add_step('spawn', spawn_start, time.time())
+        send = child.send
+        read_nonblocking = child.read_nonblocking
+        expect_loop = child.expect_loop
+
+        def timed_send(s):
+            start = time.time()
+            try:
+                return send(s)
+            finally:
+                self.add('send', start, bytes=len(s))
+
+        def counted_read_nonblocking(size=1, timeout=-1):
+            data = read_nonblocking(size, timeout)
+            self.bytes_read += len(data)
+            return data
+
+        def timed_expect_loop(searcher, timeout=-1, searchwindowsize=-1):
+            start = time.time()
+            bytes_before = self.bytes_read
+            try:
+                index = expect_loop(searcher, timeout, searchwindowsize)
+            except (pexpect.EOF, pexpect.TIMEOUT) as err:
+                self.add('expect', start, result=type(err).__name__, bytes=self.bytes_read - bytes_before,
+                         buffer=len(child.buffer))
+                raise
+            self.add('expect', start, index=index, pattern=pattern_name(searcher, index),
+                     bytes=self.bytes_read - bytes_before, buffer=len(child.buffer))
+            return index
+
+        child.send = timed_send
+        child.read_nonblocking = counted_read_nonblocking
+        child.expect_loop = timed_expect_loop
+
+    def add(self, kind, start, **details):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        end = time.time()
+        event = dict(details, type=kind, start=start - self.start, duration=end - start)
+        if self.steps:
+            event['step'] = self.steps[-1]
+        self.events.append(event)
+
+    def add_step(self, name, start, end, detail=None):
+        event = dict(type='step', name=name, start=start - self.start, duration=end - start,
+                     depth=len(self.steps))
+        if detail is not None:
+            event['detail'] = detail
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+        else:
+            self.events.append(event)
+        return event
+
+    @contextmanager
+    def step(self, name, detail=None):
+        self.steps.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.pop()
+            self.add_step(name, start, time.time(), detail)
+
+    def mark(self, name, detail=None):
+        """
+        Start a step that lasts until the next mark, for straight line code where a with block doesn't fit.
+        A name of None only ends the current one.
+        """
+        if self.marked is not None:
+            marked_name, marked_detail, start = self.marked
+            self.marked = None
+            self.steps.pop()
+            self.add_step(marked_name, start, time.time(), marked_detail)
+        if name is not None:
+            self.marked = (name, detail, time.time())
+            self.steps.append(name)
+
+    def summary(self):
+        """
+        Totals per step name, slowest steps first, along with totals for the sends and expects
+        """
+        steps = {}
+        for event in self.events:
+            if event['type'] != 'step':
+                continue
+            total = steps.setdefault(event['name'], {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+            total['count'] += 1
+            total['total_s'] += event['duration']
+            total['max_s'] = max(total['max_s'], event['duration'])
+        expects = [event for event in self.events if event['type'] == 'expect']
+        sends = [event for event in self.events if event['type'] == 'send']
+        return {'total_s': time.time() - self.start,
+                'steps': [dict(total, name=name) for name, total in sorted(steps.items(),
+                                                                           key=lambda item: -item[1]['total_s'])],
+                'expect_count': len(expects), 'expect_wait_s': sum(event['duration'] for event in expects),
+                'send_count': len(sends), 'send_s': sum(event['duration'] for event in sends),
+                'bytes_read': self.bytes_read, 'events_dropped': self.dropped}
+
+    def result(self):
+        self.mark(None)
+        return {'summary': self.summary(), 'events': self.events}
+
+    def chrome_trace(self):
+        """
+        The events in Chrome trace event format, steps on one row and sends and expects on another
+        """
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            args = dict((key, value) for key, value in event.items()
+                        if key not in ('type', 'name', 'start', 'duration'))
+            if event['type'] == 'step':
+                name, tid = event['name'], 1
+            else:
+                name, tid = event['type'], 2
+            trace.append({'name': name, 'cat': event['type'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                          'ts': int(event['start'] * 1000000), 'dur': int(event['duration'] * 1000000),
+                          'args': args})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+@contextmanager
+def step(child, name, detail=None):
+    """
+    Group what happens inside the block under a step when the child has a timeline attached, and tell its
+    watchdog and progress stream which step it is in.
+    The step is also kept in child.keyva_step while it runs and left there when it raises, so an error message
+    can say where the session was.
+    """
+    outer = getattr(child, 'keyva_step', None)
+    child.keyva_step = (name, detail)
+    timeline = getattr(child, 'keyva_timeline', None)
+    watchdog = getattr(child, 'keyva_watchdog', None)
+    if watchdog is not None:
+        watchdog.start_step(name)
+    progress = getattr(child, 'keyva_progress', None)
+    if progress is not None:
+        progress.step(name, detail)
+    try:
+        if timeline is None:
+            yield
+        else:
+            with timeline.step(name, detail):
+                yield
+    finally:
+        if watchdog is not None:
+            watchdog.end_step()
+    child.keyva_step = outer
+
+
+def mark(child, name, detail=None):
+    """
+    Timeline.mark() when the child has a timeline attached, Watchdog.mark() when it has a watchdog and
+    ProgressStream.step() when it has a progress stream
+    """
+    timeline = getattr(child, 'keyva_timeline', None)
+    if timeline is not None:
+        timeline.mark(name, detail)
+    watchdog = getattr(child, 'keyva_watchdog', None)
+    if watchdog is not None:
+        watchdog.mark(name)
+    progress = getattr(child, 'keyva_progress', None)
+    if progress is not None and name is not None:
+        progress.step(name, detail)
+
+
+def instrumentation(timeline, profiler, trace_path=None, watchdog=None, archive=None, progress=None,
+                    command_file=None):
+    """
+    The timeline, profile, watchdog state, archive id, progress stream and how far a commands file got to add to
+    a module result, also wanted when the task fails since that is when they help most
+    """
+    result = {}
+    if command_file is not None:
+        result['commands_file'] = command_file.result()
+    if progress is not None:
+        result['progress'] = progress.result()
+    if archive is not None:
+        result['archive_id'] = archive.id
+    if watchdog is not None:
+        result['watchdog'] = watchdog.result()
+    if timeline is not None:
+        result['timeline'] = timeline.result()
+        if trace_path:
+            timeline.save_chrome_trace(trace_path)
+            result['timeline_trace'] = trace_path
+    if profiler is not None and profiler.mode not in (None, 'none'):
+        summary = profiler.summary()
+        if summary is not None:
+            result['profile'] = summary
+    return result
+
+
+def pattern_name(searcher, index):
+    """
+    The pattern at index in one of our Searchers or one of pexpect's own searchers
+    """
+    if index == searcher.eof_index:
+        return 'EOF'
+    if index == searcher.timeout_index:
+        return 'TIMEOUT'
+    matcher = getattr(searcher, 'matcher', None)
+    if matcher is not None:
+        pattern = matcher.patterns[index]
+        return '{0}'.format(getattr(pattern, 'pattern', pattern))
+    for n, pattern in getattr(searcher, '_searches', getattr(searcher, '_strings', [])):
+        if n == index:
+            return '{0}'.format(getattr(pattern, 'pattern', pattern))
+    return None
+
+
+class Profiler(object):
+    """
+    Profile the python side of a module run with 'cprofile' or 'tracemalloc'
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.profile = None
+        self.snapshot = None
+        self.peak = None
+
+    def __enter__(self):
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.mode == 'cprofile':
+            self.profile.disable()
+        elif self.mode == 'tracemalloc':
+            import tracemalloc
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def summary(self, lines=PROFILE_LINES):
+        """
+        None when nothing was profiled, e.g. check mode answered from a saved snapshot
+        """
+        if self.mode == 'cprofile' and self.profile is not None:
+            import pstats
+            stats = pstats.Stats(self.profile).stats
+            ordered = sorted(stats.items(), key=lambda item: -item[1][3])[:lines]
+            return {'mode': 'cprofile',
+                    'functions': [{'function': '{0}:{1}({2})'.format(*func), 'calls': calls,
+                                   'total_s': total, 'cumulative_s': cumulative}
+                                  for func, (primitive, calls, total, cumulative, callers) in ordered]}
+        if self.mode == 'tracemalloc' and self.snapshot is not None:
+            return {'mode': 'tracemalloc', 'peak_bytes': self.peak,
+                    'allocations': [{'line': '{0}:{1}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                                     'bytes': stat.size, 'count': stat.count}
+                                    for stat in self.snapshot.statistics('lineno')[:lines]]}
+        return None
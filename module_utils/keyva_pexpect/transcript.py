@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Record a pexpect session to a transcript and replay it later without a pty, a fork or any waiting.
+
+Recorder.attach() wraps send, read_nonblocking and close on one child, the same way a Timeline does, and writes
+the session to a JSON file (gzipped when the path ends in .gz) when the child is closed:
+
+    {"version": 1, "command": ..., "args": [...], "encoding": null, "exitstatus": 0, "signalstatus": null,
+     "events": [[0.0123, "r", "Welcome ..."], [0.5, "s", "<redacted>\\n"], [0.001, "eof"]]}
+
+Every event holds the seconds since the event before it: r is output read from the program, s is what we sent
+and eof is the program going away. Text the recorder is told to redact, like the password, never ends up in
+the file.
+
+ReplaySpawn plays a transcript back through the normal expect API, child.expect(), the PatternMatcher expect(),
+read_nonblocking and so on. Output recorded after a send only shows up once that send was made, so the dialog
+code has to drive the replay the same way it drove the program. A send that differs from the recorded one
+raises TranscriptMismatch, which is how a change to the dialog shows up.
+Replay runs on a virtual clock: a read that would have waited longer than the timeout raises TIMEOUT at once,
+and the program waiting for input we don't send is a TIMEOUT as well. time_scale sleeps for that fraction of
+the recorded delays, 0 (the default) never sleeps at all, so the timeout paths of a module run in milliseconds.
+
+Modules take a spawn callable in place of pexpect.spawn, replayer() makes one for a transcript file:
+
+    run_pexpect(path, password, spawn=replayer('password.json', redact=[password]))
+"""
+import gzip
+import json
+import time
+from contextlib import contextmanager
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+VERSION = 1
+REDACTED = '<redacted>'
+
+
+class TranscriptMismatch(pexpect.ExceptionPexpect):
+    """
+    The replayed session sent something other than what was recorded
+    """
+
+
+class Recorder(object):
+    def __init__(self, path, redact=None):
+        self.path = path
+        self.redact = [secret for secret in (redact or []) if secret]
+        self.events = []
+        self.last = None
+        self.transcript = None
+
+    def attach(self, child):
+        """
+        Record every read and send of child, the transcript is written when child is closed
+        """
+        self.transcript = {'version': VERSION, 'command': to_text(getattr(child, 'command', None)),
+                           'args': [to_text(arg) for arg in getattr(child, 'args', None) or []],
+                           'encoding': getattr(child, 'encoding', None)}
+        self.last = time.time()
+        send = child.send
+        read_nonblocking = child.read_nonblocking
+        close = child.close
+
+        def recorded_send(s):
+            count = send(s)
+            self.add('s', s)
+            return count
+
+        def recorded_read_nonblocking(size=1, timeout=-1):
+            try:
+                data = read_nonblocking(size, timeout)
+            except pexpect.EOF:
+                if not self.events or self.events[-1][1] != 'eof':
+                    self.add('eof')
+                raise
+            self.add('r', data)
+            return data
+
+        def recorded_close(*args, **kwargs):
+            try:
+                return close(*args, **kwargs)
+            finally:
+                self.transcript.update(exitstatus=child.exitstatus, signalstatus=child.signalstatus)
+                self.save()
+
+        child.send = recorded_send
+        child.read_nonblocking = recorded_read_nonblocking
+        child.close = recorded_close
+
+    def add(self, kind, data=None):
+        now = time.time()
+        event = [round(now - self.last, 4), kind]
+        self.last = now
+        if data is not None:
+            text = to_text(data)
+            for secret in self.redact:
+                text = text.replace(secret, REDACTED)
+            event.append(text)
+        if self.events and kind == 'r' and self.events[-1][1] == 'r' and event[0] == 0:
+            # Reads that came in back to back are one chunk as far as a replay is concerned
+            self.events[-1][2] += event[2]
+        else:
+            self.events.append(event)
+
+    def save(self, **extra):
+        """
+        Write the transcript, extra keys like the outcome of the run are stored next to the events
+        """
+        self.transcript.update(extra, events=self.events)
+        dump(self.path, self.transcript)
+
+
+class ReplaySpawn(SpawnBase):
+    def __init__(self, transcript, timeout=30, maxread=2000, searchwindowsize=None, logfile=None, encoding=None,
+                 codec_errors='strict', time_scale=0, redact=None):
+        super(ReplaySpawn, self).__init__(timeout=timeout, maxread=maxread, searchwindowsize=searchwindowsize,
+                                          logfile=logfile, encoding=encoding, codec_errors=codec_errors)
+        self.transcript = transcript
+        self.events = transcript['events']
+        self.command = transcript.get('command')
+        self.args = transcript.get('args', [])
+        self.time_scale = time_scale
+        self.redact = [secret for secret in (redact or []) if secret]
+        # Virtual time now and of the last event played back
+        self.clock = 0.0
+        self.last = 0.0
+        # Next event to read from and next recorded send to match
+        self.position = 0
+        self.send_position = 0
+        # Virtual times our sends were made at, by event index
+        self.sent_at = {}
+        # Left over of a read event that was bigger than the size asked for
+        self.partial = b''
+        self.deadline = None
+        self.closed = False
+        self.terminated = False
+        self.delayafterread = None
+        self.delaybeforesend = None
+
+    def __str__(self):
+        return '<ReplaySpawn {0} {1} at event {2} of {3}>'.format(self.command, self.args, self.position,
+                                                                  len(self.events))
+
+    def expect_list(self, pattern_list, timeout=-1, searchwindowsize=-1, async_=False, **kw):
+        with self.expecting(timeout):
+            return super(ReplaySpawn, self).expect_list(pattern_list, timeout, searchwindowsize, async_, **kw)
+
+    def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1, async_=False, **kw):
+        with self.expecting(timeout):
+            return super(ReplaySpawn, self).expect_exact(pattern_list, timeout, searchwindowsize, async_, **kw)
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+        with self.expecting(timeout):
+            return super(ReplaySpawn, self).expect_loop(searcher, timeout, searchwindowsize)
+
+    @contextmanager
+    def expecting(self, timeout):
+        """
+        The timeout of an expect call counts in virtual time, pexpect's own clock hardly moves during a replay
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        outer = self.deadline
+        if timeout is not None:
+            self.deadline = self.clock + timeout
+        try:
+            yield
+        finally:
+            self.deadline = outer
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self.flag_eof:
+            raise pexpect.EOF('End Of File (EOF). Replay ended.')
+        if timeout == -1:
+            timeout = self.timeout
+        if self.deadline is not None:
+            # A shorter timeout passed in, e.g. by a Watchdog, still wins
+            remaining = max(0.0, self.deadline - self.clock)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if not self.partial:
+            self.partial = self.next_output(timeout)
+        data, self.partial = self.partial[:size], self.partial[size:]
+        s = self._decoder.decode(data, final=False)
+        self._log(s, 'read')
+        return s
+
+    def next_output(self, timeout):
+        """
+        Wait in virtual time for the next output event, returns its bytes or raises EOF or TIMEOUT
+        """
+        while True:
+            event = self.events[self.position] if self.position < len(self.events) else None
+            if event is not None and event[1] == 's' and self.position in self.sent_at:
+                # We already made this send, what comes after it is due relative to when we did
+                self.last = max(self.last, self.sent_at[self.position])
+                self.position += 1
+                continue
+            if event is None or event[1] == 's':
+                # The program is waiting for input, or it was still running when the recording stopped
+                self.advance(timeout)
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            due = self.last + event[0]
+            if timeout is not None and due - self.clock > timeout:
+                self.advance(timeout)
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            self.advance(due - self.clock)
+            self.last = due
+            self.position += 1
+            if event[1] == 'eof':
+                self.flag_eof = True
+                # Known from here on like a real child that isalive() found exited
+                self.exitstatus = self.transcript.get('exitstatus')
+                self.signalstatus = self.transcript.get('signalstatus')
+                raise pexpect.EOF('End Of File (EOF). Replay ended.')
+            return from_text(event[2])
+
+    def advance(self, seconds):
+        if seconds is None:
+            raise pexpect.TIMEOUT('Timeout exceeded, the replayed program never answers.')
+        seconds = max(0.0, seconds)
+        self.clock += seconds
+        if self.time_scale:
+            time.sleep(seconds * self.time_scale)
+
+    def send(self, s):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        text = to_text(s)
+        for secret in self.redact:
+            text = text.replace(secret, REDACTED)
+        while self.send_position < len(self.events) and self.events[self.send_position][1] != 's':
+            self.send_position += 1
+        if self.send_position >= len(self.events):
+            raise TranscriptMismatch('Sent {0!r} after the last recorded send'.format(text))
+        recorded = self.events[self.send_position][2]
+        if text != recorded:
+            raise TranscriptMismatch('Sent {0!r} where the transcript has {1!r}'.format(text, recorded))
+        self.sent_at[self.send_position] = self.clock
+        self.send_position += 1
+        return len(self._encoder.encode(s, final=False))
+
+    def sendline(self, s=''):
+        s = self._coerce_send_string(s)
+        return self.send(s + self.linesep)
+
+    def isalive(self):
+        return not self.closed and not self.flag_eof
+
+    def close(self, force=True):
+        if self.closed:
+            return
+        # Whatever the recorded program ended with, at the point the recording was closed
+        self.exitstatus = self.transcript.get('exitstatus')
+        self.signalstatus = self.transcript.get('signalstatus')
+        self.closed = True
+        self.terminated = True
+
+    def terminate(self, force=False):
+        self.close()
+        return True
+
+
+def replayer(path, time_scale=0, redact=None):
+    """
+    A callable taking the same arguments as pexpect.spawn that replays the transcript at path instead
+    """
+    transcript = load(path)
+
+    def spawn(command=None, args=None, timeout=30, maxread=2000, searchwindowsize=None, logfile=None,
+              encoding=None, codec_errors='strict', **kwargs):
+        # Start from the top every time, like a new process would
+        return ReplaySpawn(transcript, timeout=timeout, maxread=maxread, searchwindowsize=searchwindowsize,
+                           logfile=logfile, encoding=encoding, codec_errors=codec_errors, time_scale=time_scale,
+                           redact=redact)
+    return spawn
+
+
+def to_text(data):
+    if isinstance(data, bytes):
+        # surrogateescape keeps bytes that aren't utf-8, from_text gives them back unchanged
+        return data.decode('utf-8', 'surrogateescape')
+    return data
+
+
+def from_text(text):
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def load(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as transcript_file:
+        transcript = json.load(transcript_file)
+    if transcript.get('version') != VERSION:
+        raise ValueError("{0} is not a version {1} transcript".format(path, VERSION))
+    return transcript
+
+
+def dump(path, transcript):
+    data = json.dumps(transcript, separators=(',', ':'))
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as transcript_file:
+        transcript_file.write(data)
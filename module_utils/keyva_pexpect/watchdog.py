@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Fail a hung program in seconds instead of waiting out the whole task timeout.
+
+Watchdog.attach() wraps read_nonblocking and send on one child, the same way a Timeline does, and shortens
+every wait for output so it ends at the first of:
+    - idle_timeout seconds without output from the program, counted from its last output or our last send,
+      since a program waiting for our input prints nothing
+    - the deadline of the current step, when it has one
+and then raises pexpect.TIMEOUT saying which one it was. The overall timeout of an expect call still applies.
+
+Step deadlines come from a history kept on the host of how long each named step took on earlier successful
+runs of the same script, the steps being the ones the dialog code already names with step() and mark(). Once a
+step has MIN_SAMPLES samples its deadline is the p99 times a factor, never less than a minimum. A step that is
+past its deadline but still printing is left alone, long installs that make progress still finish; it fails
+once it has been quiet for OVERRUN_IDLE seconds.
+"""
+import os
+import time
+
+import pexpect
+
+from .state import state_path, load_json, save_json
+
+KIND = 'step_history'
+# Samples kept per step, and how many a step needs before we trust its deadline
+MAX_SAMPLES = 100
+MIN_SAMPLES = 5
+DEFAULT_FACTOR = 3.0
+DEFAULT_MIN_DEADLINE = 10.0
+# Seconds a step past its deadline may go without output
+OVERRUN_IDLE = 5.0
+
+
+def history_path(state_dir, module, script_path):
+    return state_path(state_dir, KIND, module, os.path.abspath(script_path))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Watchdog(object):
+    def __init__(self, idle_timeout=0, history=None, factor=DEFAULT_FACTOR, min_deadline=DEFAULT_MIN_DEADLINE):
+        """
+        history is the path of the step history file, see history_path(), None to not use one
+        """
+        self.idle_timeout = idle_timeout or None
+        self.history = history
+        self.steps = []
+        self.samples = {}
+        self.fired = None
+        self.last_activity = time.time()
+        self.deadlines = {}
+        if history is not None:
+            for name, samples in load_json(history, {}).get('steps', {}).items():
+                if len(samples) >= MIN_SAMPLES:
+                    self.deadlines[name] = max(min_deadline, percentile(samples, 0.99) * factor)
+
+    def attach(self, child):
+        child.keyva_watchdog = self
+        send = child.send
+        read_nonblocking = child.read_nonblocking
+
+        def watched_send(s):
+            self.last_activity = time.time()
+            return send(s)
+
+        def watched_read_nonblocking(size=1, timeout=-1):
+            if timeout == -1:
+                timeout = child.timeout
+            fire_at, reason = self.limit()
+            if fire_at is not None and (timeout is None or fire_at - time.time() < timeout):
+                try:
+                    data = read_nonblocking(size, max(0, fire_at - time.time()))
+                except pexpect.TIMEOUT:
+                    self.fired = reason
+                    raise pexpect.TIMEOUT(reason)
+            else:
+                data = read_nonblocking(size, timeout)
+            self.last_activity = time.time()
+            return data
+
+        child.send = watched_send
+        child.read_nonblocking = watched_read_nonblocking
+
+    def limit(self):
+        """
+        The time the watchdog fires at if no output comes in before then, and what it will say, or (None, None)
+        """
+        fire_at = reason = None
+        if self.idle_timeout:
+            fire_at = self.last_activity + self.idle_timeout
+            reason = 'No output for {0}s, the program looks hung'.format(self.idle_timeout)
+        if self.steps:
+            name, start = self.steps[-1]
+            deadline = self.deadlines.get(name)
+            if deadline is not None:
+                step_fire_at = max(start + deadline, self.last_activity + OVERRUN_IDLE)
+                if fire_at is None or step_fire_at < fire_at:
+                    fire_at = step_fire_at
+                    reason = ("Step '{0}' ran past its deadline of {1:.1f}s from earlier runs and printed nothing "
+                              "for {2}s".format(name, deadline, OVERRUN_IDLE))
+        return fire_at, reason
+
+    def start_step(self, name):
+        self.steps.append((name, time.time()))
+
+    def end_step(self):
+        name, start = self.steps.pop()
+        self.samples.setdefault(name, []).append(time.time() - start)
+
+    def mark(self, name):
+        """
+        Like Timeline.mark(), a name of None only ends the current step
+        """
+        if self.steps:
+            self.end_step()
+        if name is not None:
+            self.start_step(name)
+
+    def save(self, warn=None):
+        """
+        Add the step times of this run to the history, only call it after a successful run.
+        When the history can't be written the run still succeeded, warn, e.g. module.warn, is called with why.
+        """
+        if self.history is None:
+            return
+        while self.steps:
+            self.end_step()
+        steps = load_json(self.history, {}).get('steps', {})
+        for name, samples in self.samples.items():
+            steps[name] = (steps.get(name, []) + samples)[-MAX_SAMPLES:]
+        try:
+            save_json(self.history, {'time': time.time(), 'steps': steps})
+        except (IOError, OSError) as err:
+            if warn is not None:
+                warn("Unable to save the step history, this run's step times are not counted: {0}".format(err))
+
+    def result(self):
+        return {'idle_timeout': self.idle_timeout, 'step_deadlines': self.deadlines, 'fired': self.fired}
@@ -15,11 +15,22 @@ else
   exit 1
 fi
 
+# Items like socket have numbered instances, socket.1, socket.2 and so on, which have to be added before use
+declare -A ITEMS
+
 while true; do
     IFS=' ' read -p "> " -a TEST
     case "${TEST[@]}" in
         set*)
-            echo "${TEST[1]} set to ${TEST[2]}"
+            if [[ ${TEST[1]} =~ ^([a-z]+)\.([0-9]+)\. ]] && (( BASH_REMATCH[2] > ${ITEMS[${BASH_REMATCH[1]}]:-0} )); then
+                echo "ERROR: \"${BASH_REMATCH[1]}.${BASH_REMATCH[2]}\" does not exist"
+            else
+                echo "${TEST[1]} set to ${TEST[2]}"
+            fi
+        ;;
+        add*)
+            ITEMS[${TEST[1]}]=$(( ${ITEMS[${TEST[1]}]:-0} + 1 ))
+            echo "${TEST[1]}.${ITEMS[${TEST[1]}]} added"
         ;;
         print\ config)
             echo -e "\nFake Config:\nminheap: 1024m\nmaxheap: 5120m\nport: 7000\nwebport: 80"
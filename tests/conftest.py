@@ -0,0 +1,48 @@
+"""
+Makes the module_utils in this repo importable as ansible.module_utils and the modules in library/ loadable,
+the same way benchmarks/run_benchmarks.py does, so the tests need nothing but pexpect and pytest.
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from run_benchmarks import install_import_shim, load_library  # noqa: E402
+
+install_import_shim()
+
+MOCK_CLI = os.path.join(REPO_DIR, 'roles', 'pexpect_demo', 'files', 'mock_cli.sh')
+MOCK_INSTALL = os.path.join(REPO_DIR, 'roles', 'pexpect_demo', 'files', 'mock_install.sh')
+TRANSCRIPTS = os.path.join(REPO_DIR, 'benchmarks', 'transcripts')
+
+
+@pytest.fixture(scope='session')
+def cli_module():
+    return load_library('keyva_pexpect_cli')
+
+
+@pytest.fixture(scope='session')
+def install_module():
+    return load_library('keyva_pexpect_install')
+
+
+@pytest.fixture
+def mock_installer(tmp_path):
+    """
+    A copy of mock_install.sh that marks itself installed under tmp_path instead of /tmp
+    """
+    def make(name='mock_install', extra_before_done=''):
+        with open(MOCK_INSTALL) as source:
+            script = source.read()
+        script = script.replace('FILE=/tmp/pexpect_mock_demo', 'FILE={0}/{1}.marker'.format(tmp_path, name))
+        script = script.replace('LOGFILE=/tmp/pexpect_mock_demo', 'LOGFILE={0}/{1}'.format(tmp_path, name))
+        if extra_before_done:
+            script = script.replace('touch $FILE', '{0}\ntouch $FILE'.format(extra_before_done))
+        path = tmp_path / (name + '.sh')
+        path.write_text(script)
+        path.chmod(0o755)
+        return str(path)
+    return make
@@ -0,0 +1,122 @@
+import json
+import os
+import time
+
+import pexpect
+import pytest
+
+from ansible.module_utils.keyva_pexpect import archive
+from ansible.module_utils.keyva_pexpect.archive import ArchiveSession, entries, evict, fetch, find
+
+PASSWORD = 'RHUG2020'
+
+
+def session(archive_dir, output, outcome='ok', module='keyva_pexpect_install', script='/opt/install.sh', **kwargs):
+    """
+    Archive one session that printed output, a list of reads
+    """
+    archived = ArchiveSession(archive_dir, module, script, redact=[PASSWORD])
+    for data in output:
+        archived.write(data)
+    return archived.finish(outcome, **kwargs)
+
+
+def test_sessions_are_appended_and_fetched_one_by_one(tmp_path):
+    archive_dir = str(tmp_path)
+    first = session(archive_dir, [b'first ', b'session\n'])
+    second = session(archive_dir, [b'second session\n'], outcome='failed', error=RuntimeError('it broke\nbadly'))
+    assert first['segment'] == second['segment'] == 'segment-0.gz'
+    assert second['offset'] == first['offset'] + first['length']
+    assert fetch(archive_dir, first['id']) == b'first session\n'
+    assert fetch(archive_dir, second['id']) == b'second session\n'
+    assert second['error'] == 'RuntimeError: it broke'
+    assert fetch(archive_dir, 'nope') is None
+    # Nothing is left in the spool once a session is archived
+    assert os.listdir(os.path.join(archive_dir, 'spool')) == []
+
+
+def test_password_split_over_reads_is_redacted(tmp_path):
+    entry = session(str(tmp_path), [b'Please enter your password: RHU', b'G20', b'20\r\nok\r\n'])
+    assert fetch(str(tmp_path), entry['id']) == b'Please enter your password: <redacted>\r\nok\r\n'
+    assert entry['bytes'] == len(b'Please enter your password: <redacted>\r\nok\r\n')
+
+
+def test_attached_child_is_archived_with_its_exit_status(tmp_path):
+    archived = ArchiveSession(str(tmp_path), 'keyva_pexpect_cli', '/bin/bash')
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo hello; exit 3'])
+    archived.attach(child)
+    child.expect(pexpect.EOF)
+    child.close()
+    entry = archived.finish('failed')
+    assert entry['exitstatus'] == 3
+    assert fetch(str(tmp_path), entry['id']) == b'hello\r\n'
+
+
+def test_index_filters(tmp_path):
+    archive_dir = str(tmp_path)
+    session(archive_dir, [b'a'], module='keyva_pexpect_cli', script='/opt/cli.sh')
+    failed = session(archive_dir, [b'b'], outcome='failed')
+    session(archive_dir, [b'c'])
+    assert [entry['outcome'] for entry in find(archive_dir)] == ['ok', 'failed', 'ok']
+    assert [entry['id'] for entry in find(archive_dir, outcome='failed')] == [failed['id']]
+    assert len(find(archive_dir, module='keyva_pexpect_install', script='/opt/install.sh')) == 2
+    assert find(archive_dir, since=time.time() + 10) == []
+    # A line cut short doesn't hide the rest of the index
+    with open(os.path.join(archive_dir, archive.INDEX), 'a') as index:
+        index.write('{"id": "cut sho\n')
+    session(archive_dir, [b'd'])
+    assert len(list(entries(archive_dir))) == 4
+
+
+def test_eviction_by_size_keeps_the_newest_segment(tmp_path, monkeypatch):
+    # Every session closes its segment, so each one lands in a segment of its own
+    monkeypatch.setattr(archive, 'SEGMENT_SIZE', 1)
+    archive_dir = str(tmp_path)
+    ids = [session(archive_dir, [os.urandom(2000)])['id'] for n in range(4)]
+    assert archive.segments(archive_dir) == ['segment-{0}.gz'.format(n) for n in range(4)]
+    # Room for about two of them, the oldest go first
+    assert evict(archive_dir, max_age=0, max_bytes=4500) == ['segment-0.gz', 'segment-1.gz']
+    assert [entry['id'] for entry in find(archive_dir)] == ids[2:]
+    assert fetch(archive_dir, ids[0]) is None and len(fetch(archive_dir, ids[3])) == 2000
+    # However small max_bytes is, the segment being appended to stays
+    assert evict(archive_dir, max_age=0, max_bytes=1) == ['segment-2.gz']
+    assert [entry['id'] for entry in find(archive_dir)] == ids[3:]
+
+
+def test_eviction_by_age(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'SEGMENT_SIZE', 1)
+    archive_dir = str(tmp_path)
+    old = session(archive_dir, [b'old'])
+    new = session(archive_dir, [b'new'])
+    # Make the first session look a day old
+    index_path = os.path.join(archive_dir, archive.INDEX)
+    with open(index_path) as index:
+        lines = [json.loads(line) for line in index]
+    lines[0]['end'] -= 24 * 3600
+    with open(index_path, 'w') as index:
+        index.writelines(json.dumps(entry) + '\n' for entry in lines)
+    assert evict(archive_dir, max_age=3600, max_bytes=0) == [old['segment']]
+    assert [entry['id'] for entry in find(archive_dir)] == [new['id']]
+
+
+def test_stale_spool_files_are_removed(tmp_path):
+    archive_dir = str(tmp_path)
+    session(archive_dir, [b'a'])
+    stale = os.path.join(archive_dir, 'spool', 'left-behind')
+    with open(stale, 'w') as spool:
+        spool.write('x')
+    os.utime(stale, (0, time.time() - archive.STALE_SPOOL - 10))
+    evict(archive_dir)
+    assert not os.path.exists(stale)
+
+
+def test_session_that_cant_be_archived(tmp_path):
+    archive_dir = str(tmp_path)
+    # A directory where the index should be
+    os.makedirs(os.path.join(archive_dir, archive.INDEX))
+    with pytest.raises(OSError):
+        session(archive_dir, [b'a'])
+    warnings = []
+    assert session(archive_dir, [b'b'], warn=warnings.append) is None
+    assert len(warnings) == 1 and warnings[0].startswith("Unable to archive the session in '{0}'".format(archive_dir))
+    assert os.listdir(os.path.join(archive_dir, 'spool')) == []
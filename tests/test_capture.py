@@ -0,0 +1,48 @@
+import gzip
+
+import pytest
+
+from ansible.module_utils.keyva_pexpect.capture import BoundedCapture
+
+PASSWORD = 'RHUG2020'
+
+
+def test_password_split_over_reads_is_redacted(tmp_path):
+    spool = str(tmp_path / 'spool.gz')
+    capture = BoundedCapture(16, 16, spool_path=spool, redact=[PASSWORD])
+    for chunk in (b'Please enter your password: RHU', b'G20', b'20\r\nPassword accepted!\r\n'):
+        capture.write(chunk)
+    value = capture.getvalue()
+    capture.close()
+    with gzip.open(spool) as spooled:
+        spooled = spooled.read()
+    assert spooled == b'Please enter your password: <redacted>\r\nPassword accepted!\r\n'
+    assert PASSWORD.encode() not in value
+    assert capture.total == len(spooled)
+
+
+def test_nothing_held_back_without_redact():
+    capture = BoundedCapture(1024, 1024)
+    capture.write(b'abc')
+    assert capture.redactor.pending == b''
+    assert capture.getvalue() == b'abc'
+
+
+def test_spool_that_cant_be_opened_raises(tmp_path):
+    # The module turns this into a fail_json naming the spool before the installer is started
+    with pytest.raises(IOError):
+        BoundedCapture(1024, 1024, spool_path=str(tmp_path / 'missing' / 'spool.gz'))
+
+
+def test_bounded_install_never_keeps_the_password(install_module, mock_installer, tmp_path):
+    spool = str(tmp_path / 'install.gz')
+    capture = BoundedCapture(65536, 65536, spool_path=spool, redact=[PASSWORD])
+    output, logfile, changed, exitstatus, errors = install_module.run_pexpect(mock_installer(), PASSWORD, 20,
+                                                                              capture=capture)
+    assert changed and exitstatus == 0
+    assert b'Please enter your password: <redacted>' in output
+    assert PASSWORD.encode() not in output
+    with gzip.open(spool) as spooled:
+        spooled = spooled.read()
+    assert b'<redacted>' in spooled and PASSWORD.encode() not in spooled
+    assert not any(PASSWORD.encode() in line for line in capture.lines)
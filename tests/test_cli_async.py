@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from conftest import MOCK_CLI
+
+from ansible.module_utils.keyva_pexpect import cli_async
+from ansible.module_utils.keyva_pexpect.cli_session import save_config_dialog
+
+MISSING_ITEM_COMMANDS = ['set port 7000', 'set socket.1.port 8080', 'set socket.1.host a', 'set socket.2.port 80']
+
+
+def target(path=MOCK_CLI, commands=('set port 7000',), timeout=5, pipeline=0, password='RHUG2020'):
+    return dict(path=path, options='', commands=list(commands), password=password, timeout=timeout,
+                pipeline=pipeline, diff_config=False)
+
+
+def run(*targets):
+    return asyncio.run(cli_async.run_targets(list(targets), concurrency=4))
+
+
+def test_targets_run_the_shared_dialog():
+    results = run(target(), target(commands=MISSING_ITEM_COMMANDS), target(commands=MISSING_ITEM_COMMANDS,
+                                                                           pipeline=4))
+    for result in results:
+        assert result['failed'] is False, result.get('msg')
+        assert result['changed'] is True
+        assert result['config']['port'] == '7000'
+        assert result['logfile'].startswith('/tmp/pexpect_mock_cli.')
+
+
+def test_dialog_is_not_duplicated():
+    # Everything the session says to myscript comes from cli_session
+    for name in ('run_session', 'run_command', 'save_config', 'print_config', 'add_missing_item'):
+        assert not hasattr(cli_async, name)
+    assert save_config_dialog.__module__.endswith('cli_session')
+
+
+def test_bad_password_fails_the_target_only():
+    bad, good = run(target(password='wrong'), target())
+    assert bad['failed'] is True
+    assert good['failed'] is False
+
+
+def test_timeout_says_where_and_closes_without_waiting(tmp_path):
+    # Logs in and then never shows a prompt
+    script = tmp_path / 'stuck_cli.sh'
+    script.write_text('#!/bin/bash\necho "Logfile: /tmp/stuck_cli.log"\nread -s -p "Enter password: " P\n'
+                      'echo\nsleep 30\n')
+    script.chmod(0o755)
+    start = time.time()
+    result, = run(target(path=str(script), timeout=1))
+    assert time.time() - start < 5
+    assert result['failed'] is True
+    assert "in step 'start_config'" in result['msg']
+    assert "timed out after 1s" in result['msg']
+    assert "'Initialize New Config\\\\?'" in result['msg']
+
+
+def test_timeout_names_the_command(tmp_path):
+    # Answers the first prompt and then hangs on the first command
+    script = tmp_path / 'slow_cli.sh'
+    script.write_text('#!/bin/bash\necho "Logfile: /tmp/slow_cli.log"\nread -s -p "Enter password: " P\n'
+                      'echo\nread -p "> " C\nsleep 30\n')
+    script.chmod(0o755)
+    result, = run(target(path=str(script), timeout=1, commands=['set port 7000']))
+    assert "in step 'command' of 'set port 7000'" in result['msg']
@@ -0,0 +1,134 @@
+from conftest import MOCK_CLI
+
+from ansible.module_utils.keyva_pexpect.cli_session import config_deltas, iter_deltas, parse_config, plan_commands
+
+# What mock_cli.sh prints for 'print config'
+MOCK_CONFIG = 'Fake Config:\r\nminheap: 1024m\r\nmaxheap: 5120m\r\nport: 7000\r\nwebport: 80'
+
+
+class Warnings(object):
+    """
+    The part of AnsibleModule save_snapshot() uses
+    """
+
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+
+def test_parse_config():
+    assert parse_config(MOCK_CONFIG) == {'minheap': '1024m', 'maxheap': '5120m', 'port': '7000', 'webport': '80'}
+
+
+def test_parse_config_keeps_colons_in_values():
+    assert parse_config('url: http://example.com:8080/x') == {'url': 'http://example.com:8080/x'}
+
+
+def test_parse_config_of_unparseable_output():
+    assert parse_config('') == {}
+    # A key needs a value and a value needs a key
+    assert parse_config('ERROR: \r\n:\r\nno settings here\r\n: orphan value\r\nkey:') == {}
+
+
+def test_config_deltas_drops_what_is_already_set():
+    config = parse_config(MOCK_CONFIG)
+    assert config_deltas(config, ['set port 7000', 'set webport 80']) == []
+
+
+def test_config_deltas_keeps_changed_and_new_values():
+    config = parse_config(MOCK_CONFIG)
+    commands = ['set port 8000', 'set webport 80', 'set socket.1.port 80', 'set minheap 1024m']
+    assert config_deltas(config, commands) == ['set port 8000', 'set socket.1.port 80']
+
+
+def test_config_deltas_follows_earlier_commands():
+    # Setting port back to what the config has is a change after it was set to something else
+    config = parse_config(MOCK_CONFIG)
+    assert config_deltas(config, ['set port 8000', 'set port 7000', 'set port 7000']) == \
+        ['set port 8000', 'set port 7000']
+
+
+def test_config_deltas_keeps_everything_after_another_command():
+    config = parse_config(MOCK_CONFIG)
+    commands = ['set port 7000', 'add socket', 'set port 7000', 'reset', 'set webport 80']
+    assert config_deltas(config, commands) == commands[1:]
+
+
+def test_config_deltas_against_unparseable_output():
+    assert config_deltas(parse_config('garbage'), ['set port 7000']) == ['set port 7000']
+
+
+def test_iter_deltas_streams():
+    consumed = []
+
+    def commands():
+        for command in ['set port 7000', 'set port 8000', 'set webport 80']:
+            consumed.append(command)
+            yield command
+
+    deltas = iter_deltas(parse_config(MOCK_CONFIG), commands())
+    assert next(deltas) == 'set port 8000'
+    assert consumed == ['set port 7000', 'set port 8000']
+    assert list(deltas) == []
+
+
+def test_plan_commands_adds_missing_instances_up_front():
+    config = dict(parse_config(MOCK_CONFIG), **{'socket.1.port': '80'})
+    commands = ['set socket.3.port 80', 'set socket.1.host a', 'set other.1.x 1']
+    assert plan_commands(config, commands) == ['add socket', 'add socket', 'set socket.3.port 80',
+                                               'set socket.1.host a', 'add other', 'set other.1.x 1']
+
+
+def test_plan_commands_drops_overridden_sets():
+    assert plan_commands({}, ['set port 1', 'set webport 2', 'set port 3']) == ['set webport 2', 'set port 3']
+
+
+def test_plan_commands_counts_explicit_adds():
+    assert plan_commands({}, ['add socket', 'set socket.1.port 80', 'set socket.2.port 81']) == \
+        ['add socket', 'set socket.1.port 80', 'add socket', 'set socket.2.port 81']
+
+
+def test_plan_commands_stops_at_other_commands():
+    # Nothing is dropped before 'reset' or added after it, run_command() still adds what turns out missing
+    commands = ['set port 1', 'reset', 'set port 1', 'set port 2', 'set socket.1.port 80']
+    assert plan_commands({}, commands) == ['set port 1', 'reset', 'set port 2', 'set socket.1.port 80']
+
+
+def test_plan_commands_with_diff_config():
+    config = parse_config(MOCK_CONFIG)
+    commands = ['set port 7000', 'set webport 8080', 'set webport 80', 'set socket.2.port 80']
+    assert plan_commands(config, commands, diff_config=True) == ['add socket', 'add socket', 'set socket.2.port 80']
+
+
+def test_plan_commands_against_unparseable_output():
+    assert plan_commands(parse_config('garbage'), ['set socket.1.port 80'], diff_config=True) == \
+        ['add socket', 'set socket.1.port 80']
+
+
+def test_check_mode_plan_from_the_config_read(cli_module, tmp_path):
+    """
+    What check mode with plan_commands reports: the config is read from the script without sending anything,
+    saved as the snapshot and the plan is made against it with diff_config
+    """
+    current_settings, changed, logfile = cli_module.run_pexpect(MOCK_CLI, '', [], 'RHUG2020', 10)
+    snapshot = cli_module.save_snapshot(Warnings(), str(tmp_path / 'snapshot.json'), current_settings, logfile)
+    assert snapshot['config'] == parse_config(MOCK_CONFIG)
+    commands = ['set port 7000', 'set webport 8080', 'set webport 80', 'set socket.2.port 80',
+                'set socket.1.host a', 'set maxheap 4096m']
+    assert plan_commands(snapshot['config'], commands, diff_config=True) == \
+        ['add socket', 'add socket', 'set socket.2.port 80', 'set socket.1.host a', 'set maxheap 4096m']
+    # The same plan sent for real goes through without an item missing
+    settings, changed, logfile = cli_module.run_pexpect(MOCK_CLI, '', commands, 'RHUG2020', 10, plan=True)
+    assert changed is True
+
+
+def test_snapshot_that_cant_be_saved_is_a_warning(cli_module, tmp_path):
+    module = Warnings()
+    (tmp_path / 'state').write_text('a file where the snapshot directory should be')
+    snapshot_path = str(tmp_path / 'state' / 'cli_config' / 'snapshot.json')
+    snapshot = cli_module.save_snapshot(module, snapshot_path, MOCK_CONFIG, '/tmp/x.log')
+    assert snapshot['config']['port'] == '7000'
+    assert len(module.warnings) == 1
+    assert "Unable to save the config snapshot '{0}'".format(snapshot_path) in module.warnings[0]
@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+from conftest import MOCK_CLI
+
+from ansible.module_utils.keyva_pexpect.command_file import CommandFile
+
+
+@pytest.fixture
+def commands_file(tmp_path):
+    def make(text):
+        path = tmp_path / 'commands.txt'
+        path.write_text(text)
+        return str(path)
+    return make
+
+
+def command_file(path, tmp_path, checkpoint_every=2, resume=True, script=MOCK_CLI):
+    return CommandFile(path, str(tmp_path / 'state'), script, '', checkpoint_every, resume)
+
+
+def test_chunks_skip_comments_and_blank_lines(commands_file, tmp_path):
+    path = commands_file('# settings\nset a 1\n\nset b 2\n  set c 3  \n#set d 4\nset e 5\n')
+    chunks = list(command_file(path, tmp_path).chunks())
+    assert [chunk for chunk, offset in chunks] == [['set a 1', 'set b 2'], ['set c 3', 'set e 5']]
+    assert chunks[-1][1] == os.path.getsize(path)
+
+
+def test_last_line_without_newline(commands_file, tmp_path):
+    # A file cut off in the middle of its last line still sends what is there
+    path = commands_file('set a 1\nset b 2\nset c')
+    assert [command for command, offset in command_file(path, tmp_path).commands()] == \
+        ['set a 1', 'set b 2', 'set c']
+
+
+def test_line_that_is_not_utf8(commands_file, tmp_path):
+    path = commands_file('set a 1\n')
+    with open(path, 'ab') as latin1:
+        latin1.write(u'set b caf\xe9\nset c 3\n'.encode('latin-1'))
+    first = command_file(path, tmp_path, checkpoint_every=1)
+    chunks = first.chunks()
+    chunk, offset = next(chunks)
+    first.checkpoint(offset, 1)
+    with pytest.raises(RuntimeError, match="line 2 of the commands_file '{0}' is not UTF-8".format(path)):
+        next(chunks)
+    # Resuming after the checkpoint still names the line in the whole file
+    with pytest.raises(RuntimeError, match='line 2 of the commands_file'):
+        list(command_file(path, tmp_path).chunks())
+
+
+def test_checkpoint_resumes_after_it(commands_file, tmp_path):
+    path = commands_file('set a 1\nset b 2\nset c 3\n')
+    first = command_file(path, tmp_path)
+    chunk, offset = next(first.chunks())
+    first.checkpoint(offset, len(chunk))
+    again = command_file(path, tmp_path)
+    assert again.offset == offset and again.resumed_from == 2
+    assert list(again.chunks()) == [(['set c 3'], os.path.getsize(path))]
+    # Without resume the file is read from the top
+    assert command_file(path, tmp_path, resume=False).offset == 0
+
+
+def test_truncated_file_starts_from_the_top(commands_file, tmp_path):
+    path = commands_file('set a 1\nset b 2\nset c 3\nset d 4\n')
+    first = command_file(path, tmp_path)
+    chunks = first.chunks()
+    next(chunks)
+    chunk, offset = next(chunks)
+    first.checkpoint(offset, 4)
+    with open(path, 'r+') as truncated:
+        truncated.truncate(8)
+    again = command_file(path, tmp_path)
+    assert again.offset == 0 and again.done == 0
+    assert list(again.chunks()) == [(['set a 1'], 8)]
+
+
+def test_modified_file_makes_the_checkpoint_stale(commands_file, tmp_path):
+    path = commands_file('set a 1\nset b 2\nset c 3\n')
+    first = command_file(path, tmp_path)
+    chunk, offset = next(first.chunks())
+    first.checkpoint(offset, len(chunk))
+    # Same size, only the content and the time changed
+    stat = os.stat(path)
+    with open(path, 'w') as modified:
+        modified.write('set a 9\nset b 2\nset c 3\n')
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    again = command_file(path, tmp_path)
+    assert again.offset == 0 and again.resumed_from == 0
+
+
+def test_resume_after_a_failure_mid_file(commands_file, tmp_path, cli_module):
+    """
+    A run against the mock CLI that fails in its second chunk leaves a checkpoint after the first one,
+    the next run sends the rest of the file from there and forgets the checkpoint once it is done
+    """
+    broken = tmp_path / 'broken'
+    broken.touch()
+    script = tmp_path / 'mock_cli.sh'
+    with open(MOCK_CLI) as source:
+        # 'set fail' fails as long as the broken file is there
+        script.write_text(source.read().replace(
+            '        set*)\n',
+            '        set\\ fail*)\n            [[ -e {0} ]] && echo "ERROR: failed" || echo "fail set"\n        ;;\n'
+            '        set*)\n'.format(broken)))
+    script.chmod(0o755)
+    path = commands_file('set a 1\nset b 2\nset c 3\nset fail 1\nset e 5\n')
+    first = command_file(path, tmp_path, script=str(script))
+    with pytest.raises(RuntimeError, match='ERROR: failed'):
+        cli_module.run_pexpect(str(script), '', [], 'RHUG2020', 10, command_file=first)
+    assert first.result()['commands_done'] == 2 and first.result()['complete'] is False
+
+    broken.unlink()
+    again = command_file(path, tmp_path, script=str(script))
+    current_settings, changed, logfile = cli_module.run_pexpect(str(script), '', [], 'RHUG2020', 10,
+                                                                command_file=again)
+    result = again.result()
+    assert result['resumed_from'] == 2
+    assert result['commands_sent'] == 3 and result['commands_done'] == 5
+    assert result['complete'] is True and result['checkpoints'] == 2
+    assert changed is True
+    assert not os.path.exists(again.record)
+    assert command_file(path, tmp_path, script=str(script)).offset == 0
@@ -0,0 +1,63 @@
+import pexpect
+import pytest
+
+from ansible.module_utils.keyva_pexpect.dialog import CLI_DIALOG, INSTALL_DIALOG, Dialog, compile_dialog
+
+
+def dialog(**state):
+    """
+    A dialog of one state 'ask' that waits for 'ready' and ends, plus whatever state sets
+    """
+    ask = dict({'expect': [{'pattern': 'ready', 'end': True}]}, **state)
+    return {'start': 'ask', 'states': {'ask': ask}}
+
+
+def run(spec, script='echo ready; sleep 5', **variables):
+    child = pexpect.spawn('/bin/bash', ['-c', script], timeout=5, encoding='utf-8')
+    try:
+        return Dialog(spec).run(child, variables)
+    finally:
+        child.close(force=True)
+
+
+def test_builtin_dialogs_compile():
+    compile_dialog(INSTALL_DIALOG)
+    compile_dialog(CLI_DIALOG)
+
+
+@pytest.mark.parametrize('spec, message', [
+    (dialog(send='{password'), "invalid template '{password'"),
+    (dialog(send='{0}'), 'positional field'),
+    (dialog(expect=[{'pattern': 'ready', 'fail': 'failed: {}'}]), 'positional field'),
+    (dialog(expect=[{'pattern': 'x', 'capture': 'v', 'word': '1'}]), "word '1', not a number"),
+    (dialog(timeout=[10]), 'timeout [10], not seconds or a variable name'),
+])
+def test_mistakes_found_when_compiled(spec, message):
+    with pytest.raises(ValueError, match="dialog state 'ask'") as err:
+        Dialog(spec)
+    assert message in str(err.value)
+
+
+def test_unknown_variable_in_a_template():
+    with pytest.raises(RuntimeError, match="dialog state 'ask' formats 'hello {nobody}', but 'nobody' is not a"):
+        run(dialog(send='hello {nobody}'))
+    spec = dialog(expect=[{'pattern': 'ready', 'fail': 'failed in {where}'}])
+    with pytest.raises(RuntimeError, match="dialog state 'ask' formats 'failed in {where}'"):
+        run(spec)
+    with pytest.raises(RuntimeError, match='failed in setup'):
+        run(spec, where='setup')
+
+
+def test_timeout_naming_a_missing_variable():
+    with pytest.raises(RuntimeError, match="dialog state 'ask' waits for timeout 'wait', which is not a variable"):
+        run(dialog(timeout='wait'))
+    assert run(dialog(timeout='wait'), wait=5) == {'wait': 5}
+
+
+def test_word_past_the_end_of_the_match():
+    spec = {'start': 'log', 'states': {'log': {'expect': [
+        {'pattern': 'Logfile:.+?\\r\\n', 'capture': 'logfile', 'word': 2, 'end': True}]}}}
+    with pytest.raises(RuntimeError, match="dialog state 'log' captures word 2 of 'Logfile: /tmp/x.log', which has 2"):
+        run(spec, script='echo "Logfile: /tmp/x.log"')
+    spec['states']['log']['expect'][0]['word'] = -1
+    assert run(spec, script='echo "Logfile: /tmp/x.log"')['logfile'] == '/tmp/x.log'
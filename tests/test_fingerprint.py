@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from ansible.module_utils.keyva_pexpect import fingerprint
+
+PARAMS = dict(path='/opt/installer.sh', mock_failure=None, dialog=None)
+
+
+@pytest.fixture
+def installed(tmp_path):
+    """
+    An installer and the marker it left behind, with a fingerprint recorded for them
+    """
+    installer = tmp_path / 'installer.sh'
+    installer.write_text('#!/bin/bash\ntouch marker\n')
+    marker = tmp_path / 'marker'
+    marker.write_text('installed')
+    state_dir = str(tmp_path / 'state')
+    record = fingerprint.save(state_dir, str(installer), PARAMS, [str(marker)], dict(logfile=None, return_code=0))
+    assert record is not None
+    return state_dir, installer, marker
+
+
+def check(installed, params=PARAMS, max_age=0):
+    state_dir, installer, marker = installed
+    return fingerprint.check(state_dir, str(installer), params, [str(marker)], max_age)
+
+
+def test_unchanged_install_matches(installed):
+    record = check(installed)
+    assert record is not None and record['result']['return_code'] == 0
+
+
+def test_changed_installer_content(installed):
+    state_dir, installer, marker = installed
+    stat = os.stat(str(installer))
+    # Same size and mtime, the inode stays too: the recorded hash is trusted
+    with open(str(installer), 'r+') as edited:
+        edited.write('#!/bin/bash\ntouch MARKER\n')
+    os.utime(str(installer), (stat.st_atime, stat.st_mtime))
+    assert check(installed) is not None
+    # Once the mtime moves the content is hashed again and no longer matches
+    os.utime(str(installer), (stat.st_atime, stat.st_mtime + 10))
+    assert check(installed) is None
+
+
+def test_touched_installer_with_the_same_content_still_matches(installed):
+    state_dir, installer, marker = installed
+    stat = os.stat(str(installer))
+    os.utime(str(installer), (stat.st_atime, stat.st_mtime + 10))
+    assert check(installed) is not None
+
+
+def test_changed_params(installed):
+    assert check(installed, dict(PARAMS, mock_failure='password')) is None
+    assert check(installed, dict(PARAMS, dialog='dialog.yml')) is None
+
+
+def test_changed_or_removed_marker(installed):
+    state_dir, installer, marker = installed
+    stat = os.stat(str(marker))
+    os.utime(str(marker), (stat.st_atime, stat.st_mtime + 10))
+    assert check(installed) is None
+    marker.unlink()
+    assert check(installed) is None
+
+
+def test_replaced_marker(installed):
+    # A new file with the same size and times is still a different inode
+    state_dir, installer, marker = installed
+    stat = os.stat(str(marker))
+    replacement = marker.parent / 'replacement'
+    replacement.write_text('installed')
+    os.utime(str(replacement), (stat.st_atime, stat.st_mtime))
+    kept = marker.parent / 'kept'
+    os.rename(str(marker), str(kept))
+    os.rename(str(replacement), str(marker))
+    assert check(installed) is None
+
+
+def test_max_age(installed):
+    state_dir, installer, marker = installed
+    record = check(installed)
+    record['time'] -= 100
+    fingerprint.save_json(fingerprint.record_path(state_dir, str(installer)), record)
+    assert check(installed, max_age=1000) is not None
+    assert check(installed, max_age=10) is None
+
+
+def test_missing_marker_is_not_recorded(installed):
+    state_dir, installer, marker = installed
+    marker.unlink()
+    assert fingerprint.save(state_dir, str(installer), PARAMS, [str(marker)], {}) is None
+    # And whatever was recorded before is gone
+    assert not os.path.exists(fingerprint.record_path(state_dir, str(installer)))
+
+
+def test_record_that_cant_be_saved_raises(tmp_path, installed):
+    # The module turns this into a warning, the install itself went through
+    state_dir, installer, marker = installed
+    blocked = tmp_path / 'blocked'
+    blocked.write_text('a file where the state directory should be')
+    with pytest.raises(OSError):
+        fingerprint.save(str(blocked), str(installer), PARAMS, [str(marker)], {})
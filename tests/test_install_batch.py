@@ -0,0 +1,127 @@
+import os
+import signal
+import time
+
+import pytest
+
+from ansible.module_utils.keyva_pexpect.install_batch import (Installer, dependents, finish, plan_installers,
+                                                              run_batch, schedule_summary)
+
+
+def installer(name, *depends_on):
+    return dict(name=name, path='/opt/{0}.sh'.format(name), depends_on=list(depends_on))
+
+
+def test_plan_installers():
+    depends = plan_installers([installer('a'), installer('b', 'a'), installer('c', 'a', 'b')])
+    assert depends == {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}}
+
+
+@pytest.mark.parametrize('installers, message', [
+    ([installer('a'), installer('a')], "installer name 'a' is used more than once"),
+    ([installer('a', 'z')], "installer 'a' depends on unknown installer 'z'"),
+    ([installer('a', 'b'), installer('b', 'a'), installer('c')], "in a cycle: a, b"),
+    ([installer('a', 'a')], "in a cycle: a"),
+])
+def test_plan_installers_rejects(installers, message):
+    with pytest.raises(ValueError, match=message):
+        plan_installers(installers)
+
+
+def test_dependents_follows_chains():
+    depends = plan_installers([installer('a'), installer('b', 'a'), installer('c', 'b'), installer('d')])
+    assert dependents(depends, 'a') == {'b', 'c'}
+    assert dependents(depends, 'c') == set()
+
+
+def test_failure_skips_dependents_only():
+    installers = [installer('base'), installer('app', 'base'), installer('plugin', 'app'), installer('other')]
+
+    def run(spec):
+        return dict(failed=spec['name'] == 'base', changed=True, msg=spec['name'])
+
+    results = dict((result['name'], result) for result in run_batch(installers, run, concurrency=2))
+    assert results['base']['failed'] is True and 'skipped' not in results['base']
+    assert results['other']['failed'] is False and results['other']['changed'] is True
+    for name in ('app', 'plugin'):
+        assert results[name]['skipped'] is True
+        assert results[name]['failed'] is True
+        assert results[name]['path'] == '/opt/{0}.sh'.format(name)
+    assert "installer 'base'" in results['app']['msg']
+
+
+def test_exception_in_run_is_a_failure():
+    def run(spec):
+        raise RuntimeError('no such script')
+
+    result, = run_batch([installer('a')], run)
+    assert result['failed'] is True
+    assert result['msg'] == 'RuntimeError: no such script'
+    assert result['changed'] is False
+
+
+def test_results_keep_the_given_order_and_run_in_parallel():
+    installers = [installer('slow'), installer('fast'), installer('last', 'fast')]
+
+    def run(spec):
+        time.sleep(0.3 if spec['name'] == 'slow' else 0.1)
+        return dict(failed=False, changed=False)
+
+    start = time.time()
+    results = run_batch(installers, run, concurrency=2)
+    assert [result['name'] for result in results] == ['slow', 'fast', 'last']
+    # fast and last run while slow does
+    assert time.time() - start < 0.5
+    assert results[2]['start_s'] >= results[1]['start_s'] + results[1]['duration_s'] - 0.01
+
+
+def test_schedule_summary():
+    installers = [installer('a'), installer('b', 'a'), installer('c'), installer('d', 'b')]
+    results = [dict(name='a', duration_s=1.0), dict(name='b', duration_s=2.0), dict(name='c', duration_s=2.5),
+               dict(name='d', skipped=True, failed=True)]
+    summary = schedule_summary(installers, results, 3.25)
+    assert summary == {'elapsed_s': 3.25, 'serial_s': 5.5, 'critical_path': ['a', 'b'], 'critical_path_s': 3.0}
+
+
+def forked(body):
+    """
+    An Installer for a forked process that runs body(write_fd) and exits with status 0
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            body(write_fd)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    job = Installer(installer('a'), pid, read_fd, time.time())
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            return job
+        job.data.append(data)
+
+
+def test_finish_with_invalid_json():
+    job = forked(lambda fd: os.write(fd, b'{"failed": fal'))
+    result = finish(job, job.start)
+    assert result['failed'] is True
+    assert result['msg'] == 'the process running the installer exited with 0 before it sent a result'
+    assert result['name'] == 'a' and result['changed'] is False
+
+
+def test_finish_after_a_signal():
+    job = forked(lambda fd: os.kill(os.getpid(), signal.SIGKILL))
+    result = finish(job, job.start)
+    assert result['failed'] is True
+    assert 'was killed by signal {0}'.format(signal.SIGKILL) in result['msg']
+
+
+def test_finish_with_a_result():
+    job = forked(lambda fd: os.write(fd, b'{"failed": false, "changed": true}'))
+    result = finish(job, job.start)
+    assert result['failed'] is False and result['changed'] is True
+    assert result['path'] == '/opt/a.sh'
+    assert result['duration_s'] >= 0
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from ansible.module_utils.keyva_pexpect.logscan import scan
+
+
+@pytest.fixture
+def log(tmp_path):
+    """
+    Appends to a logfile and scans it with a state dir under tmp_path
+    """
+    class Log(object):
+        path = str(tmp_path / 'install.log')
+        state_dir = str(tmp_path / 'state')
+
+        def append(self, text):
+            with open(self.path, 'a') as logfile:
+                logfile.write(text)
+
+        def scan(self, **kwargs):
+            return scan(self.state_dir, self.path, **kwargs)
+    return Log()
+
+
+def test_only_new_lines_are_scanned(log):
+    log.append('start\nERROR: one\nWarning: two\n')
+    first = log.scan()
+    assert first['lines'] == ['ERROR: one', 'Warning: two'] and first['start'] == 0 and not first['restarted']
+    log.append('fine\nERROR: three\n')
+    second = log.scan()
+    assert second['lines'] == ['ERROR: three']
+    assert second['start'] == first['end'] and second['end'] == os.path.getsize(log.path)
+    assert log.scan()['lines'] == []
+
+
+def test_partial_last_line_waits_for_the_next_scan(log):
+    log.append('ERROR: whole\nERROR: still being wri')
+    first = log.scan()
+    assert first['lines'] == ['ERROR: whole'] and first['end'] == len('ERROR: whole\n')
+    log.append('tten\n')
+    assert log.scan()['lines'] == ['ERROR: still being written']
+
+
+def test_replaced_file_starts_from_the_top(log, tmp_path):
+    log.append('ERROR: old\n' * 10)
+    log.scan()
+    rotated = tmp_path / 'new.log'
+    rotated.write_text('ERROR: old\n' * 10 + 'ERROR: new\n')
+    os.rename(str(rotated), log.path)
+    scanned = log.scan()
+    assert scanned['restarted'] and scanned['start'] == 0 and len(scanned['lines']) == 11
+
+
+def test_truncated_file_starts_from_the_top(log):
+    log.append('ERROR: one\nERROR: two\n')
+    log.scan()
+    with open(log.path, 'r+') as logfile:
+        logfile.truncate(len('ERROR: one\n'))
+    scanned = log.scan()
+    assert scanned['restarted'] and scanned['lines'] == ['ERROR: one']
+
+
+def test_rewritten_file_is_caught_by_the_signature(log):
+    log.append('ERROR: one\nERROR: two\n')
+    log.scan()
+    # Same inode and not shorter, only the bytes before the offset differ
+    with open(log.path, 'r+') as logfile:
+        logfile.write('ERROR: new\nERROR: two\nok\n')
+    scanned = log.scan()
+    assert scanned['restarted'] and scanned['lines'] == ['ERROR: new', 'ERROR: two']
+
+
+def test_max_lines(log):
+    log.append('ERROR\n' * 5)
+    scanned = log.scan(max_lines=2)
+    assert scanned['lines'] == ['ERROR', 'ERROR'] and scanned['lines_dropped'] == 3
+
+
+def test_missing_logfile(log):
+    assert log.scan() is None
+
+
+def test_index_that_cant_be_saved_is_a_warning(log, tmp_path):
+    warnings = []
+    log.state_dir = str(tmp_path / 'blocked')
+    (tmp_path / 'blocked').write_text('a file where the state directory should be')
+    log.append('ERROR: one\n')
+    assert log.scan(warn=warnings.append)['lines'] == ['ERROR: one']
+    assert len(warnings) == 1 and "the scan of '{0}'".format(log.path) in warnings[0]
+    # Without an index the next scan sees the same lines again
+    assert log.scan()['lines'] == ['ERROR: one']
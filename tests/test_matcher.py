@@ -0,0 +1,137 @@
+"""
+PatternMatcher against pexpect's own searchers: whatever way the data comes in, the same pattern has to win at
+the same place as it would with child.expect()
+"""
+import re
+
+import pexpect
+import pytest
+from pexpect.expect import searcher_re, searcher_string
+
+from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, Searcher, expect, line_local
+
+CASES = [
+    # Earliest match wins wherever it is in the list
+    (['Done', 'Enter password\\:'], 'Installing... Enter password: Done'),
+    # Ties go to the pattern listed first, a literal and a regex starting at the same place
+    (['pass', r'pass\w+'], 'Enter password:'),
+    ([r'pass\w+', 'pass'], 'Enter password:'),
+    # (?i) and (?m) only apply to their own pattern once the list is one regex
+    (['(?i)password:', 'Done'], 'PASSWORD: done\nDone'),
+    (['Done', '(?m)^port: (\\d+)$'], 'x\nport: 7000\nDone'),
+    ([re.compile('error', re.IGNORECASE), 'ok'], 'all ok, no ERROR'),
+    # The same group name twice can't be one regex, those run one by one
+    (['(?P<v>a+)b', '(?P<v>c+)d', 'e'], 'xxccdaab e'),
+    (['nothing', r'here\d'], 'no match at all'),
+]
+
+
+def pexpect_searcher(patterns):
+    """
+    What child.expect() builds for the same list
+    """
+    return searcher_re([re.compile(p) if isinstance(p, str) else p for p in patterns])
+
+
+def feed(searcher, chunks):
+    """
+    What expect_loop does with a searcher: the buffer grows by one read at a time until something matches
+    """
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        index = searcher.search(buffer, len(chunk))
+        if index >= 0:
+            return index, searcher.start, searcher.end
+    return -1
+
+
+def splits(data):
+    """
+    data read in one go and cut into two reads at every place
+    """
+    yield [data]
+    for n in range(1, len(data)):
+        yield [data[:n], data[n:]]
+
+
+@pytest.mark.parametrize('patterns, data', CASES)
+def test_same_match_as_pexpect(patterns, data):
+    matcher = PatternMatcher(patterns)
+    for chunks in splits(data):
+        assert feed(Searcher(matcher), chunks) == feed(pexpect_searcher(patterns), chunks), chunks
+
+
+def test_literals_same_as_searcher_string():
+    patterns = ['Enter password:', 'Done', 'word']
+    for data in ['Please Enter password: ', 'Please Enter pass', 'a word. Done', 'Done word']:
+        for chunks in splits(data):
+            assert feed(Searcher(PatternMatcher(patterns)), chunks) == feed(searcher_string(patterns), chunks)
+
+
+def test_flags_stay_with_their_pattern():
+    matcher = PatternMatcher(['(?i)password:', 'Done'])
+    assert matcher.find('done PassWord:')[:3] == (0, 5, 14)
+    assert matcher.find('done') is None
+
+
+def test_literal_split_over_many_reads():
+    matcher = PatternMatcher(['Enter password:', r'\$ $'])
+    assert matcher.literals == [(0, 'Enter password:')]
+    chunks = ['Installing\r\nEnt', 'er pa', 's', 'sword', ': ']
+    assert feed(Searcher(matcher), chunks) == (0, 12, 27)
+
+
+def test_eof_and_timeout_entries():
+    matcher = PatternMatcher(['never', pexpect.EOF, pexpect.TIMEOUT])
+    assert (matcher.eof_index, matcher.timeout_index) == (1, 2)
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo bye'], encoding='utf-8')
+    assert expect(child, matcher) == 1
+    assert child.before.strip() == 'bye' and child.after is pexpect.EOF
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo waiting; sleep 5'], encoding='utf-8')
+    assert expect(child, matcher, timeout=0.3) == 2
+    assert child.before.strip() == 'waiting' and child.after is pexpect.TIMEOUT
+    child.close(force=True)
+    # Without them in the list the exception comes through like with child.expect()
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo bye'], encoding='utf-8')
+    with pytest.raises(pexpect.EOF):
+        expect(child, PatternMatcher(['never']))
+
+
+def test_expect_sets_before_and_after_like_pexpect():
+    child = pexpect.spawn('/bin/bash', ['-c', 'printf "Enter pass"; sleep 0.2; printf "word: "; sleep 0.2; echo ok'],
+                          encoding='utf-8')
+    assert expect(child, PatternMatcher(['nothing', 'Enter password:'])) == 1
+    assert (child.before, child.after) == ('', 'Enter password:')
+    assert expect(child, PatternMatcher([r'o\w'])) == 0
+    assert child.before == ' ' and child.match.group(0) == 'ok'
+    child.close()
+
+
+def test_rescan_starts_at_the_last_line():
+    matcher = PatternMatcher([r'port: \d+$', 'Done'])
+    assert matcher.line_local
+    buffer = 'first line\nsecond line\nport: 7'
+    # Two fresh characters, the regex may have started anywhere on the last line, the literal 3 back
+    assert matcher.rescan_start(buffer, len(buffer) - 2) == buffer.rfind('\n') + 1
+    assert PatternMatcher(['Done']).rescan_start(buffer, len(buffer) - 2) == len(buffer) - 2 - 3
+    assert matcher.rescan_start(b'no newline yet', 10) == 0
+
+
+def test_patterns_spanning_lines_rescan_everything():
+    for pattern in [r'a\nb', r'a\sb', 'a[^x]b', '(?s)a.b', 'a.\nb']:
+        assert not line_local(pattern, 0), pattern
+        assert PatternMatcher([pattern]).rescan_start('x\ny\nz', 4) == 0
+    assert not line_local('a.b', re.DOTALL)
+    # Without regex syntax a line break is just part of a literal, that only looks back its own length
+    assert PatternMatcher(['a\nb']).rescan_start('x\ny\nz', 4) == 2
+    # A line break at the very end is still line local
+    assert line_local(r'password:\r\n', 0)
+    for chunks in splits('xa\nby'):
+        assert feed(Searcher(PatternMatcher([r'a\nb'])), chunks) == (0, 1, 4)
+
+
+def test_search_window():
+    searcher = Searcher(PatternMatcher(['abc']))
+    assert searcher.search('abc' + 'x' * 10, 13, searchwindowsize=5) == -1
+    assert searcher.search('abc' + 'x' * 10, 13) == 0
@@ -0,0 +1,46 @@
+import pytest
+
+from ansible.module_utils.keyva_pexpect.dialog import INSTALL_DIALOG, compile_dialog
+
+BAD_PASSWORD = "This program is really bad and doesn't even tell us about bad passwords..."
+
+
+def installer(tmp_path, after_password):
+    """
+    An installer that asks for the password and then runs after_password without printing anything
+    """
+    path = tmp_path / 'installer.sh'
+    path.write_text('#!/bin/bash\nread -p "Please enter your password: " P\n{0}\n'.format(after_password))
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture(params=['hand written', 'dialog'])
+def run(request, install_module):
+    dialog = compile_dialog(INSTALL_DIALOG) if request.param == 'dialog' else None
+
+    def run(path, mock_failure=None):
+        return install_module.run_pexpect(path, 'RHUG2020', 10, mock_failure, password_check='event', dialog=dialog)
+    return run
+
+
+def test_clean_exit_after_the_password_is_a_bad_password(run, mock_installer):
+    with pytest.raises(RuntimeError, match='bad passwords'):
+        run(mock_installer(), mock_failure='password')
+
+
+def test_failing_exit_after_the_password_is_reported(run, tmp_path):
+    with pytest.raises(RuntimeError) as err:
+        run(installer(tmp_path, 'exit 3'))
+    assert str(err.value) == ("The program exited with 3 right after the password was sent, before it printed "
+                              "anything we look for")
+
+
+def test_signal_after_the_password_is_reported(run, tmp_path):
+    with pytest.raises(RuntimeError, match='was killed by signal 9 right after the password'):
+        run(installer(tmp_path, 'kill -9 $$'))
+
+
+def test_good_password_still_installs(run, mock_installer):
+    script_output, logfile, changed, exitstatus, errors = run(mock_installer())
+    assert changed is True and exitstatus == 0
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import time
+
+import pexpect
+import pytest
+
+from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+from ansible.module_utils.keyva_pexpect.progress import ProgressStream, line_chunks
+
+READY = PatternMatcher(['ready'])
+DONE = PatternMatcher(['done'])
+
+
+def events(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+@pytest.mark.parametrize('fifo', [False, True])
+def test_events_are_written_while_the_program_is_quiet(tmp_path, fifo):
+    path = str(tmp_path / 'progress')
+    reader = None
+    if fifo:
+        os.mkfifo(path)
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    stream = ProgressStream(path, 'test', '/bin/bash', interval=0.2)
+    seen = []
+
+    def look():
+        # The child is still sleeping, expect('done') below is blocked in read_nonblocking
+        if fifo:
+            seen.append(os.read(reader, 65536))
+        else:
+            with open(path, 'rb') as progress:
+                seen.append(progress.read())
+
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo ready; sleep 1.5; echo done'])
+    stream.attach(child)
+    expect(child, READY)
+    timer = threading.Timer(0.8, look)
+    timer.start()
+    expect(child, DONE)
+    timer.join()
+    child.close()
+    stream.finish('ok')
+    if reader is not None:
+        os.close(reader)
+    matched = [event for event in events(seen[0]) if event['event'] == 'match']
+    assert [event['text'] for event in matched] == ['ready']
+
+
+def test_quiet_program_still_times_out(tmp_path):
+    stream = ProgressStream(str(tmp_path / 'progress'), 'test', '/bin/bash', interval=0.1)
+    child = pexpect.spawn('/bin/bash', ['-c', 'echo ready; sleep 5'])
+    stream.attach(child)
+    expect(child, READY)
+    start = time.time()
+    with pytest.raises(pexpect.TIMEOUT):
+        expect(child, DONE, timeout=0.5)
+    assert 0.4 < time.time() - start < 1.5
+    child.close()
+    stream.finish('failed')
+    with open(str(tmp_path / 'progress'), 'rb') as progress:
+        assert [event['event'] for event in events(progress.read())][-3:] == ['timeout', 'close', 'end']
+
+
+def test_fifo_without_reader_is_off(tmp_path):
+    path = str(tmp_path / 'fifo')
+    os.mkfifo(path)
+    stream = ProgressStream(path, 'test', '/bin/bash')
+    assert stream.fd is None
+    stream.event('send', bytes=1)
+    assert stream.result()['events'] == 0
+
+
+def test_file_that_cant_be_opened_raises(tmp_path):
+    # The module turns this into a fail_json, unlike a FIFO without a reader it is a mistake in the task
+    with pytest.raises(OSError):
+        ProgressStream(str(tmp_path / 'missing' / 'progress'), 'test', '/bin/bash')
+
+
+def test_line_chunks_keep_lines_whole():
+    data = b'aaaa\nbb\ncccccccc\nd\n'
+    chunks = line_chunks(data, 8)
+    assert b''.join(chunks) == data
+    assert all(chunk.endswith(b'\n') for chunk in chunks)
+    assert chunks == [b'aaaa\nbb\n', b'cccccccc\n', b'd\n']
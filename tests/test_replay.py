@@ -0,0 +1,30 @@
+"""
+Every recorded session in benchmarks/transcripts replayed through run_pexpect(), see benchmarks/replay_fixtures.py
+"""
+import os
+
+import pytest
+
+import replay_fixtures
+
+RUNS = replay_fixtures.runs()
+
+
+@pytest.mark.parametrize('name, module, installed, params, hooks', RUNS, ids=[run[0] for run in RUNS])
+def test_replay(name, module, installed, params, hooks):
+    outcome, problem = replay_fixtures.replay(name.split('+')[0], module, installed, params, **hooks)
+    assert problem is None, '{0}, got {1}'.format(problem, outcome)
+    assert replay_fixtures.PASSWORD not in repr(outcome)
+
+
+def test_every_transcript_has_a_case():
+    recorded = set(name[:-len('.json')] for name in os.listdir(replay_fixtures.TRANSCRIPT_DIR))
+    assert recorded == set(name for name, module, installed, params in replay_fixtures.CASES)
+    assert set(replay_fixtures.DIALOG_CASES) <= recorded
+
+
+def test_bounded_capture_case_keeps_the_redacted_output():
+    outcome, problem = replay_fixtures.replay(*[case for case in replay_fixtures.CASES
+                                                if case[0] == 'install_bounded_capture'][0])
+    assert 'Please enter your password: <redacted>' in outcome['output']
+    assert 'bytes omitted' in outcome['output']
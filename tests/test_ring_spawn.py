@@ -0,0 +1,113 @@
+import pexpect
+import pytest
+
+from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+from ansible.module_utils.keyva_pexpect.ring_spawn import RingSpawn
+
+DONE = PatternMatcher(['DONE'])
+
+
+def spawn(script, **kwargs):
+    return RingSpawn('/bin/bash', ['-c', script], timeout=10, **kwargs)
+
+
+@pytest.fixture
+def idle():
+    """
+    A RingSpawn whose buffer the tests fill by hand
+    """
+    child = spawn('sleep 10', before_size=1000)
+    yield child
+    child.close(force=True)
+
+
+def test_trim_keeps_where_a_match_could_start(idle):
+    idle._pending[:] = b'x' * 3000
+    # The literal could only start in the last 10 bytes, everything over before_size goes
+    idle.trim(DONE, 2990)
+    assert len(idle._pending) == 1000 and idle.before_dropped == 2000
+    # A line local regex could start 1500 bytes back, that much is kept even though it is over before_size
+    idle._pending[:] = b'x' * 3000
+    idle.trim(PatternMatcher([r'DONE \d+']), 1500)
+    assert len(idle._pending) == 1500 and idle.before_dropped == 3500
+
+
+def test_trim_caps_absurd_lines_and_spanning_regexes(idle):
+    # A single line over twice before_size is cut anyway
+    idle._pending[:] = b'x' * 3000
+    idle.trim(DONE, 500)
+    assert len(idle._pending) == 1000
+    # A regex that can span lines may start anywhere, keeping all of it would never stop growing
+    idle._pending[:] = b'x' * 3000
+    idle.trim(PatternMatcher([r'a\sb']), 0)
+    assert len(idle._pending) == 1000
+    # Under before_size nothing happens
+    idle._pending[:] = b'x' * 999
+    idle.trim(DONE, 0)
+    assert len(idle._pending) == 999 and idle.before_dropped == 4000
+
+
+def test_long_output_is_counted_not_kept():
+    # 2000 lines of 50 bytes, 'D' and 'ONE' in separate reads so the literal spans a trim
+    script = 'for i in $(seq 2000); do printf "%049d\\n" $i; done; printf D; sleep 0.2; echo ONE'
+    child = spawn(script, before_size=4096)
+    assert expect(child, DONE) == 0
+    # Every byte before the match is either in before or counted as dropped
+    assert child.before_dropped > 0
+    assert child.before_dropped + len(child.before) == 2000 * 51
+    assert len(child.before) <= 4096 + 51
+    assert child.before.endswith(b'00002000\r\n') and child.after == b'DONE'
+    child.close()
+
+
+def test_pexpect_patterns_get_the_buffer_and_give_it_back():
+    child = spawn('echo one; echo two; echo three; echo four; sleep 5')
+    assert expect(child, PatternMatcher(['one'])) == 0
+    child.expect('three', timeout=5)
+    # pexpect's loop started from what our loop had kept
+    assert child.before == b'\r\ntwo\r\n' and child.after == b'three'
+    assert expect(child, PatternMatcher(['four'])) == 0
+    # What came after pexpect's match came back to us
+    assert child.before == b'\r\n'
+    assert child.expect_exact([b'nothing', pexpect.TIMEOUT], timeout=0.2) == 1
+    # A timeout in pexpect's loop keeps the data too
+    assert expect(child, PatternMatcher([b'\r\n'])) == 0 and child.before == b''
+    child.close(force=True)
+
+
+def test_buffer_property_in_both_modes(idle):
+    idle._pending[:] = b'kept'
+    assert idle.buffer == b'kept'
+    idle.buffer = b'set'
+    assert bytes(idle._pending) == b'set'
+    # While pexpect's loop has it the same property reads and writes its io buffer
+    assert idle.handed_over(lambda: idle.buffer) == b'set'
+    assert idle._pending == bytearray(b'set')
+
+
+def test_eof_expected_and_not():
+    child = spawn('echo last words')
+    assert expect(child, PatternMatcher(['never', pexpect.EOF])) == 1
+    assert child.before == b'last words\r\n' and child.after is pexpect.EOF and child.match is pexpect.EOF
+    assert child.buffer == b''
+    child = spawn('echo last words')
+    with pytest.raises(pexpect.EOF):
+        expect(child, PatternMatcher(['never']))
+    assert child.before == b'last words\r\n' and child.after is pexpect.EOF and child.match is None
+
+
+def test_timeout_keeps_the_data_for_the_next_expect():
+    child = spawn('printf "half a line"; sleep 5')
+    assert expect(child, PatternMatcher(['never', pexpect.TIMEOUT]), timeout=0.3) == 1
+    assert child.before == b'half a line' and child.after is pexpect.TIMEOUT
+    with pytest.raises(pexpect.TIMEOUT):
+        expect(child, PatternMatcher(['never']), timeout=0.3)
+    assert child.match is None
+    assert expect(child, PatternMatcher(['half'])) == 0 and child.before == b''
+    assert child.before_text == '' and child.after_text == 'half'
+    child.close(force=True)
+
+
+def test_text_encoding_is_not_pexpects():
+    with pytest.raises(ValueError):
+        RingSpawn('/bin/true', encoding='utf-8')
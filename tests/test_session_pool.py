@@ -0,0 +1,98 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+
+import pytest
+
+from conftest import MOCK_CLI
+
+from ansible.module_utils.keyva_pexpect import session_pool
+
+
+def pids(pattern):
+    found = subprocess.run(['pgrep', '-f', pattern], stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return sorted(int(pid) for pid in found.split())
+
+
+@pytest.fixture
+def pool(tmp_path):
+    """
+    A private copy of the mock CLI so its processes can be told apart, and a socket for a broker of our own
+    """
+    script = str(tmp_path / 'pooled_cli.sh')
+    shutil.copy(MOCK_CLI, script)
+    socket_path = str(tmp_path / 'pool.sock')
+    yield script, socket_path
+    # Children first, so the broker is still there to collect them
+    for pid in pids(script) + pids(socket_path):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def test_second_task_reuses_the_live_session(pool, monkeypatch):
+    script, socket_path = pool
+    # The broker must find its package without the test's sys.path
+    monkeypatch.delenv('PYTHONPATH', raising=False)
+    first = session_pool.run_pooled(script, '', ['set port 7000', 'set socket.1.port 80'], 'RHUG2020', timeout=10,
+                                    socket_path=socket_path, idle_timeout=30)
+    assert first[1] is True
+    assert len(pids(socket_path)) == 1
+    children = pids(script)
+    assert len(children) == 1
+    # socket.1 was added by the first task, a fresh login would need it added again
+    second = session_pool.run_pooled(script, '', ['set socket.1.host a'], 'RHUG2020', timeout=10,
+                                     socket_path=socket_path, idle_timeout=30)
+    assert second[1] is True
+    assert second[2] == first[2]
+    assert pids(script) == children
+
+
+def test_broker_gets_only_the_module_utils_directory(pool, monkeypatch):
+    script, socket_path = pool
+    started = {}
+
+    def popen(args, **kwargs):
+        started.update(args=args, env=kwargs['env'])
+        return real_popen(args, **kwargs)
+
+    real_popen = subprocess.Popen
+    monkeypatch.setattr(session_pool.subprocess, 'Popen', popen)
+    session_pool.start_broker(socket_path, 30, 2)
+    module_utils = os.path.dirname(os.path.dirname(os.path.abspath(session_pool.__file__)))
+    assert started['env']['PYTHONPATH'] == module_utils
+    assert 'from keyva_pexpect.session_pool import main' in started['args'][2]
+
+
+def test_broker_that_never_answers(pool, monkeypatch):
+    script, socket_path = pool
+    monkeypatch.setattr(session_pool, 'STARTUP_TIMEOUT', 0.2)
+    # Accepts connections in its backlog and never reads them
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    try:
+        with pytest.raises(RuntimeError, match='the session pool broker did not answer within 0.4s'):
+            session_pool.run_pooled(script, '', [], 'RHUG2020', timeout=0.1, socket_path=socket_path)
+    finally:
+        listener.close()
+
+
+def test_stale_socket_of_a_dead_broker_is_replaced(pool):
+    script, socket_path = pool
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    settings, changed, logfile = session_pool.run_pooled(script, '', ['set port 7000'], 'RHUG2020', timeout=10,
+                                                         socket_path=socket_path, idle_timeout=30)
+    assert changed is True and len(pids(socket_path)) == 1
+
+
+def test_socket_already_removed(tmp_path):
+    # Another broker cleaned it up first
+    session_pool.remove_socket(str(tmp_path / 'gone.sock'))
+    with pytest.raises(OSError):
+        session_pool.remove_socket(str(tmp_path))
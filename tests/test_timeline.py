@@ -0,0 +1,22 @@
+from ansible.module_utils.keyva_pexpect.timeline import Profiler, instrumentation
+
+
+def test_profiler_never_entered_has_no_summary():
+    # check mode answered from a saved snapshot never runs the profiled block
+    for mode in ('cprofile', 'tracemalloc'):
+        profiler = Profiler(mode)
+        assert profiler.summary() is None
+        assert 'profile' not in instrumentation(None, profiler)
+
+
+def test_profiler_summary_after_block():
+    for mode in ('cprofile', 'tracemalloc'):
+        profiler = Profiler(mode)
+        with profiler:
+            sum(range(1000))
+        assert instrumentation(None, profiler)['profile']['mode'] == mode
+
+
+def test_instrumentation_without_profiler():
+    assert instrumentation(None, None) == {}
+    assert instrumentation(None, Profiler('none')) == {}
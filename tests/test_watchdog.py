@@ -0,0 +1,109 @@
+import time
+
+import pexpect
+import pytest
+
+from ansible.module_utils.keyva_pexpect import watchdog as watchdog_module
+from ansible.module_utils.keyva_pexpect.matcher import PatternMatcher, expect
+from ansible.module_utils.keyva_pexpect.state import load_json, save_json
+from ansible.module_utils.keyva_pexpect.watchdog import MAX_SAMPLES, MIN_SAMPLES, Watchdog
+
+DONE = PatternMatcher(['done'])
+
+
+def spawn(script, watchdog):
+    child = pexpect.spawn('/bin/bash', ['-c', script], timeout=10)
+    watchdog.attach(child)
+    return child
+
+
+def history(tmp_path, **steps):
+    path = str(tmp_path / 'history.json')
+    save_json(path, {'time': 0, 'steps': steps})
+    return path
+
+
+def timed_expect(child):
+    start = time.time()
+    try:
+        expect(child, DONE)
+    finally:
+        child.close(force=True)
+    return time.time() - start
+
+
+def test_idle_timeout_fires_long_before_the_task_timeout():
+    watchdog = Watchdog(idle_timeout=0.5)
+    child = spawn('echo started; sleep 5; echo done', watchdog)
+    with pytest.raises(pexpect.TIMEOUT, match='No output for 0.5s'):
+        timed_expect(child)
+    assert watchdog.fired == 'No output for 0.5s, the program looks hung'
+
+
+def test_output_keeps_the_idle_timeout_away():
+    watchdog = Watchdog(idle_timeout=0.5)
+    child = spawn('for i in 1 2 3 4 5 6; do echo working; sleep 0.2; done; echo done', watchdog)
+    assert timed_expect(child) > 1
+    assert watchdog.fired is None
+
+
+def test_deadline_is_p99_times_the_factor(tmp_path):
+    samples = [float(n) for n in range(1, 101)]
+    watchdog = Watchdog(history=history(tmp_path, install=samples, short=[0.1] * MIN_SAMPLES), factor=2,
+                        min_deadline=1)
+    # p99 of 1..100 is 100, a step that always took 0.1s still gets min_deadline
+    assert watchdog.deadlines == {'install': 200.0, 'short': 1}
+
+
+def test_too_few_samples_give_no_deadline(tmp_path):
+    watchdog = Watchdog(history=history(tmp_path, install=[1.0] * (MIN_SAMPLES - 1)))
+    assert watchdog.deadlines == {}
+    watchdog.start_step('install')
+    assert watchdog.limit() == (None, None)
+
+
+def test_step_past_its_deadline_fails_once_quiet(tmp_path, monkeypatch):
+    monkeypatch.setattr(watchdog_module, 'OVERRUN_IDLE', 0.4)
+    watchdog = Watchdog(history=history(tmp_path, install=[0.1] * MIN_SAMPLES), factor=1, min_deadline=0.2)
+    watchdog.start_step('install')
+    # Printing past the 0.2s deadline is fine, the step fails 0.4s after it goes quiet
+    child = spawn('for i in 1 2 3 4 5; do echo working; sleep 0.2; done; sleep 5; echo done', watchdog)
+    start = time.time()
+    with pytest.raises(pexpect.TIMEOUT, match="Step 'install' ran past its deadline of 0.2s"):
+        timed_expect(child)
+    assert 1 < time.time() - start < 3
+
+
+def test_overrun_idle_and_idle_timeout_take_the_earlier(tmp_path):
+    watchdog = Watchdog(idle_timeout=60, history=history(tmp_path, install=[1.0] * MIN_SAMPLES), factor=1,
+                        min_deadline=1)
+    now = time.time()
+    watchdog.steps = [('install', now - 100)]
+    watchdog.last_activity = now
+    fire_at, reason = watchdog.limit()
+    assert fire_at == now + watchdog_module.OVERRUN_IDLE and reason.startswith("Step 'install'")
+    # Within its deadline the idle timeout is what counts
+    watchdog.steps = [('install', now + 100)]
+    fire_at, reason = watchdog.limit()
+    assert fire_at == now + 60 and reason.startswith('No output')
+
+
+def test_save_adds_to_the_history(tmp_path):
+    path = history(tmp_path, install=[1.0] * MAX_SAMPLES)
+    watchdog = Watchdog(history=path)
+    watchdog.mark('install')
+    watchdog.mark('verify')
+    # The open step is ended by save()
+    watchdog.save()
+    steps = load_json(path)['steps']
+    assert len(steps['install']) == MAX_SAMPLES and steps['install'][-1] < 1
+    assert len(steps['verify']) == 1
+
+
+def test_history_that_cant_be_saved_is_a_warning(tmp_path):
+    (tmp_path / 'blocked').write_text('a file where the state directory should be')
+    watchdog = Watchdog(history=str(tmp_path / 'blocked' / 'history.json'))
+    watchdog.mark('install')
+    warnings = []
+    watchdog.save(warn=warnings.append)
+    assert len(warnings) == 1 and warnings[0].startswith('Unable to save the step history')